@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Artifact download throughput: FileIter versus wsgi.file_wrapper
+
+Serves an artifact from a local frontend data directory to a socket, once
+through the plain FileIter path where every chunk is copied through Python,
+and once through a wsgi.file_wrapper that sends the file with sendfile(),
+like servers implementing the wrapper natively do. Reports throughput and
+CPU time of the process, sender and receiver, per gigabyte.
+
+Usage: PYTHONPATH=src python benchmarks/download_throughput.py [--size-mb N] [--rounds N]
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import ctypes
+import ctypes.util
+import logging
+import argparse
+import tempfile
+import threading
+
+import webob
+
+from distci import frontend
+
+LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+LIBC.sendfile.argtypes = [ ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t ]
+LIBC.sendfile.restype = ctypes.c_ssize_t
+
+class SendfileWrapper(object):
+    """ wsgi.file_wrapper recognized by serve() """
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.blksize), '')
+
+    def close(self):
+        self.filelike.close()
+
+def serve(app, environ, sock):
+    """ Minimal WSGI server loop writing the response body to sock """
+    def start_response(status, headers, exc_info=None):
+        assert status.startswith('200'), status
+    result = app(environ, start_response)
+    try:
+        if isinstance(result, SendfileWrapper):
+            fdesc = result.filelike.fileno()
+            while True:
+                ret = LIBC.sendfile(sock.fileno(), fdesc, None, result.blksize)
+                if ret < 0:
+                    raise OSError(ctypes.get_errno(), 'sendfile failed')
+                if ret == 0:
+                    break
+        else:
+            for chunk in result:
+                sock.sendall(chunk)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+def drain(sock, counter):
+    """ Read and discard everything from sock """
+    buf = bytearray(1024*1024)
+    while True:
+        ret = sock.recv_into(buf)
+        if ret == 0:
+            break
+        counter[0] += ret
+
+def measure(app, path, file_wrapper):
+    """ Return (bytes, seconds, cpu seconds) for one download """
+    environ = webob.Request.blank(path).environ
+    if file_wrapper:
+        environ['wsgi.file_wrapper'] = SendfileWrapper
+    sender, receiver = socket.socketpair()
+    counter = [ 0 ]
+    reader = threading.Thread(target=drain, args=(receiver, counter))
+    reader.start()
+    start_times = os.times()
+    start = time.time()
+    serve(app, environ, sender)
+    sender.shutdown(socket.SHUT_WR)
+    reader.join()
+    elapsed = time.time() - start
+    end_times = os.times()
+    sender.close()
+    receiver.close()
+    cpu = (end_times[0] - start_times[0]) + (end_times[1] - start_times[1])
+    return counter[0], elapsed, cpu
+
+def setup_artifact(app, data_directory, size_mb):
+    """ Store an artifact of size_mb megabytes, return its path """
+    request = webob.Request.blank('/jobs/bench', method='PUT', body=json.dumps({'job_id': 'bench'}))
+    assert request.get_response(app).status_int == 200
+    response = webob.Request.blank('/jobs/bench/builds', method='POST').get_response(app)
+    build_number = json.loads(response.body)['build_number']
+
+    source_path = os.path.join(data_directory, 'source')
+    block = os.urandom(1024*1024)
+    with open(source_path, 'wb') as fileo:
+        for _ in range(size_mb):
+            fileo.write(block)
+    with open(source_path, 'rb') as fileo:
+        request = webob.Request.blank('/jobs/bench/builds/%d/artifacts' % build_number, method='POST')
+        request.body_file = fileo
+        request.content_length = size_mb * 1024 * 1024
+        response = request.get_response(app)
+    os.unlink(source_path)
+    return '/jobs/bench/builds/%d/artifacts/%s' % (build_number, json.loads(response.body)['artifact_id'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare artifact download paths')
+    parser.add_argument('--size-mb', type=int, default=512, help='artifact size in megabytes')
+    parser.add_argument('--rounds', type=int, default=5, help='downloads per path')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    data_directory = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(data_directory, 'jobs'))
+        app = frontend.Frontend({ 'data_directory': data_directory })
+        path = setup_artifact(app, data_directory, args.size_mb)
+        for name, file_wrapper in (('FileIter', False), ('file_wrapper', True)):
+            results = [ measure(app, path, file_wrapper) for _ in range(args.rounds) ]
+            total = sum(result[0] for result in results)
+            assert total == args.size_mb * 1024 * 1024 * args.rounds, 'short download'
+            elapsed = sum(result[1] for result in results)
+            cpu = sum(result[2] for result in results)
+            print '%-12s %8.1f MB/s %8.2f CPU s/GB' % (name, total / elapsed / 1024 / 1024, cpu / (total / 1024.0 / 1024 / 1024))
+    finally:
+        shutil.rmtree(data_directory)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Frontend request throughput per storage backend
+
+Runs a mix of build requests (create build, store and fetch build state,
+store and fetch workspace, list builds) straight against the WSGI
+application from several threads, with local file system storage and with
+the in-memory backend. The difference is the share of storage latency in
+request handling; the in-memory figure is the ceiling of the frontend code
+itself.
+
+Usage: PYTHONPATH=src python benchmarks/request_throughput.py [--requests N] [--threads N]
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+
+import webob
+
+from distci import frontend
+
+WORKSPACE = os.urandom(64*1024)
+
+def request(app, path, method='GET', body=None, status=200):
+    """ Run one request, check its status """
+    req = webob.Request.blank(path, method=method)
+    if body is not None:
+        req.body = body
+        req.content_type = 'application/octet-stream'
+    response = req.get_response(app)
+    assert response.status_int == status, '%s %s: %s' % (method, path, response.status)
+    return response
+
+def client(app, job_id, count):
+    """ Run 'count' rounds of the request mix on one job """
+    request(app, '/jobs/%s' % job_id, 'PUT', json.dumps({'job_id': job_id}))
+    for _ in range(count):
+        response = request(app, '/jobs/%s/builds' % job_id, 'POST', status=201)
+        build = '/jobs/%s/builds/%d' % (job_id, json.loads(response.body)['build_number'])
+        request(app, build + '/state', 'PUT', json.dumps({'status': 'running'}))
+        request(app, build + '/state')
+        request(app, build + '/workspace', 'PUT', WORKSPACE, status=204)
+        request(app, build + '/workspace')
+        request(app, '/jobs/%s/builds' % job_id)
+
+def measure(config, rounds, threads):
+    """ Return requests per second for the configuration """
+    app = frontend.Frontend(config)
+    workers = [ threading.Thread(target=client, args=(app, 'bench%d' % i, rounds)) for i in range(threads) ]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return rounds * threads * 6 / (time.time() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare frontend throughput per storage backend')
+    parser.add_argument('--requests', type=int, default=200, help='request mix rounds per thread')
+    parser.add_argument('--threads', type=int, default=4, help='client threads')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    data_directory = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(data_directory, 'jobs'))
+        for backend in ('localfs', 'memory'):
+            config = { 'data_directory': data_directory, 'storage_backend': backend }
+            print '%-8s %8.1f requests/s' % (backend, measure(config, args.requests, args.threads))
+    finally:
+        shutil.rmtree(data_directory)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Workspace upload throughput: buffered copy versus zero-copy ingest
+
+Uploads a workspace of the given size to a frontend served by wsgiref,
+with storage_zero_copy_uploads off and on. The client runs in a separate
+process, so the reported CPU time is the frontend's alone, and MB/s per
+core is the throughput one fully busy core could sustain.
+
+Usage: PYTHONPATH=src python benchmarks/upload_throughput.py [--size-mb N] [--rounds N]
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import httplib
+import logging
+import argparse
+import tempfile
+import wsgiref.simple_server
+
+import webob
+
+from distci import frontend
+from distci.frontend import storage
+
+class SilentWSGIRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def upload(port, path, source_path, size):
+    """ Client process: PUT source file, exit with 0 on 204 """
+    conn = httplib.HTTPConnection('localhost', port)
+    conn.putrequest('PUT', path)
+    conn.putheader('Content-Type', 'application/octet-stream')
+    conn.putheader('Content-Length', str(size))
+    conn.endheaders()
+    with open(source_path, 'rb') as fileo:
+        while True:
+            data = fileo.read(1024*1024)
+            if not data:
+                break
+            conn.sock.sendall(data)
+    os._exit(0 if conn.getresponse().status == 204 else 1)
+
+def measure(server, path, source_path, size):
+    """ Return (seconds, cpu seconds) of the frontend for one upload """
+    pid = os.fork()
+    if pid == 0:
+        server.socket.close()
+        upload(server.socket_port, path, source_path, size)
+    start_times = os.times()
+    start = time.time()
+    server.handle_request()
+    elapsed = time.time() - start
+    end_times = os.times()
+    _, status = os.waitpid(pid, 0)
+    assert status == 0, 'upload failed'
+    return elapsed, (end_times[0] - start_times[0]) + (end_times[1] - start_times[1])
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare workspace upload paths')
+    parser.add_argument('--size-mb', type=int, default=1024, help='workspace size in megabytes')
+    parser.add_argument('--rounds', type=int, default=3, help='uploads per path')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    data_directory = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(data_directory, 'jobs'))
+        config = { 'data_directory': data_directory }
+        app = frontend.Frontend(config)
+        assert webob.Request.blank('/jobs/bench', method='PUT', body=json.dumps({'job_id': 'bench'})).get_response(app).status_int == 200
+        response = webob.Request.blank('/jobs/bench/builds', method='POST').get_response(app)
+        path = '/jobs/bench/builds/%d/workspace' % json.loads(response.body)['build_number']
+
+        source_path = os.path.join(data_directory, 'source')
+        block = os.urandom(1024*1024)
+        with open(source_path, 'wb') as fileo:
+            for _ in range(args.size_mb):
+                fileo.write(block)
+        size = args.size_mb * 1024 * 1024
+
+        server = wsgiref.simple_server.make_server('localhost', 0, app, handler_class=SilentWSGIRequestHandler)
+        server.socket_port = server.socket.getsockname()[1]
+        for name, zero_copy in (('buffered', False), ('zero-copy', True)):
+            config['storage_zero_copy_uploads'] = zero_copy
+            storage.configure(config)
+            results = [ measure(server, path, source_path, size) for _ in range(args.rounds) ]
+            total = size * args.rounds / 1024.0 / 1024
+            elapsed = sum(result[0] for result in results)
+            cpu = sum(result[1] for result in results)
+            print '%-10s %8.1f MB/s %8.1f MB/s per core' % (name, total / elapsed, total / max(cpu, 0.001))
+        server.server_close()
+    finally:
+        shutil.rmtree(data_directory)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,13 +12,18 @@ class Client(object):
     def __init__(self, parent):
         self.parent = parent
 
-    def put(self, job_id, build_id, fileobj, fileobj_len):
-        """ Push a build artifact """
+    def put(self, job_id, build_id, fileobj, fileobj_len, sha256=None):
+        """ Push a build artifact. If 'sha256' is given, the frontend
+            rejects content that does not match it. """
+        query = None
+        if sha256 is not None:
+            query = [ ('sha256', sha256) ]
         try:
             response = self.parent.rest.do_build_request('POST',
                                                          job_id,
                                                          build_id,
                                                          'artifacts',
+                                                         query=query,
                                                          data=fileobj,
                                                          data_len=fileobj_len,
                                                          content_type="application/octet-stream")
@@ -36,27 +41,49 @@ class Client(object):
             self.parent.log.exception('Failed to decode reply to post artifact, %s', job_id)
             return None
 
-    def get(self, job_id, build_id, artifact_id, fileobj):
-        """ Get an artifact """
+    def link(self, job_id, build_id, sha256, size):
+        """ Create a build artifact from content the frontend already has,
+            identified by digest and size. Returns None if the content is
+            unknown and has to be uploaded with put. """
         try:
-            response = self.parent.rest.do_build_request('GET',
+            response = self.parent.rest.do_build_request('POST',
                                                          job_id,
                                                          build_id,
-                                                         'artifacts/%s' % artifact_id)
+                                                         'artifacts',
+                                                         query=[ ('sha256', sha256), ('size', size) ])
+        except:
+            self.parent.log.exception('Failed to link artifact %s/%s', job_id, build_id)
+            return None
+
+        if response.status == 404:
+            response.read()
+            return None
+
+        if response.status != 201:
+            self.parent.log.error('Linking artifact %s/%s failed with HTTP code %d', job_id, build_id, response.status)
+            return None
+
+        try:
+            return json.loads(response.read())
+        except (TypeError, ValueError):
+            self.parent.log.exception('Failed to decode reply to link artifact, %s', job_id)
+            return None
+
+    def get(self, job_id, build_id, artifact_id, fileobj):
+        """ Get an artifact, resuming interrupted downloads """
+        try:
+            status = self.parent.rest.download_build_file(job_id,
+                                                          build_id,
+                                                          'artifacts/%s' % artifact_id,
+                                                          fileobj)
         except:
             self.parent.log.exception('Failed to get artifact %s/%s/%s', job_id, build_id, artifact_id)
             return False
 
-        if response.status != 200:
-            self.parent.log.error('Getting artifact %s/%s/%s failed with HTTP code %d', job_id, build_id, artifact_id, response.status)
+        if status != 200:
+            self.parent.log.error('Getting artifact %s/%s/%s failed with HTTP code %d', job_id, build_id, artifact_id, status)
             return False
 
-        while True:
-            data = response.read(1024*64)
-            if data == '':
-                break
-            fileobj.write(data)
-
         return True
 
     def delete(self, job_id, build_id, artifact_id):
@@ -18,13 +18,16 @@ class Client(object):
         self.console = console.Client(parent)
         self.artifacts = artifacts.Client(parent)
 
-    def list(self, job_id):
-        """ list all build """
+    def list(self, job_id, limit=None, before=None, after=None, order=None):
+        """ list builds, all of them or a page selected by the optional
+            limit, before/after build number bounds and order ('asc'/'desc') """
+        query = [ (key, value) for key, value in (('limit', limit), ('before', before), ('after', after), ('order', order)) if value is not None ]
         try:
             response = self.parent.rest.do_build_request('GET',
                                                          job_id,
                                                          None,
-                                                         None)
+                                                         None,
+                                                         query=query)
         except:
             self.parent.log.exception('Failed to list builds for %s', job_id)
             return None
@@ -71,7 +74,7 @@ class Client(object):
             self.parent.log.exception('Failed to delete build %s/%s', job_id, build_id)
             return False
 
-        if response.status != 204 or response.status != 404:
+        if response.status not in (202, 204, 404):
             self.parent.log.error('Delete build %s/%s failed with HTTP code %d', job_id, build_id, response.status)
             return False
 
@@ -29,13 +29,23 @@ class Client(object):
 
         return True
 
-    def get(self, job_id, build_id):
-        """ get console log """
+    def get(self, job_id, build_id, offset=None, length=None, tail=None):
+        """ get console log, or the part of it selected by offset and
+            length or by tail """
+        result = self.fetch(job_id, build_id, offset, length, tail)
+        if result is None:
+            return None
+        return result[0]
+
+    def fetch(self, job_id, build_id, offset=None, length=None, tail=None):
+        """ get console log or part of it, returns (data, total log size) """
+        query = [ (key, value) for key, value in (('offset', offset), ('length', length), ('tail', tail)) if value is not None ]
         try:
             response = self.parent.rest.do_build_request('GET',
                                                          job_id,
                                                          build_id,
-                                                         'console')
+                                                         'console',
+                                                         query=query)
         except:
             self.parent.log.exception('Failed to get console log config for %s', job_id)
             return None
@@ -44,5 +54,36 @@ class Client(object):
             self.parent.log.error('Get console log %s failed with HTTP code %d', job_id, response.status)
             return None
 
-        return response.read()
+        data = response.read()
+        try:
+            log_len = int(response.getheader('X-Console-Size'))
+        except (TypeError, ValueError):
+            log_len = len(data)
+        return data, log_len
+
+    def follow(self, job_id, build_id, since=0, wait=None):
+        """ wait for console log content after offset 'since', returns
+            (data, total log size, build complete) """
+        query = [ ('since', since) ]
+        if wait is not None:
+            query.append(('wait', wait))
+        try:
+            response = self.parent.rest.do_build_request('GET',
+                                                         job_id,
+                                                         build_id,
+                                                         'console',
+                                                         query=query)
+        except:
+            self.parent.log.exception('Failed to follow console log for %s/%s', job_id, build_id)
+            return None
+
+        if response.status != 200:
+            self.parent.log.error('Follow console log %s/%s failed with HTTP code %d', job_id, build_id, response.status)
+            return None
 
+        data = response.read()
+        try:
+            log_len = int(response.getheader('X-Console-Size'))
+        except (TypeError, ValueError):
+            log_len = since + len(data)
+        return data, log_len, response.getheader('X-Build-Complete') == 'true'
@@ -81,7 +81,7 @@ class Client(object):
             self.parent.log.exception('Failed to delete job %s', job_id)
             return False
 
-        if response.status != 204 and response.status != 404:
+        if response.status not in (202, 204, 404):
             self.parent.log.error('Delete job %s failed with HTTP code %d', job_id, response.status)
             return False
 
@@ -7,7 +7,43 @@ See LICENSE for details
 
 import httplib
 import urlparse
+import urllib
 import random
+import socket
+
+DOWNLOAD_ATTEMPTS = 5
+DOWNLOAD_CHUNK_SIZE = 1024*64
+UPLOAD_CHUNK_SIZE = 1024*64
+
+class ChunkedWriter(object):
+    """ File-like object sending written data as an HTTP/1.1 chunked
+        request body """
+    def __init__(self, conn, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.buf = []
+        self.buf_len = 0
+
+    def write(self, data):
+        """ buffer data, sending it once there is a chunk worth """
+        if not data:
+            return
+        self.buf.append(data)
+        self.buf_len += len(data)
+        if self.buf_len >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """ send buffered data as a chunk """
+        if self.buf_len > 0:
+            self.conn.send('%x\r\n%s\r\n' % (self.buf_len, ''.join(self.buf)))
+            self.buf = []
+            self.buf_len = 0
+
+    def close(self):
+        """ send remaining data and the terminating chunk """
+        self.flush()
+        self.conn.send('0\r\n\r\n')
 
 class RESTHelper(object):
     """ Helper class for REST operations """
@@ -39,6 +75,29 @@ class RESTHelper(object):
         response = conn.getresponse()
         return response
 
+    @classmethod
+    def _do_streaming_request(cls, base_url, method, path, producer, extra_headers=None, content_type='application/octet-stream'):
+        """ Internal helper for requests with a chunked body of unknown
+            length. producer is called with a file-like object to write
+            the body into. """
+        base_scheme, base_netloc, base_path, _, _ = urlparse.urlsplit(base_url)
+        resource = urlparse.urljoin(base_path, path)
+        if base_scheme == 'http':
+            conn = httplib.HTTPConnection(base_netloc)
+        else:
+            conn = httplib.HTTPSConnection(base_netloc)
+        conn.putrequest(method, resource)
+        conn.putheader('Content-Type', content_type)
+        conn.putheader('Transfer-Encoding', 'chunked')
+        if extra_headers:
+            for header, value in extra_headers.iteritems():
+                conn.putheader(header, value)
+        conn.endheaders()
+        writer = ChunkedWriter(conn)
+        producer(writer)
+        writer.close()
+        return conn.getresponse()
+
     def do_task_request(self, method, task_id, **kwargs):
         """ Perform a request on task frontends """
         base_url = random.choice(self.parent.config['task_frontends'])
@@ -63,7 +122,7 @@ class RESTHelper(object):
                                 path,
                                 **kwargs)
 
-    def do_build_request(self, method, job_id, build_id, subcommand, **kwargs):
+    def do_build_request(self, method, job_id, build_id, subcommand, query=None, **kwargs):
         """ Perform a build related request on frontends """
         base_url = random.choice(self.parent.config['frontends'])
         path = 'jobs/%s/builds' % job_id
@@ -71,8 +130,65 @@ class RESTHelper(object):
             path = '%s/%s' % (path, build_id)
             if subcommand is not None:
                 path = '%s/%s' % (path, subcommand)
+        if query:
+            path = '%s?%s' % (path, urllib.urlencode(query))
         return self._do_request(base_url,
                                 method,
                                 path,
                                 **kwargs)
 
+    def do_build_streaming_request(self, method, job_id, build_id, subcommand, producer, **kwargs):
+        """ Perform a build related request with a streamed request body """
+        base_url = random.choice(self.parent.config['frontends'])
+        path = 'jobs/%s/builds/%s/%s' % (job_id, build_id, subcommand)
+        return self._do_streaming_request(base_url,
+                                          method,
+                                          path,
+                                          producer,
+                                          **kwargs)
+
+    def download_build_file(self, job_id, build_id, subcommand, fileobj, attempts=DOWNLOAD_ATTEMPTS, response_headers=None):
+        """ Download a build file into fileobj. Interrupted transfers are
+            resumed with a Range request, guarded by If-Range so that a
+            changed file is downloaded again from the start, which needs a
+            seekable fileobj. Returns the HTTP status of the download, and
+            fills response_headers, if given, with the (lowercase) headers
+            of the response that started it. """
+        written = 0
+        etag = None
+        for attempt in range(attempts):
+            headers = {}
+            if written > 0 and etag is not None:
+                headers['Range'] = 'bytes=%d-' % written
+                headers['If-Range'] = etag
+            expected = None
+            try:
+                response = self.do_build_request('GET', job_id, build_id, subcommand, extra_headers=headers)
+                if response.status == 200:
+                    if written > 0:
+                        fileobj.seek(0)
+                        fileobj.truncate()
+                        written = 0
+                    etag = response.getheader('ETag')
+                    if response_headers is not None:
+                        response_headers.clear()
+                        response_headers.update(response.getheaders())
+                elif response.status != 206:
+                    return response.status
+                if response.getheader('Content-Length') is not None:
+                    expected = written + int(response.getheader('Content-Length'))
+                while True:
+                    data = response.read(DOWNLOAD_CHUNK_SIZE)
+                    if data == '':
+                        break
+                    fileobj.write(data)
+                    written += len(data)
+            except (socket.error, httplib.HTTPException):
+                if attempt == attempts - 1:
+                    raise
+                self.parent.log.exception('Download of %s/%s/%s interrupted at %d bytes', job_id, build_id, subcommand, written)
+                continue
+            if expected is None or written >= expected:
+                return 200
+            self.parent.log.warning('Download of %s/%s/%s interrupted at %d of %d bytes', job_id, build_id, subcommand, written, expected)
+        raise IOError('Download of %s/%s/%s incomplete' % (job_id, build_id, subcommand))
@@ -6,6 +6,7 @@ See LICENSE for details
 """
 
 import tempfile
+import hashlib
 import os
 import shutil
 import threading
@@ -92,7 +93,30 @@ class TestDistcilibClientTasks:
         artifact.seek(0)
         assert artifact.read() == self.state['artifact_contents'], "Artifact content mismatch"
 
-    def test_03_delete_delete(self):
+    def test_03_link_artifact(self):
+        sha256 = hashlib.sha256(self.state['artifact_contents']).hexdigest()
+        result = self.client.builds.artifacts.link(self.state['job_id'], self.state['build_number'], sha256, len(self.state['artifact_contents']))
+        assert result is not None, "Failed to link stored content"
+        assert result.get('sha256') == sha256, "Reply has wrong digest"
+        assert result.get('artifact_id') != self.state['artifact_id'], "Artifact ID reused"
+
+        artifact = tempfile.TemporaryFile()
+        assert self.client.builds.artifacts.get(self.state['job_id'], self.state['build_number'], result['artifact_id'], artifact) == True, "Failed to retrieve linked artifact"
+        artifact.seek(0)
+        assert artifact.read() == self.state['artifact_contents'], "Linked artifact content mismatch"
+
+        unknown_sha256 = hashlib.sha256('unknown content').hexdigest()
+        assert self.client.builds.artifacts.link(self.state['job_id'], self.state['build_number'], unknown_sha256, 15) is None, "Linked unknown content"
+
+        artifact = tempfile.TemporaryFile()
+        artifact.write('unknown content')
+        artifact.seek(0)
+        assert self.client.builds.artifacts.put(self.state['job_id'], self.state['build_number'], artifact, 15, sha256) is None, "Accepted content not matching digest"
+        artifact.seek(0)
+        result = self.client.builds.artifacts.put(self.state['job_id'], self.state['build_number'], artifact, 15, unknown_sha256)
+        assert result is not None and result.get('sha256') == unknown_sha256, "Failed to store verified content"
+
+    def test_04_delete_delete(self):
         self.client.builds.artifacts.delete(self.state['job_id'], self.state['build_number'], self.state['artifact_id'])
 
         artifact = tempfile.TemporaryFile()
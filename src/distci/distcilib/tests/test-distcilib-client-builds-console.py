@@ -100,3 +100,16 @@ class TestDistcilibClientTasks:
         assert reply is not None, "Failed to get console log"
         assert reply == self.state['console_contents'], "Wrong data"
 
+
+    def test_04_get_console_range(self):
+        contents = self.state['console_contents']
+        data, log_len = self.client.builds.console.fetch(self.state['job_id'], self.state['build_number'], offset=8, length=7)
+        assert data == contents[8:15], "Wrong data for range"
+        assert log_len == len(contents), "Wrong console size"
+
+        data, log_len = self.client.builds.console.fetch(self.state['job_id'], self.state['build_number'], offset=len(contents))
+        assert data == '', "Data beyond end of log"
+        assert log_len == len(contents), "Wrong console size"
+
+        reply = self.client.builds.console.get(self.state['job_id'], self.state['build_number'], tail=8)
+        assert reply == contents[-8:], "Wrong data for tail"
@@ -33,6 +33,19 @@ class TestDistcilibClientTasks:
     config_file = None
     data_directory = None
     state = {}
+    interrupted_downloads = 0
+    range_requests = []
+
+    @classmethod
+    def route_request(cls, environ, start_response):
+        if environ.has_key('HTTP_RANGE'):
+            cls.range_requests.append(environ['HTTP_RANGE'])
+        if cls.interrupted_downloads > 0 and environ['REQUEST_METHOD'] == 'GET':
+            # send headers in full but only half of the body, like a dropped connection
+            cls.interrupted_downloads -= 1
+            body = ''.join(cls.frontend_app(environ, start_response))
+            return [ body[:len(body) / 2] ]
+        return cls.frontend_app(environ, start_response)
 
     @classmethod
     def setUpClass(cls):
@@ -45,7 +58,7 @@ class TestDistcilibClientTasks:
 
         cls.frontend_app = frontend.Frontend(frontend_config)
 
-        cls.server = wsgiref.simple_server.make_server('localhost', 0, cls.frontend_app, handler_class=SilentWSGIRequestHandler)
+        cls.server = wsgiref.simple_server.make_server('localhost', 0, cls.route_request, handler_class=SilentWSGIRequestHandler)
         cls.server_port = cls.server.socket.getsockname()[1]
 
         cls.slave = BackgroundHttpServer(cls.server)
@@ -89,7 +102,15 @@ class TestDistcilibClientTasks:
         wspace.seek(0)
         assert wspace.read() == self.state['workspace_contents'], "Workspace content mismatch"
 
-    def test_03_delete_workspace(self):
+    def test_03_resume_workspace(self):
+        self.__class__.interrupted_downloads = 1
+        wspace = tempfile.TemporaryFile()
+        assert self.client.builds.workspace.get(self.state['job_id'], self.state['build_number'], wspace) == True, "Failed to retrieve workspace"
+        wspace.seek(0)
+        assert wspace.read() == self.state['workspace_contents'], "Workspace content mismatch"
+        assert self.range_requests == [ 'bytes=6-' ], "Download was not resumed"
+
+    def test_04_delete_workspace(self):
         self.client.builds.workspace.delete(self.state['job_id'], self.state['build_number'])
 
         wspace = tempfile.TemporaryFile()
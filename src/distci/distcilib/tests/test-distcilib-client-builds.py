@@ -89,7 +89,21 @@ class TestDistcilibClientTasks:
         assert builds.has_key('builds'), "Missing builds key in list reply"
         assert self.state['build_number'] in builds['builds'], "Our build not present on builds list"
 
-    def test_04_delete_build(self):
+    def test_04_list_builds_paged(self):
+        for _ in range(3):
+            assert self.client.builds.trigger(self.state['job_id']) is not None, "Empty result for trigger build"
+        all_builds = self.client.builds.list(self.state['job_id'])['builds']
+        assert all_builds == sorted(all_builds), "Builds not in ascending order"
+
+        builds = self.client.builds.list(self.state['job_id'], limit=2, order='desc')
+        assert builds is not None, "Empty result for list builds"
+        assert builds['builds'] == all_builds[-1:-3:-1], "Wrong page for newest builds"
+        assert builds['last_build_number'] == all_builds[-1], "Wrong last build number"
+
+        builds = self.client.builds.list(self.state['job_id'], before=all_builds[-1], after=all_builds[0])
+        assert builds['builds'] == all_builds[1:-1], "Wrong page for build range"
+
+    def test_05_delete_build(self):
         self.client.builds.delete(self.state['job_id'], self.state['build_number'])
 
         builds = self.client.builds.list(self.state['job_id'])
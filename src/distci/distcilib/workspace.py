@@ -5,18 +5,35 @@ Copyright (c) 2012-2013 Heikki Nousiainen, F-Secure
 See LICENSE for details
 """
 
+import json
+
+def _codec_headers(codec):
+    """ Return headers recording the codec of a workspace archive """
+    if codec is None:
+        return None
+    return { 'X-Workspace-Codec': codec }
+
+def _update_headers(headers, response):
+    """ Pass (lowercase) response headers to the caller """
+    if headers is not None:
+        headers.clear()
+        headers.update(response.getheaders())
+
 class Client(object):
     """ client class for workspace upload/download """
     def __init__(self, parent):
         self.parent = parent
 
-    def put(self, job_id, build_id, fileobj, fileobj_len):
-        """ update workspace """
+    def put(self, job_id, build_id, fileobj, fileobj_len, codec=None, headers=None):
+        """ update workspace, codec names the decoder the archive needs.
+            The stored version is in 'x-workspace-version' of headers, if
+            given. """
         try:
             response = self.parent.rest.do_build_request('PUT',
                                                          job_id,
                                                          build_id,
                                                          'workspace',
+                                                         extra_headers=_codec_headers(codec),
                                                          data=fileobj,
                                                          data_len=fileobj_len,
                                                          content_type="application/octet-stream")
@@ -28,10 +45,52 @@ class Client(object):
             self.parent.log.error('Updating workspace %s/%s failed with HTTP code %d', job_id, build_id, response.status)
             return False
 
+        _update_headers(headers, response)
         return True
 
-    def get(self, job_id, build_id, fileobj):
-        """ Get workspace """
+    def put_stream(self, job_id, build_id, producer, codec=None, headers=None):
+        """ update workspace, streaming the archive written by producer
+            into a file-like object it is called with """
+        try:
+            response = self.parent.rest.do_build_streaming_request('PUT',
+                                                                   job_id,
+                                                                   build_id,
+                                                                   'workspace',
+                                                                   producer,
+                                                                   extra_headers=_codec_headers(codec))
+        except:
+            self.parent.log.exception('Failed to stream workspace %s/%s', job_id, build_id)
+            return False
+
+        if response.status != 204:
+            self.parent.log.error('Streaming workspace %s/%s failed with HTTP code %d', job_id, build_id, response.status)
+            return False
+
+        _update_headers(headers, response)
+        return True
+
+    def get(self, job_id, build_id, fileobj, headers=None):
+        """ Get workspace, resuming interrupted downloads. The decoder the
+            archive needs is in 'x-workspace-codec' of headers, if given. """
+        try:
+            status = self.parent.rest.download_build_file(job_id,
+                                                          build_id,
+                                                          'workspace',
+                                                          fileobj,
+                                                          response_headers=headers)
+        except:
+            self.parent.log.exception('Failed to get workspace %s/%s', job_id, build_id)
+            return False
+
+        if status != 200:
+            self.parent.log.error('Getting workspace %s/%s failed with HTTP code %d', job_id, build_id, status)
+            return False
+
+        return True
+
+    def open_stream(self, job_id, build_id):
+        """ Open workspace archive for reading as it is downloaded, returns
+            a file-like response for the caller to close, or None """
         try:
             response = self.parent.rest.do_build_request('GET',
                                                          job_id,
@@ -39,19 +98,33 @@ class Client(object):
                                                          'workspace')
         except:
             self.parent.log.exception('Failed to get workspace %s/%s', job_id, build_id)
-            return False
+            return None
 
         if response.status != 200:
             self.parent.log.error('Getting workspace %s/%s failed with HTTP code %d', job_id, build_id, response.status)
-            return False
+            response.close()
+            return None
 
-        while True:
-            data = response.read(1024*64)
-            if data == '':
-                break
-            fileobj.write(data)
+        return response
 
-        return True
+    def version(self, job_id, build_id):
+        """ Get version of the stored workspace, None if there is none """
+        try:
+            response = self.parent.rest.do_build_request('HEAD',
+                                                         job_id,
+                                                         build_id,
+                                                         'workspace')
+        except:
+            self.parent.log.exception('Failed to get workspace version %s/%s', job_id, build_id)
+            return None
+
+        response.read()
+        if response.status != 200:
+            if response.status != 404:
+                self.parent.log.error('Getting workspace version %s/%s failed with HTTP code %d', job_id, build_id, response.status)
+            return None
+
+        return response.getheader('X-Workspace-Version')
 
     def delete(self, job_id, build_id):
         """ Delete workspace """
@@ -70,3 +143,89 @@ class Client(object):
 
         return True
 
+    def get_manifest(self, job_id, build_id):
+        """ Get workspace manifest, None if the workspace is not stored as one """
+        try:
+            response = self.parent.rest.do_build_request('GET',
+                                                         job_id,
+                                                         build_id,
+                                                         'workspace/manifest')
+        except:
+            self.parent.log.exception('Failed to get workspace manifest %s/%s', job_id, build_id)
+            return None
+
+        if response.status != 200:
+            if response.status != 404:
+                self.parent.log.error('Getting workspace manifest %s/%s failed with HTTP code %d', job_id, build_id, response.status)
+            return None
+
+        try:
+            return json.loads(response.read())
+        except (TypeError, ValueError):
+            self.parent.log.exception('Failed to decode workspace manifest %s/%s', job_id, build_id)
+            return None
+
+    def put_manifest(self, job_id, build_id, manifest, headers=None):
+        """ Store workspace as a manifest. Returns list of digests of file
+            contents that have to be uploaded with put_blob before trying
+            again, empty list when stored, None on failure. """
+        try:
+            response = self.parent.rest.do_build_request('PUT',
+                                                         job_id,
+                                                         build_id,
+                                                         'workspace/manifest',
+                                                         data=json.dumps(manifest))
+        except:
+            self.parent.log.exception('Failed to update workspace manifest %s/%s', job_id, build_id)
+            return None
+
+        if response.status == 204:
+            _update_headers(headers, response)
+            return []
+
+        if response.status != 409:
+            self.parent.log.error('Updating workspace manifest %s/%s failed with HTTP code %d', job_id, build_id, response.status)
+            return None
+
+        try:
+            return json.loads(response.read())['missing']
+        except (TypeError, ValueError, KeyError):
+            self.parent.log.exception('Failed to decode reply to workspace manifest update %s/%s', job_id, build_id)
+            return None
+
+    def put_blob(self, job_id, build_id, sha256, fileobj, fileobj_len):
+        """ Upload contents of a workspace file """
+        try:
+            response = self.parent.rest.do_build_request('PUT',
+                                                         job_id,
+                                                         build_id,
+                                                         'workspace/blobs/%s' % sha256,
+                                                         data=fileobj,
+                                                         data_len=fileobj_len,
+                                                         content_type="application/octet-stream")
+        except:
+            self.parent.log.exception('Failed to upload workspace file %s/%s/%s', job_id, build_id, sha256)
+            return False
+
+        if response.status != 204:
+            self.parent.log.error('Uploading workspace file %s/%s/%s failed with HTTP code %d', job_id, build_id, sha256, response.status)
+            return False
+
+        return True
+
+    def get_blob(self, job_id, build_id, sha256, fileobj):
+        """ Download contents of a workspace file """
+        try:
+            status = self.parent.rest.download_build_file(job_id,
+                                                          build_id,
+                                                          'workspace/blobs/%s' % sha256,
+                                                          fileobj)
+        except:
+            self.parent.log.exception('Failed to get workspace file %s/%s/%s', job_id, build_id, sha256)
+            return False
+
+        if status != 200:
+            self.parent.log.error('Getting workspace file %s/%s/%s failed with HTTP code %d', job_id, build_id, sha256, status)
+            return False
+
+        return True
@@ -9,11 +9,12 @@ import json
 from webob.dec import wsgify
 import logging
 
-from distci.frontend import dispatcher
+from distci.frontend import dispatcher, chunked, storage
 
 class Frontend(object):
     def __init__(self, config):
         self.config = config
+        storage.configure(config)
         self.dispatcher = dispatcher.Dispatcher(self.config)
         if config.get('log_level'):
             log_level = logging._levelNames.get(config.get('log_level').upper())
@@ -21,7 +22,9 @@ class Frontend(object):
 
     @wsgify
     def __call__(self, request):
-        return self.dispatcher.handle_request(request)
+        chunked.decode_request(request, self.config)
+        response = self.dispatcher.handle_request(request)
+        return storage.use_file_wrapper(request, response)
 
 def build_frontend_app(config_file):
     config = json.load(file(config_file))
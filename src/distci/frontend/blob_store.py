@@ -0,0 +1,186 @@
+"""
+Content-addressed blob store
+
+Artifact contents are stored once under blobs/<aa>/<sha256> in the data
+directory, and each build artifact is a hard link to its blob, so that
+artifact files can be read like before. The link count of a blob doubles
+as its reference count: a blob with only one link is no longer used by
+any artifact and can be removed. A <artifact_id>.meta file next to each
+artifact records the digest, so releasing references needs no hashing.
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+import os
+import json
+import uuid
+import hashlib
+import logging
+
+from distci.frontend import storage
+
+class HashingReader(object):
+    """ File object wrapper computing SHA-256 of everything read """
+    def __init__(self, ifh):
+        self.ifh = ifh
+        self.sha256 = hashlib.sha256()
+
+    def readinto(self, buf):
+        """ read into a writable buffer """
+        if hasattr(self.ifh, 'readinto'):
+            ret = self.ifh.readinto(buf)
+            if ret:
+                self.sha256.update(memoryview(buf)[:ret])
+            return ret
+        data = self.ifh.read(len(buf))
+        buf[:len(data)] = data
+        self.sha256.update(data)
+        return len(data)
+
+    def read(self, size=-1):
+        """ read data """
+        data = self.ifh.read(size)
+        self.sha256.update(data)
+        return data
+
+    def hexdigest(self):
+        """ return digest of data read so far """
+        return self.sha256.hexdigest()
+
+class BlobStore(object):
+    """ Deduplicated storage of artifact contents """
+    def __init__(self, config):
+        self.config = config
+        self.log = logging.getLogger('blob_store')
+
+    def _blob_dir(self):
+        """ Return top level directory of the blob store """
+        return os.path.join(self.config.get('data_directory'), 'blobs')
+
+    def _tmp_dir(self):
+        """ Return directory for uploads in progress """
+        return os.path.join(self._blob_dir(), 'tmp')
+
+    def _blob_file(self, sha256):
+        """ Return filename for a blob """
+        return os.path.join(self._blob_dir(), sha256[:2], sha256)
+
+    @classmethod
+    def _meta_file(cls, path):
+        """ Return filename of the metadata of a stored artifact """
+        return '%s.meta' % path
+
+    @classmethod
+    def _ensure_dir(cls, store, path):
+        """ Create directory and its parents if missing """
+        if not store.isdir(path):
+            try:
+                store.makedirs(path)
+            except storage.ObjectExists:
+                pass
+
+    def put(self, store, ifh, length, path, expected_sha256=None):
+        """ Store contents of 'ifh' as artifact file 'path', replacing an
+            existing one. Returns (sha256, size), sha256 is None if the
+            upload was truncated or did not match 'expected_sha256'. The
+            upload is written to a temporary file, which becomes the blob
+            unless the same content is stored already. """
+        self._ensure_dir(store, self._tmp_dir())
+        tmp_path = os.path.join(self._tmp_dir(), uuid.uuid4().hex)
+        reader = HashingReader(ifh)
+        try:
+            with store.open(tmp_path, 'wb') as ofh:
+                size = store.write_from(ofh, reader, length)
+            if length is not None and size != length:
+                self.log.error("Upload truncated, %d of %d bytes", size, length)
+                return None, size
+            sha256 = reader.hexdigest()
+            if expected_sha256 is not None and sha256 != expected_sha256:
+                self.log.error("Upload digest %s does not match %s", sha256, expected_sha256)
+                return None, size
+            self._ensure_dir(store, os.path.dirname(self._blob_file(sha256)))
+            try:
+                store.link(tmp_path, self._blob_file(sha256))
+            except storage.ObjectExists:
+                self.log.debug('Blob %s already stored', sha256)
+            try:
+                self._link(store, self._blob_file(sha256), sha256, size, path)
+            except storage.NotFound:
+                # blob was released in between, keep our own copy
+                self._link(store, tmp_path, sha256, size, path)
+        finally:
+            try:
+                store.unlink(tmp_path)
+            except storage.NotFound:
+                pass
+        return sha256, size
+
+    def link(self, store, sha256, size, path):
+        """ Store an already stored blob as artifact file 'path', replacing
+            an existing one. Returns False if no blob matches the digest
+            and size, in which case the content has to be uploaded. """
+        try:
+            if store.getsize(self._blob_file(sha256)) != size:
+                self.log.error('Size mismatch for blob %s', sha256)
+                return False
+            self._link(store, self._blob_file(sha256), sha256, size, path)
+        except storage.NotFound:
+            return False
+        return True
+
+    def _link(self, store, src, sha256, size, path):
+        """ Make 'path' a link to 'src', atomically replacing an existing
+            file, and release the blob 'path' referred to before """
+        previous = self.digest(store, path)
+        tmp_path = '%s.tmp-%s' % (path, uuid.uuid4().hex)
+        store.link(src, tmp_path)
+        try:
+            store.write_file(self._meta_file(path), json.dumps({'sha256': sha256, 'size': size}))
+            store.rename(tmp_path, path)
+        except:
+            store.unlink(tmp_path)
+            raise
+        if previous is not None and previous != sha256:
+            self.release(store, previous)
+
+    def digest(self, store, path):
+        """ Return digest of the blob a stored file refers to, None for
+            files stored before deduplication """
+        try:
+            with store.open(self._meta_file(path), 'rb') as fileo:
+                return json.load(fileo)['sha256']
+        except storage.NotFound:
+            return None
+        except (ValueError, KeyError, TypeError):
+            self.log.error('Unreadable metadata for %s', path)
+            return None
+
+    def unlink(self, store, path):
+        """ Remove a stored file and release its blob """
+        sha256 = self.digest(store, path)
+        store.unlink(path)
+        if sha256 is not None:
+            try:
+                store.unlink(self._meta_file(path))
+            except storage.NotFound:
+                pass
+            self.release(store, sha256)
+
+    def release(self, store, sha256):
+        """ Remove a blob if no stored file refers to it anymore. A blob
+            being linked concurrently is safe to remove, the new link keeps
+            the data and only deduplication against it is lost. """
+        try:
+            if store.getnlink(self._blob_file(sha256)) <= 1:
+                store.unlink(self._blob_file(sha256))
+                self.log.debug('Removed unreferenced blob %s', sha256)
+        except storage.NotFound:
+            pass
+        except:
+            self.log.exception('Failed to release blob %s', sha256)
+
+    def release_all(self, store, digests):
+        """ Release a set of blobs """
+        for sha256 in digests:
+            self.release(store, sha256)
@@ -0,0 +1,270 @@
+"""
+Per-job build index
+
+Keeps a sorted summary of the builds of a job in the job directory, so that
+listing builds or finding e.g. the last successful build does not need a
+directory scan or reading the state of each build.
+
+Updates are made under an index lock. A change that can not take the lock
+raises the invalidation generation stored next to the index instead. The
+index records the generation it was built at, and an index built at an
+older generation is rebuilt from the job directory by the next reader or
+updater, so changes are not lost even if the lock holder stores its copy
+afterwards. The generation is never lowered, which is why raising it needs
+no lock.
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+import os
+import json
+import time
+import bisect
+import logging
+
+from distci.frontend import metadata, sync
+
+INDEX_VERSION = 1
+
+SUMMARY_KEYS = ('status', 'result')
+
+def _is_complete(entry):
+    """ build has finished """
+    return entry.get('status') == 'complete'
+
+def _is_successful(entry):
+    """ build has finished successfully """
+    return _is_complete(entry) and entry.get('result') == 'success'
+
+def _is_failed(entry):
+    """ build has finished unsuccessfully """
+    return _is_complete(entry) and entry.get('result') != 'success'
+
+BUILD_ALIASES = {
+    'lastBuild': lambda entry: True,
+    'lastCompleted': _is_complete,
+    'lastSuccessful': _is_successful,
+    'lastFailed': _is_failed
+}
+
+class BuildIndex(object):
+    """ Sorted build index of a single job """
+    def __init__(self, config, job_id):
+        self.config = config
+        self.job_id = job_id
+        self.log = logging.getLogger('build_index')
+        self.zknodes = config.get('zookeeper_nodes')
+        self.metadata = metadata.get_metadata(config)
+
+    def _job_dir(self):
+        """ Return directory for the job """
+        return os.path.join(self.config.get('data_directory'), 'jobs', self.job_id)
+
+    def _index_file(self):
+        """ Return filename for the build index """
+        return os.path.join(self._job_dir(), 'builds.index')
+
+    def _generation_file(self):
+        """ Return filename for the invalidation generation """
+        return os.path.join(self._job_dir(), 'builds.index.generation')
+
+    def _generation(self, store):
+        """ Return current invalidation generation """
+        return _parse_int(self.metadata.get(store, self._generation_file()))
+
+    def _lock(self):
+        """ Take the index lock, or return None if it stays busy """
+        return sync.acquire_lock(self.zknodes, 'build-index-lock-%s' % self.job_id)
+
+    def _scan(self, store):
+        """ Build index entries from the job directory and build states """
+        entries = []
+        for entry in store.scandir(self._job_dir()):
+            try:
+                build_number = int(entry.name)
+            except ValueError:
+                continue
+            if entry.is_dir:
+                index_entry = {'build_number': build_number}
+                try:
+                    index_entry.update(summarize(json.loads(self.metadata.get(store, os.path.join(self._job_dir(), entry.name, 'build.state')))))
+                except (TypeError, ValueError):
+                    pass
+                entries.append(index_entry)
+        entries.sort(key=lambda entry: entry['build_number'])
+        return entries
+
+    def _read(self, store, generation):
+        """ Read stored index, None if missing, unreadable, outdated or
+            built before the given generation """
+        return self._parse(self.metadata.get(store, self._index_file()), generation)
+
+    @classmethod
+    def _parse(cls, data, generation):
+        """ Return entries of a serialized index, None if missing,
+            unreadable, outdated or built at another generation """
+        try:
+            index = json.loads(data)
+            if index.get('version') != INDEX_VERSION or index.get('generation', 0) != generation:
+                return None
+            return index['builds']
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    @classmethod
+    def _serialize(cls, entries, generation):
+        """ Return index as stored """
+        return json.dumps({'version': INDEX_VERSION, 'generation': generation, 'builds': entries})
+
+    def _write(self, store, entries, generation):
+        """ Store index """
+        self.metadata.put(store, self._index_file(), self._serialize(entries, generation))
+
+    def load(self, store):
+        """ Return index entries sorted by build number. A missing or stale
+            index is rebuilt from the job directory and stored for later
+            reads. """
+        # read the generation first, the scan then sees every change
+        # made before it was raised
+        generation = self._generation(store)
+        entries = self._read(store, generation)
+        if entries is not None:
+            return entries
+        self.log.info('Rebuilding build index for %s', self.job_id)
+        entries = self._scan(store)
+        lock = self._lock()
+        if lock is not None:
+            try:
+                if self._read(store, generation) is None:
+                    self._write(store, entries, generation)
+            except:
+                self.log.exception('Failed to store build index for %s', self.job_id)
+            lock.unlock()
+            lock.close()
+        return entries
+
+    def update(self, store, func):
+        """ Apply func to index entries under the index lock and store the
+            result. If the lock cannot be taken the index is invalidated
+            instead, to be rebuilt by the next reader or updater. Changes
+            must be stored in the job directory before updating the index. """
+        lock = self._lock()
+        if lock is None:
+            self.log.error('Build index for %s locked, invalidating', self.job_id)
+            self.invalidate(store)
+            return False
+        def _apply(data):
+            generation = self._generation(store)
+            entries = self._parse(data, generation)
+            if entries is None:
+                entries = self._scan(store)
+            func(entries)
+            return self._serialize(entries, generation)
+        try:
+            self.metadata.update(store, self._index_file(), _apply)
+        except:
+            self.log.exception('Failed to update build index for %s', self.job_id)
+            lock.unlock()
+            lock.close()
+            self.invalidate(store)
+            return False
+        lock.unlock()
+        lock.close()
+        return True
+
+    def invalidate(self, store):
+        """ Mark stored index stale by raising the invalidation generation.
+            Needs no lock, as a lock holder storing its copy afterwards
+            stores it at the generation it read before. """
+        try:
+            self.metadata.update(store, self._generation_file(), lambda data: str(_parse_int(data) + 1))
+        except:
+            self.log.exception('Failed to invalidate build index for %s', self.job_id)
+
+    def add(self, store, build_number, build_state):
+        """ Add a new build """
+        def _add(entries):
+            pos, found = _position(entries, build_number)
+            if not found:
+                entry = {'build_number': build_number, 'created': int(time.time())}
+                entry.update(summarize(build_state))
+                entries.insert(pos, entry)
+        return self.update(store, _add)
+
+    def set_state(self, store, build_number, build_state):
+        """ Record status and result of a build, if they have changed """
+        summary = summarize(build_state)
+        entry = find(self.load(store), build_number)
+        if entry is not None and all(entry.get(key) == summary.get(key) for key in SUMMARY_KEYS):
+            return True
+        def _set_state(entries):
+            pos, found = _position(entries, build_number)
+            if not found:
+                entries.insert(pos, {'build_number': build_number})
+            for key in SUMMARY_KEYS:
+                entries[pos].pop(key, None)
+            entries[pos].update(summary)
+            entries[pos]['updated'] = int(time.time())
+        return self.update(store, _set_state)
+
+    def remove(self, store, build_number):
+        """ Remove a build """
+        def _remove(entries):
+            pos, found = _position(entries, build_number)
+            if found:
+                del entries[pos]
+        return self.update(store, _remove)
+
+    def resolve(self, store, alias):
+        """ Return build number for a build alias, None if no build matches """
+        match = BUILD_ALIASES[alias]
+        for entry in reversed(self.load(store)):
+            if match(entry):
+                return entry['build_number']
+        return None
+
+def _parse_int(data):
+    """ Return integer stored in a document, 0 if unset or unreadable """
+    try:
+        return int(data)
+    except (TypeError, ValueError):
+        return 0
+
+def summarize(build_state):
+    """ Return the indexed fields of a build state """
+    return dict((key, build_state[key]) for key in SUMMARY_KEYS if key in build_state)
+
+def _position(entries, build_number):
+    """ Return insertion position of a build and whether it is indexed """
+    numbers = [ entry['build_number'] for entry in entries ]
+    pos = bisect.bisect_left(numbers, build_number)
+    return pos, pos < len(numbers) and numbers[pos] == build_number
+
+def find(entries, build_number):
+    """ Return index entry for a build, None if not indexed """
+    pos, found = _position(entries, build_number)
+    if found:
+        return entries[pos]
+    return None
+
+def select(entries, limit=None, before=None, after=None, order='asc'):
+    """ Return a page of index entries. 'before' and 'after' are exclusive
+        build number bounds, 'order' is 'asc' or 'desc' and decides which
+        end of the range 'limit' keeps. """
+    numbers = [ entry['build_number'] for entry in entries ]
+    start = 0
+    end = len(entries)
+    if after is not None:
+        start = bisect.bisect_right(numbers, after)
+    if before is not None:
+        end = bisect.bisect_left(numbers, before)
+    if end <= start:
+        return []
+    if order == 'desc':
+        if limit is not None:
+            start = max(start, end - limit)
+        return entries[start:end][::-1]
+    if limit is not None:
+        end = min(end, start + limit)
+    return entries[start:end]
@@ -0,0 +1,78 @@
+"""
+Chunked transfer encoding of request bodies
+
+Servers such as gunicorn decode chunked request bodies themselves, some
+of them without marking the input terminated. The wsgiref server passes the
+encoded stream on, so it is decoded here, letting handlers read uploads of
+unknown length until EOF in both cases. As decoding a body twice corrupts
+it, bodies are only decoded for servers known to pass them on encoded,
+unless the decode_chunked_requests setting says otherwise.
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+class ChunkedReader(object):
+    """ File object decoding a chunked request body """
+    def __init__(self, rfile):
+        self.rfile = rfile
+        self.remaining = 0
+        self.eof = False
+
+    def _next_chunk(self):
+        """ read the next chunk header, return False at the last chunk """
+        line = self.rfile.readline()
+        try:
+            self.remaining = int(line.split(';', 1)[0].strip(), 16)
+        except ValueError:
+            raise IOError('Invalid chunk header %r' % line)
+        if self.remaining > 0:
+            return True
+        # skip trailers up to the terminating empty line
+        while line not in ('\r\n', '\n', ''):
+            line = self.rfile.readline()
+        self.eof = True
+        return False
+
+    def read(self, size=-1):
+        """ read up to size bytes, or until EOF if size is negative """
+        data = []
+        while not self.eof and (size < 0 or size > 0):
+            if self.remaining == 0 and not self._next_chunk():
+                break
+            read_len = self.remaining
+            if size >= 0:
+                read_len = min(read_len, size)
+            chunk = self.rfile.read(read_len)
+            if not chunk:
+                raise IOError('Truncated chunked request body')
+            data.append(chunk)
+            self.remaining -= len(chunk)
+            if size >= 0:
+                size -= len(chunk)
+            if self.remaining == 0:
+                # CRLF after chunk data
+                self.rfile.readline()
+        return ''.join(data)
+
+# SERVER_SOFTWARE prefixes of servers passing chunked bodies on encoded
+RAW_CHUNKED_SERVERS = ('WSGIServer/',)
+
+def _server_passes_chunked(request):
+    """ Tell whether the server passed a chunked body on encoded """
+    if request.environ.get('wsgi.input_terminated'):
+        return False
+    return request.environ.get('SERVER_SOFTWARE', '').startswith(RAW_CHUNKED_SERVERS)
+
+def decode_request(request, config):
+    """ Decode a chunked request body, unless the server did it already.
+        decode_chunked_requests 'auto' decides by the server, true or false
+        overrides it. """
+    if request.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+        return
+    setting = config.get('decode_chunked_requests', 'auto')
+    if setting == 'auto':
+        setting = _server_passes_chunked(request)
+    if setting:
+        request.body_file_raw = ChunkedReader(request.environ['wsgi.input'])
+        request.environ['wsgi.input_terminated'] = True
@@ -0,0 +1,302 @@
+"""
+Segmented console log storage
+
+Console output is appended to console.log in the build directory. When it
+grows past the segment size, the content is compressed into a gzip segment
+console.<n>.gz and recorded in console.index together with its offset in
+the uncompressed log. Ranges can then be served by decompressing only the
+segments they touch, and gzip capable clients get the segments as they are.
+
+Appends take no lock. Rotation, under the console log lock, renames
+console.log aside before compressing it, so output appended meanwhile goes
+to a new console.log instead of being lost.
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+import os
+import json
+import logging
+
+from distci.frontend import sync, storage
+from distci.worker import compression
+
+INDEX_VERSION = 1
+SEGMENT_SIZE = 1024*1024
+COMPRESS_LEVEL = 6
+SNAPSHOT_ATTEMPTS = 3
+
+class LogIter(object):
+    """ WSGI app_iter over console log parts. Each part is a tuple of
+        (kind, source, skip, take): 'segment' parts are decompressed,
+        'file' parts are read as is and 'data' parts are strings. Files
+        are closed when the server closes the iterator. """
+    def __init__(self, parts, chunk_size=storage.READ_CHUNK_SIZE):
+        self.parts = parts
+        self.chunk_size = chunk_size
+        self.chunks = self._chunks()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """ return the next chunk """
+        return next(self.chunks)
+
+    __next__ = next
+
+    def _chunks(self):
+        """ generate chunks of all parts in order """
+        for kind, source, skip, take in self.parts:
+            if kind == 'data':
+                yield source[skip:skip + take]
+            elif kind == 'segment':
+                yield compression.gzip_decompress(source.read())[skip:skip + take]
+                source.close()
+            else:
+                if skip > 0:
+                    source.seek(skip)
+                for chunk in storage.FileIter(source, self.chunk_size, take):
+                    yield chunk
+                source.close()
+
+    def close(self):
+        """ close all files """
+        for kind, source, _, _ in self.parts:
+            if kind != 'data':
+                source.close()
+
+class ConsoleLog(object):
+    """ Console log of a single build """
+    def __init__(self, config, job_id, build_id):
+        self.config = config
+        self.job_id = job_id
+        self.build_id = build_id
+        self.log = logging.getLogger('console_log')
+        self.zknodes = config.get('zookeeper_nodes')
+        self.segment_size = config.get('console_segment_size', SEGMENT_SIZE)
+
+    def _build_dir(self):
+        """ Return directory for the build """
+        return os.path.join(self.config.get('data_directory'), 'jobs', self.job_id, self.build_id)
+
+    def _log_file(self):
+        """ Return filename for the uncompressed end of the log """
+        return os.path.join(self._build_dir(), 'console.log')
+
+    def _index_file(self):
+        """ Return filename for the segment index """
+        return os.path.join(self._build_dir(), 'console.index')
+
+    def _segment_file(self, segment_number):
+        """ Return filename for a compressed segment """
+        return os.path.join(self._build_dir(), 'console.%d.gz' % segment_number)
+
+    def _lock(self):
+        """ Take the console log lock, or return None if it is busy """
+        return sync.acquire_lock(self.zknodes, 'console-lock-%s-%s' % (self.job_id, self.build_id), attempts=1)
+
+    def _rotated_file(self, segment_number):
+        """ Return filename console.log is moved to for compressing it into
+            a segment """
+        return os.path.join(self._build_dir(), 'console.%d.log' % segment_number)
+
+    def _read_index(self, store):
+        """ Return the index, with list of 'segments', each with uncompressed
+            'offset' and 'length' and compressed 'size', and 'rotated', the
+            length read from the file of the last segment """
+        empty = {'version': INDEX_VERSION, 'segments': [], 'rotated': 0}
+        try:
+            with store.open(self._index_file(), 'rb') as fileo:
+                index = json.load(fileo)
+        except storage.NotFound:
+            return empty
+        except ValueError:
+            self.log.error('Unreadable console index for %s/%s', self.job_id, self.build_id)
+            return empty
+        if index.get('version') != INDEX_VERSION:
+            self.log.error('Unsupported console index version for %s/%s', self.job_id, self.build_id)
+            return empty
+        return index
+
+    def _read_segments(self, store):
+        """ Return list of segments """
+        return self._read_index(store)['segments']
+
+    def append(self, store, data):
+        """ Append data to the log, compressing a new segment when the
+            uncompressed end of the log grows past the segment size. Appends
+            take no lock, only rotation does. """
+        with store.open(self._log_file(), 'ab') as fileo:
+            fileo.write(data)
+        try:
+            if store.getsize(self._log_file()) < self.segment_size:
+                return
+        except storage.NotFound:
+            # rotated meanwhile
+            return
+        lock = self._lock()
+        if lock is None:
+            # another append is rotating the log
+            return
+        try:
+            if store.getsize(self._log_file()) >= self.segment_size:
+                self._rotate(store)
+        except storage.NotFound:
+            pass
+        finally:
+            lock.unlock()
+            lock.close()
+
+    def _rotate(self, store):
+        """ Move the uncompressed end of the log into a new segment, holding
+            the console log lock.
+
+            console.log is first renamed to console.<n>.log, so appends that
+            open the log afterwards start a new console.log. An append that
+            opened the log before the rename may still write to the renamed
+            file after it has been read, so it is kept until the next
+            rotation, which appends any bytes past the length read to the
+            end of the log before removing it. Offsets already served never
+            move. A rotation interrupted after the rename is completed by
+            the next one. """
+        index = self._read_index(store)
+        segments = index['segments']
+        segment_number = len(segments)
+        if segment_number > 0:
+            try:
+                with store.open(self._rotated_file(segment_number - 1), 'rb') as fileo:
+                    late = fileo.read()[index.get('rotated', 0):]
+            except storage.NotFound:
+                late = ''
+            if late:
+                with store.open(self._log_file(), 'ab') as fileo:
+                    fileo.write(late)
+        if not store.exists(self._rotated_file(segment_number)):
+            store.rename(self._log_file(), self._rotated_file(segment_number))
+        with store.open(self._rotated_file(segment_number), 'rb') as fileo:
+            data = fileo.read()
+        if segments:
+            offset = segments[-1]['offset'] + segments[-1]['length']
+        else:
+            offset = 0
+        compressed = compression.gzip_compress(data, self.config.get('console_compress_level', COMPRESS_LEVEL))
+        store.write_file(self._segment_file(segment_number), compressed)
+        segments.append({'offset': offset, 'length': len(data), 'size': len(compressed)})
+        store.write_file(self._index_file(), json.dumps({'version': INDEX_VERSION, 'segments': segments, 'rotated': len(data)}))
+        if segment_number > 0:
+            try:
+                store.unlink(self._rotated_file(segment_number - 1))
+            except storage.NotFound:
+                pass
+
+    def _open_tail(self, store, path):
+        """ Return (open file, size) of an uncompressed part of the log,
+            None if there is no such file """
+        try:
+            fileo = store.open(path, 'rb')
+        except storage.NotFound:
+            return None
+        try:
+            return fileo, store.getsize(path)
+        except storage.NotFound:
+            fileo.close()
+            return None
+
+    def _snapshot(self, store):
+        """ Return (segments, tails) as one consistent view, retrying if a
+            rotation happens in between. Tails are (open file, size) of the
+            uncompressed end of the log: console.log and, while a rotation
+            is compressing it, the renamed file before it. """
+        attempt = 0
+        while True:
+            attempt += 1
+            segments = self._read_segments(store)
+            rotating = self._rotated_file(len(segments))
+            tails = [ tail for tail in (self._open_tail(store, rotating),
+                                        self._open_tail(store, self._log_file())) if tail is not None ]
+            if attempt >= SNAPSHOT_ATTEMPTS or (self._read_segments(store) == segments and
+                                                (len(tails) == 2 or not store.exists(rotating))):
+                return segments, tails
+            for fileo, _ in tails:
+                fileo.close()
+
+    @classmethod
+    def _length(cls, segments, tails):
+        """ Return total uncompressed log length """
+        tail_len = sum(size for _, size in tails)
+        if segments:
+            return segments[-1]['offset'] + segments[-1]['length'] + tail_len
+        return tail_len
+
+    def size(self, store):
+        """ Return uncompressed length of the log """
+        segments, tails = self._snapshot(store)
+        for fileo, _ in tails:
+            fileo.close()
+        return self._length(segments, tails)
+
+    def read(self, store, offset=None, length=None, tail=None):
+        """ Return (app_iter, read length, log length) for the part of the
+            log selected by 'offset' and 'length' or by 'tail' """
+        segments, tails = self._snapshot(store)
+        log_len = self._length(segments, tails)
+        if tail is not None:
+            offset = max(log_len - tail, 0)
+        start = min(offset or 0, log_len)
+        end = log_len
+        if length is not None:
+            end = min(end, start + length)
+
+        parts = []
+        try:
+            for segment_number, segment in enumerate(segments):
+                seg_start = segment['offset']
+                seg_end = seg_start + segment['length']
+                if seg_end <= start or seg_start >= end:
+                    continue
+                skip = max(start - seg_start, 0)
+                take = min(end, seg_end) - seg_start - skip
+                parts.append(('segment', store.open(self._segment_file(segment_number), 'rb'), skip, take))
+            tail_start = log_len - sum(size for _, size in tails)
+            while tails:
+                fileo, size = tails.pop(0)
+                if end > tail_start and tail_start + size > start:
+                    skip = max(start - tail_start, 0)
+                    parts.append(('file', fileo, skip, min(end, tail_start + size) - tail_start - skip))
+                else:
+                    fileo.close()
+                tail_start += size
+        except:
+            for _, source, _, _ in parts:
+                source.close()
+            for fileo, _ in tails:
+                fileo.close()
+            raise
+        return LogIter(parts), end - start, log_len
+
+    def read_gzip(self, store):
+        """ Return (app_iter, compressed length, log length) for the whole
+            log as concatenated gzip members, the stored segments as they
+            are followed by the compressed uncompressed end """
+        segments, tails = self._snapshot(store)
+        log_len = self._length(segments, tails)
+        parts = []
+        content_len = 0
+        try:
+            for segment_number, segment in enumerate(segments):
+                parts.append(('file', store.open(self._segment_file(segment_number), 'rb'), 0, segment['size']))
+                content_len += segment['size']
+            while tails:
+                fileo, size = tails.pop(0)
+                with fileo:
+                    compressed = compression.gzip_compress(fileo.read(size), self.config.get('console_compress_level', COMPRESS_LEVEL))
+                parts.append(('data', compressed, 0, len(compressed)))
+                content_len += len(compressed)
+        except:
+            LogIter(parts).close()
+            for fileo, _ in tails:
+                fileo.close()
+            raise
+        return LogIter(parts), content_len, log_len
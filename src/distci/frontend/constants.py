@@ -12,6 +12,7 @@ ERROR_TASK_WRONG_ACTOR         = 'Task ownership mismatch'
 
 ERROR_BUILD_INVALID_ID         = 'Invalid job ID'
 ERROR_BUILD_INVALID_PAYLOAD    = 'Decoding build data failed'
+ERROR_BUILD_INVALID_QUERY      = 'Invalid build query parameters'
 ERROR_BUILD_NOT_FOUND          = 'Build not found'
 ERROR_BUILD_LOCKED             = 'Build locked'
 ERROR_BUILD_CREATE_FAILED      = 'Failed to allocate a new build'
@@ -23,6 +24,17 @@ ERROR_ARTIFACT_INVALID_ID      = 'Invalid artifact ID'
 ERROR_ARTIFACT_NOT_FOUND       = 'Artifact not found'
 ERROR_ARTIFACT_READ_FAILED     = 'Read error'
 ERROR_ARTIFACT_WRITE_FAILED    = 'Write error'
+ERROR_ARTIFACT_INVALID_DIGEST  = 'Invalid artifact digest or size'
+ERROR_ARTIFACT_DIGEST_MISMATCH = 'Artifact content does not match digest'
+ERROR_ARTIFACT_BLOB_NOT_FOUND  = 'Artifact content not stored'
+
+ERROR_WORKSPACE_INVALID_MANIFEST = 'Invalid workspace manifest'
+ERROR_WORKSPACE_MANIFEST_NOT_FOUND = 'Workspace manifest not found'
+ERROR_WORKSPACE_BLOB_NOT_FOUND = 'Workspace file content not found'
+ERROR_WORKSPACE_INVALID_CODEC  = 'Unknown workspace codec'
+
+ERROR_TRASH_INVALID_ID         = 'Invalid trash entry ID'
+ERROR_TRASH_NOT_FOUND          = 'Trash entry not found'
 
 ERROR_INTERNAL                 = 'Internal Error'
 
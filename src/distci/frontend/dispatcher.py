@@ -5,7 +5,7 @@ Copyright (c) 2012-2013 Heikki Nousiainen, F-Secure
 See LICENSE for details
 """
 
-from distci.frontend import jobs, tasks, ui
+from distci.frontend import jobs, tasks, trash, ui
 import logging
 import webob
 
@@ -16,6 +16,7 @@ class Dispatcher(object):
         self.tasks = tasks.Tasks(config)
         self.jobs = jobs.Jobs(config)
         self.ui = ui.Ui(config)
+        self.trash = trash.Trash(config)
 
     def handle_request(self, request):
         """ Parse top level request for dispatching """
@@ -33,6 +34,8 @@ class Dispatcher(object):
             return self.jobs.handle_request(request, parts[1:])
         elif parts[0] == 'tasks':
             return self.tasks.handle_request(request, parts[1:])
+        elif parts[0] == 'trash':
+            return self.trash.handle_request(request, parts[1:])
         elif parts[0] == 'ui':
             return self.ui.handle_request(request, parts[1:])
         elif parts[0] == '':
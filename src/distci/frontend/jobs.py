@@ -8,10 +8,9 @@ See LICENSE for details
 import os
 import json
 import logging
-import time
 import webob
 
-from distci.frontend import validators, jobs_builds, jobs_tags, sync, constants, storage
+from distci.frontend import validators, jobs_builds, jobs_tags, metadata, trash, sync, constants, storage
 
 class Jobs(object):
     """ Class for handling job related requests """
@@ -19,9 +18,9 @@ class Jobs(object):
         self.config = config
         self.log = logging.getLogger('jobs')
         self.zknodes = config.get('zookeeper_nodes')
-        self.cephmonitors = config.get('ceph_monitors')
         self.jobs_builds = jobs_builds.JobsBuilds(config)
         self.jobs_tags = jobs_tags.JobsTags(config)
+        self.metadata = metadata.get_metadata(config)
 
     def _data_dir(self):
         """ Return jobs directory """
@@ -38,16 +37,11 @@ class Jobs(object):
     def get_jobs(self):
         """ Return all job ids """
         results = { 'jobs': [] }
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
+        storage_backend = storage.get_storage(self.config)
         with storage_backend as store:
-            job_ids = store.listdir(self._data_dir())
-            for job_id in job_ids:
-                if not store.isdir(self._job_dir(job_id)):
-                    continue
-                results['jobs'].append(job_id)
+            for entry in store.scandir(self._data_dir()):
+                if entry.is_dir:
+                    results['jobs'].append(entry.name)
         return webob.Response(status=200, body=json.dumps(results), content_type="application/json")
 
     def create_or_update_job(self, request, job_id_param):
@@ -73,10 +67,7 @@ class Jobs(object):
             self.log.warn("Job locked '%s'" % job_id)
             return webob.Response(status=400, body=constants.ERROR_JOB_LOCKED)
 
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
+        storage_backend = storage.get_storage(self.config)
         with storage_backend as store:
             if not store.isdir(self._job_dir(job_id)):
                 try:
@@ -87,8 +78,7 @@ class Jobs(object):
                     lock.close()
                     return webob.Response(status=500, body=constants.ERROR_JOB_CONFIG_WRITE_FAILED)
             try:
-                with store.open(self._job_config_file(job_id), 'wb') as fileo:
-                    json.dump(job_config, fileo)
+                self.metadata.put(store, self._job_config_file(job_id), json.dumps(job_config))
             except:
                 self.log.exception('Failed to write job config, job_id %s' % job_id)
                 lock.unlock()
@@ -101,48 +91,50 @@ class Jobs(object):
         return webob.Response(status=200 if job_id_param else 201, body=json.dumps({'job_id':job_id, 'config':job_config}), content_type="application/json")
 
     def delete_job(self, job_id):
-        """ Delete job """
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
+        """ Delete job. The job is moved to the trash and its data removed
+            in the background. """
+        storage_backend = storage.get_storage(self.config)
         with storage_backend as store:
-            if not store.isdir(self._job_dir(job_id)):
-                return webob.Response(status=404, body=constants.ERROR_JOB_NOT_FOUND)
             try:
-                store.rmtree(self._job_dir(job_id))
+                trash_id = trash.move_to_trash(self.config, store, self._job_dir(job_id), {'job_id': job_id})
             except storage.NotFound:
                 return webob.Response(status=404, body=constants.ERROR_JOB_NOT_FOUND)
             except:
                 self.log.exception("Exception in delete job")
                 return webob.Response(status=500, body=constants.ERROR_INTERNAL)
+            self.metadata.remove_tree(store, self._job_dir(job_id))
 
-        return webob.Response(status=204)
+        return webob.Response(status=202, body=json.dumps({'job_id': job_id, 'trash_id': trash_id}), content_type="application/json")
 
     def get_job_config(self, job_id):
         """ Get config for a specific job """
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
-        with storage_backend as store:
-            if not store.isdir(self._job_dir(job_id)):
-                return webob.Response(status=404, body=constants.ERROR_JOB_NOT_FOUND)
-            job_data = None
-            for _ in range(10):
-                try:
-                    with store.open(self._job_config_file(job_id), 'rb') as fileo:
-                        job_data = json.dumps({'job_id': job_id, 'config': json.load(fileo)})
-                    break
-                except (storage.NotFound, ValueError):
-                    time.sleep(0.1)
-                except:
-                    self.log.exception("Exception while getting job config")
-                    return webob.Response(status=500, body=constants.ERROR_INTERNAL)
-        if not job_data:
-            return webob.Response(status=409, body=constants.ERROR_JOB_LOCKED)
+        job_config = self._load_job_config(job_id)
+        if isinstance(job_config, webob.Response):
+            return job_config
+        job_data = json.dumps({'job_id': job_id, 'config': job_config})
         return webob.Response(status=200, body=job_data, content_type="application/json")
 
+    def _load_job_config(self, job_id):
+        """ Return config of a job, or an error response """
+        storage_backend = storage.get_storage(self.config)
+        with storage_backend as store:
+            job_config = None
+            try:
+                data = self.metadata.get(store, self._job_config_file(job_id))
+                if data is not None:
+                    job_config = json.loads(data)
+            except ValueError:
+                pass
+            except:
+                self.log.exception("Exception while getting job config")
+                return webob.Response(status=500, body=constants.ERROR_INTERNAL)
+            if job_config is None:
+                if not store.isdir(self._job_dir(job_id)):
+                    return webob.Response(status=404, body=constants.ERROR_JOB_NOT_FOUND)
+                # job directory exists but config is not written yet
+                return webob.Response(status=409, body=constants.ERROR_JOB_LOCKED)
+        return job_config
+
     def github_webhook_trigger(self, request, job_id):
         """ Trigger builds via github webhook """
         try:
@@ -151,26 +143,9 @@ class Jobs(object):
         except (AttributeError, ValueError, KeyError):
             return webob.Response(status=400)
 
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
-        with storage_backend as store:
-            if not store.isdir(self._job_dir(job_id)):
-                return webob.Response(status=404, body=constants.ERROR_JOB_NOT_FOUND)
-            job_config = None
-            for _ in range(10):
-                try:
-                    with store.open(self._job_config_file(job_id), 'rb') as fileo:
-                        job_config = json.load(fileo)
-                    break
-                except (storage.NotFound, ValueError):
-                    time.sleep(0.1)
-                except:
-                    self.log.exception("Exception while getting job config")
-                    return webob.Response(status=500, body=constants.ERROR_INTERNAL)
-        if not job_config:
-            return webob.Response(status=409, body=constants.ERROR_JOB_LOCKED)
+        job_config = self._load_job_config(job_id)
+        if isinstance(job_config, webob.Response):
+            return job_config
         for task in job_config.get('tasks', []):
             if task.get('type') == 'git-checkout':
                 if task.get('params', {}).get('ref') == ref:
@@ -9,21 +9,35 @@ import os
 import json
 import logging
 import time
+import uuid
 import webob
 
-from distci.frontend import validators, jobs_builds_artifacts, sync, constants, storage
+from distci.frontend import validators, jobs_builds_artifacts, build_index, console_log, workspace_manifest, metadata, trash, sync, constants, storage
 
 from distci import distcilib
 
+BUILD_ALLOCATION_ATTEMPTS = 100
+# follow requests hold a worker, keep them well below gunicorn's 30s timeout
+CONSOLE_FOLLOW_MAX_WAIT = 5
+CONSOLE_FOLLOW_POLL_INTERVAL = 0.5
+
+# decoders a workspace archive may need, archives stored without one are gzip
+WORKSPACE_CODECS = ('none', 'gzip')
+DEFAULT_WORKSPACE_CODEC = 'gzip'
+GZIP_MAGIC = '\x1f\x8b'
+
+# wakes up console followers when this process appends to a log or updates build state
+CONSOLE_EVENTS = sync.EventNotifier()
+
 class JobsBuilds(object):
     """ Class for handling build related requests """
     def __init__(self, config):
         self.config = config
         self.log = logging.getLogger('jobs_builds')
         self.zknodes = config.get('zookeeper_nodes')
-        self.cephmonitors = config.get('ceph_monitors')
         self.jobs_builds_artifacts = jobs_builds_artifacts.JobsBuildsArtifacts(config)
         self.distci_client = distcilib.DistCIClient(config)
+        self.metadata = metadata.get_metadata(config)
 
     def _job_dir(self, job_id):
         """ Return directory for a specific job """
@@ -41,9 +55,53 @@ class JobsBuilds(object):
         """ Return filename for workspace archive """
         return os.path.join(self._build_dir(job_id, build_id), 'workspace')
 
-    def _console_log_file(self, job_id, build_id):
-        """ Return filename for a build console log """
-        return os.path.join(self._build_dir(job_id, build_id), 'console.log')
+    def _build_workspace_codec_file(self, job_id, build_id):
+        """ Return filename for the codec of the workspace archive """
+        return os.path.join(self._build_dir(job_id, build_id), 'workspace.codec')
+
+    def _read_workspace_codec(self, store, job_id, build_id, etag):
+        """ Return codec of the workspace archive with the given entity tag.
+            The codec is recorded with the entity tag of its archive, and
+            is detected from the archive while they do not match, as the
+            archive is renamed in place before its codec is recorded. """
+        try:
+            with store.open(self._build_workspace_codec_file(job_id, build_id), 'rb') as fileo:
+                fields = fileo.read().split()
+        except storage.NotFound:
+            return DEFAULT_WORKSPACE_CODEC
+        if len(fields) > 1 and fields[1] != etag:
+            return self._detect_workspace_codec(store, job_id, build_id)
+        codec = fields[0] if fields else ''
+        if codec not in WORKSPACE_CODECS:
+            self.log.error("Unknown workspace codec '%s' for %s/%s", codec, job_id, build_id)
+            return DEFAULT_WORKSPACE_CODEC
+        return codec
+
+    def _detect_workspace_codec(self, store, job_id, build_id):
+        """ Return codec of the workspace archive from its gzip magic """
+        try:
+            with store.open(self._build_workspace_file(job_id, build_id), 'rb') as fileo:
+                magic = fileo.read(2)
+        except storage.NotFound:
+            return DEFAULT_WORKSPACE_CODEC
+        if magic == GZIP_MAGIC:
+            return 'gzip'
+        return 'none'
+
+    def _workspace_version(self, store, job_id, build_id):
+        """ Return version of the stored workspace, the entity tag of its
+            manifest or archive, None if there is no workspace """
+        manifest = workspace_manifest.WorkspaceManifest(self.config, job_id, build_id)
+        for path in (manifest.manifest_file(), self._build_workspace_file(job_id, build_id)):
+            try:
+                return str(store.getinfo(path).etag)
+            except storage.NotFound:
+                continue
+        return None
+
+    def _build_counter_file(self, job_id):
+        """ Return filename for the last allocated build number """
+        return os.path.join(self._job_dir(job_id), 'build.counter')
 
     def _get_build_numbers(self, store, job_id):
         """ Return all builds for given job """
@@ -57,65 +115,120 @@ class JobsBuilds(object):
                 pass
         return build_ids
 
-    def get_builds(self, job_id):
-        """ Return all builds for a specific job """
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
+    def get_builds(self, request, job_id):
+        """ Return builds for a specific job, optionally a page of them """
+        try:
+            limit = self._int_param(request, 'limit')
+            before = self._int_param(request, 'before')
+            after = self._int_param(request, 'after')
+        except ValueError:
+            return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_QUERY)
+        order = request.GET.get('order', 'asc')
+        if order not in ('asc', 'desc') or (limit is not None and limit < 0):
+            return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_QUERY)
+
+        storage_backend = storage.get_storage(self.config)
         with storage_backend as store:
             if not store.isdir(self._job_dir(job_id)):
                 return webob.Response(status=404, body=constants.ERROR_BUILD_NOT_FOUND)
-            result = { 'builds': self._get_build_numbers(store, job_id) }
-        if len(result['builds']) > 0:
-            result['last_build_number'] = max(result['builds'])
+            entries = build_index.BuildIndex(self.config, job_id).load(store)
+        page = build_index.select(entries, limit, before, after, order)
+        result = { 'builds': [ entry['build_number'] for entry in page ] }
+        if len(entries) > 0:
+            result['last_build_number'] = entries[-1]['build_number']
         return webob.Response(status=200, body=json.dumps(result), content_type="application/json")
 
-    def trigger_build(self, job_id):
-        """ Trigger a new build """
-        if self.zknodes:
-            lock = sync.ZooKeeperLock(self.zknodes, 'job-lock-%s' % job_id)
-        else:
-            lock = sync.PhonyLock('job-lock-%s' % job_id)
-        if lock.try_lock() != True:
+    @classmethod
+    def _int_param(cls, request, name):
+        """ Return an integer query parameter, None if not given """
+        value = request.GET.get(name)
+        if value is None:
+            return None
+        return int(value)
+
+    def _read_build_counter(self, store, job_id):
+        """ Return the last allocated build number, scanning the job
+            directory only if the counter has not been written yet """
+        try:
+            return int(self.metadata.get(store, self._build_counter_file(job_id)))
+        except (TypeError, ValueError):
+            build_ids = self._get_build_numbers(store, job_id)
+            if len(build_ids) > 0:
+                return max(build_ids)
+            return 0
+
+    @classmethod
+    def _parse_build_counter(cls, data):
+        """ Return build number stored in a counter document, 0 if unset """
+        try:
+            return int(data)
+        except (TypeError, ValueError):
+            return 0
+
+    def _advance_build_counter(self, store, job_id, build_number):
+        """ Raise the build counter to build_number unless it is already
+            higher. Unless the metadata backend updates atomically, this is
+            done under the job lock, so a slower trigger can not move the
+            counter back. Raises sync.SyncError if the lock stays busy. """
+        counter_file = self._build_counter_file(job_id)
+        advance = lambda data: str(max(self._parse_build_counter(data), build_number))
+        if self._parse_build_counter(self.metadata.get(store, counter_file)) >= build_number:
+            return
+        if self.metadata.atomic_updates:
+            self.metadata.update(store, counter_file, advance)
+            return
+        lock = sync.acquire_lock(self.zknodes, 'job-lock-%s' % job_id)
+        if lock is None:
+            raise sync.SyncError(sync.SYNC_LOCK_BUSY, 'Job locked')
+        try:
+            self.metadata.update(store, counter_file, advance)
+        finally:
+            lock.unlock()
             lock.close()
-            self.log.info("Job locked '%s'" % job_id)
-            return webob.Response(status=400, body=constants.ERROR_JOB_LOCKED)
 
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
+    def _allocate_build_number(self, store, job_id):
+        """ Allocate a new build number. Creating the build directory is the
+            atomic step, the counter only spares us the directory scan, so
+            failing to advance it does not fail the build. """
+        build_number = self._read_build_counter(store, job_id)
+        for _ in range(BUILD_ALLOCATION_ATTEMPTS):
+            build_number += 1
+            try:
+                store.mkdir(self._build_dir(job_id, str(build_number)))
+            except storage.ObjectExists:
+                continue
+            try:
+                self._advance_build_counter(store, job_id, build_number)
+            except:
+                self.log.exception('Failed to update build counter, job_id %s, build %d', job_id, build_number)
+            return str(build_number)
+        return None
+
+    def trigger_build(self, job_id):
+        """ Trigger a new build """
+        storage_backend = storage.get_storage(self.config)
         with storage_backend as store:
             if not store.isdir(self._job_dir(job_id)):
                 return webob.Response(status=404, body=constants.ERROR_BUILD_NOT_FOUND)
-            build_ids = self._get_build_numbers(store, job_id)
-            if len(build_ids) > 0:
-                new_build_number = str(max(build_ids) + 1)
-            else:
-                new_build_number = "1"
 
             try:
-                store.mkdir(self._build_dir(job_id, new_build_number))
+                new_build_number = self._allocate_build_number(store, job_id)
             except:
                 self.log.exception("Build directory creation failed")
-                if lock:
-                    lock.unlock()
-                    lock.close()
                 return webob.Response(status=500, body=constants.ERROR_BUILD_CREATE_FAILED)
-
-            if lock:
-                lock.unlock()
-                lock.close()
+            if new_build_number is None:
+                self.log.error("Failed to allocate a build number, job_id %s", job_id)
+                return webob.Response(status=500, body=constants.ERROR_BUILD_CREATE_FAILED)
 
             build_state = { "status": "preparing" }
             try:
-                with store.open(self._build_state_file(job_id, new_build_number), 'wb') as fileo:
-                    json.dump(build_state, fileo)
+                self.metadata.put(store, self._build_state_file(job_id, new_build_number), json.dumps(build_state))
             except:
                 self.log.exception('Failed to write build state, job_id %s, build %s', job_id, new_build_number)
                 return webob.Response(status=500, body=constants.ERROR_BUILD_WRITE_FAILED)
 
+            build_index.BuildIndex(self.config, job_id).add(store, int(new_build_number), build_state)
+
         if self.config.get('task_frontends'):
             for _ in range(10):
                 task_id = self.distci_client.tasks.create()
@@ -147,26 +260,22 @@ class JobsBuilds(object):
         """ Get job state """
         if validators.validate_build_id(build_id) != build_id:
             return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_ID)
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
+        storage_backend = storage.get_storage(self.config)
         build_data = None
         with storage_backend as store:
-            if not store.isdir(self._build_dir(job_id, build_id)):
+            try:
+                data = self.metadata.get(store, self._build_state_file(job_id, build_id))
+                if data is not None:
+                    build_data = json.dumps({'job_id': job_id, 'build_number': build_id, 'state': json.loads(data)})
+            except ValueError:
+                pass
+            except:
+                self.log.exception("Exception while reading build state")
+                return webob.Response(status=500, body=constants.ERROR_INTERNAL)
+            if not build_data and not store.isdir(self._build_dir(job_id, build_id)):
                 return webob.Response(status=404, body=constants.ERROR_JOB_NOT_FOUND)
-            for _ in range(10):
-                try:
-                    with store.open(self._build_state_file(job_id, build_id), 'rb') as fileo:
-                        build_state = json.load(fileo)
-                    build_data = json.dumps({'job_id': job_id, 'build_number': build_id, 'state': build_state})
-                    break
-                except (storage.NotFound, ValueError):
-                    time.sleep(0.1)
-                except:
-                    self.log.exception("Exception while reading build state")
-                    return webob.Response(status=500, body=constants.ERROR_INTERNAL)
         if not build_data:
+            # build directory exists but state is not written yet
             return webob.Response(status=409, body=constants.ERROR_BUILD_LOCKED)
         return webob.Response(status=200, body=build_data, content_type="application/json")
 
@@ -180,119 +289,239 @@ class JobsBuilds(object):
         if validators.validate_build_id(build_id) != build_id:
             self.log.error("Build_id validation failure, '%s'", build_id)
             return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_ID)
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
+        storage_backend = storage.get_storage(self.config)
         with storage_backend as store:
             if not store.isdir(self._build_dir(job_id, build_id)):
                 return webob.Response(status=404, body=constants.ERROR_BUILD_NOT_FOUND)
 
             try:
-                with store.open(self._build_state_file(job_id, build_id), 'wb') as fileo:
-                    json.dump(build_state, fileo)
+                self.metadata.put(store, self._build_state_file(job_id, build_id), json.dumps(build_state))
             except:
                 self.log.exception('Failed to write build state, job_id %s, build %s', job_id, build_id)
                 return webob.Response(status=500, body=constants.ERROR_BUILD_WRITE_FAILED)
 
+            build_index.BuildIndex(self.config, job_id).set_state(store, int(build_id), build_state)
+
+        CONSOLE_EVENTS.notify('%s/%s' % (job_id, build_id))
+
         return webob.Response(status=200, body=json.dumps({'job_id': job_id, 'build_number': int(build_id), 'state': build_state}), content_type="application/json")
 
-    def get_console_log(self, job_id, build_id):
-        """ Return contents of the console log """
+    def get_console_log(self, request, job_id, build_id):
+        """ Return contents of the console log, or the part selected by
+            'offset' and 'length' or 'tail' query parameters. Current log
+            size is returned in the X-Console-Size header. With 'since',
+            follow the log instead, see follow_console_log. Whole logs are
+            sent gzip encoded to clients that accept it. """
         if validators.validate_build_id(build_id) != build_id:
             self.log.error("Build_id validation failure, '%s'", build_id)
             return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_ID)
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
-        console_log = ''
+        try:
+            offset = self._int_param(request, 'offset')
+            length = self._int_param(request, 'length')
+            tail = self._int_param(request, 'tail')
+            since = self._int_param(request, 'since')
+            wait = self._int_param(request, 'wait')
+        except ValueError:
+            return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_QUERY)
+        if ((offset is not None and offset < 0) or
+            (length is not None and length < 0) or
+            (tail is not None and (tail < 0 or offset is not None)) or
+            (since is not None and (since < 0 or offset is not None or tail is not None)) or
+            (wait is not None and wait < 0)):
+            return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_QUERY)
+
+        if since is not None:
+            return self.follow_console_log(job_id, build_id, since, length, wait)
+
+        storage_backend = storage.get_storage(self.config)
         with storage_backend as store:
             if not store.isdir(self._build_dir(job_id, build_id)):
                 return webob.Response(status=404, body=constants.ERROR_BUILD_NOT_FOUND)
-            try:
-                with store.open(self._console_log_file(job_id, build_id), 'rb') as fileo:
-                    console_log = fileo.read()
-            except storage.NotFound:
-                # can be ignored, we just return empty log
-                pass
-            except:
-                self.log.exception("Exception while reading console log")
-        return webob.Response(status=200, body=console_log, content_type="text/plain")
+            if offset is None and length is None and tail is None and 'gzip' in request.accept_encoding:
+                return self._console_log_gzip_response(store, job_id, build_id)
+            return self._console_log_response(store, job_id, build_id, offset, length, tail)
+
+    def follow_console_log(self, job_id, build_id, since, length=None, wait=None):
+        """ Long-poll for console log content after offset 'since'. Returns
+            as soon as there is new content, the build is complete or 'wait'
+            seconds have passed. X-Build-Complete header tells clients when
+            to stop following. Appends through this frontend process wake
+            up waiters immediately, appends through other processes are
+            noticed by checking the log size every
+            CONSOLE_FOLLOW_POLL_INTERVAL seconds. A follower holds a sync
+            worker for up to console_follow_max_wait seconds. """
+        max_wait = self.config.get('console_follow_max_wait', CONSOLE_FOLLOW_MAX_WAIT)
+        if wait is None or wait > max_wait:
+            wait = max_wait
+        deadline = time.time() + wait
+        event = '%s/%s' % (job_id, build_id)
+        while True:
+            storage_backend = storage.get_storage(self.config)
+            with storage_backend as store:
+                if not store.isdir(self._build_dir(job_id, build_id)):
+                    return webob.Response(status=404, body=constants.ERROR_BUILD_NOT_FOUND)
+                # read state before size, so a complete build has its final output included
+                try:
+                    complete = json.loads(self.metadata.get(store, self._build_state_file(job_id, build_id))).get('status') == 'complete'
+                except (TypeError, ValueError):
+                    complete = False
+                log_len = console_log.ConsoleLog(self.config, job_id, build_id).size(store)
+                remaining = deadline - time.time()
+                if log_len > since or complete or remaining <= 0:
+                    response = self._console_log_response(store, job_id, build_id, since, length)
+                    response.headers['X-Build-Complete'] = 'true' if complete else 'false'
+                    return response
+            CONSOLE_EVENTS.wait(event, min(remaining, CONSOLE_FOLLOW_POLL_INTERVAL))
+
+    def _console_log_response(self, store, job_id, build_id, offset=None, length=None, tail=None):
+        """ Return response with the selected part of console log and its size """
+        try:
+            app_iter, read_len, log_len = console_log.ConsoleLog(self.config, job_id, build_id).read(store, offset, length, tail)
+        except:
+            self.log.exception("Exception while reading console log")
+            return self._console_log_data_response('', 0)
+        return self._console_log_data_response(app_iter, log_len, read_len)
+
+    def _console_log_gzip_response(self, store, job_id, build_id):
+        """ Return response with the whole console log gzip encoded """
+        try:
+            app_iter, content_len, log_len = console_log.ConsoleLog(self.config, job_id, build_id).read_gzip(store)
+        except:
+            self.log.exception("Exception while reading console log")
+            return self._console_log_data_response('', 0)
+        response = self._console_log_data_response(app_iter, log_len, content_len)
+        response.content_encoding = 'gzip'
+        response.vary = ('Accept-Encoding',)
+        return response
+
+    @classmethod
+    def _console_log_data_response(cls, data, log_len, read_len=None):
+        """ Return console log response with size header """
+        if read_len is None:
+            response = webob.Response(status=200, body=data, content_type="text/plain")
+        else:
+            response = webob.Response(status=200, app_iter=data, content_length=read_len, content_type="text/plain")
+        response.headers['X-Console-Size'] = str(log_len)
+        return response
 
     def update_console_log(self, request, job_id, build_id):
         """ Append content to the console log """
         if validators.validate_build_id(build_id) != build_id:
             self.log.error("Build_id validation failure, '%s'", build_id)
             return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_ID)
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
+        storage_backend = storage.get_storage(self.config)
         with storage_backend as store:
             if not store.isdir(self._build_dir(job_id, build_id)):
                 return webob.Response(status=404, body=constants.ERROR_BUILD_NOT_FOUND)
 
             try:
                 log = request.body_file.read()
-                with store.open(self._console_log_file(job_id, build_id), 'ab') as fileo:
-                    fileo.write(log)
+                console_log.ConsoleLog(self.config, job_id, build_id).append(store, log)
             except:
                 self.log.exception("Exception while updating console log")
                 # FIXME: ignored for now
+        CONSOLE_EVENTS.notify('%s/%s' % (job_id, build_id))
         return webob.Response(status=204)
 
+    def _remove_temporary(self, store, path):
+        """ Remove a temporary file after a failed write, without masking
+            the original error """
+        try:
+            store.unlink(path)
+        except storage.NotFound:
+            pass
+        except:
+            self.log.exception("Failed to remove %s", path)
+
     def update_workspace(self, request, job_id, build_id):
-        """ Store workspace archive """
+        """ Store workspace archive, and the codec it was compressed with
+            from the X-Workspace-Codec header """
         if validators.validate_build_id(build_id) != build_id:
             self.log.error("Build_id validation failure, '%s'", build_id)
             return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_ID)
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
+        codec = request.headers.get('X-Workspace-Codec', DEFAULT_WORKSPACE_CODEC)
+        if codec not in WORKSPACE_CODECS:
+            self.log.error("Unknown workspace codec '%s'", codec)
+            return webob.Response(status=400, body=constants.ERROR_WORKSPACE_INVALID_CODEC)
+        storage_backend = storage.get_storage(self.config)
         with storage_backend as store:
             if not store.isdir(self._build_dir(job_id, build_id)):
                 return webob.Response(status=404, body=constants.ERROR_BUILD_NOT_FOUND)
 
             data_len = request.content_length
             ifh = request.body_file
+            if data_len is not None:
+                # unwrapped, so that local storage can copy a spooled body in the kernel
+                ifh = request.body_file_raw
 
+            # written aside and renamed in place, so that readers never see
+            # a partial archive and every upload gets a new version
+            tmp_path = '%s.tmp-%s' % (self._build_workspace_file(job_id, build_id), uuid.uuid4().hex)
             try:
-                ofh = store.open(self._build_workspace_file(job_id, build_id), 'wb')
+                ofh = store.open(tmp_path, 'wb')
             except:
                 self.log.exception("Failed to open workspace for writing")
                 return webob.Response(status=500, body=constants.ERROR_BUILD_WRITE_FAILED)
 
             try:
-                while data_len > 0:
-                    read_len = data_len
-                    if read_len > 1024*128:
-                        read_len = 1024*128
-                    data = ifh.read(read_len)
-                    ofh.write(data)
-                    data_len = data_len - len(data)
+                written = store.write_from(ofh, ifh, data_len)
             except:
                 self.log.exception("Exception while updating workspace")
                 ofh.close()
+                self._remove_temporary(store, tmp_path)
                 return webob.Response(status=500, body=constants.ERROR_BUILD_WRITE_FAILED)
 
             ofh.close()
 
-        return webob.Response(status=204)
+            if data_len is not None and written != data_len:
+                self.log.error("Workspace upload truncated, %d of %d bytes", written, data_len)
+                self._remove_temporary(store, tmp_path)
+                return webob.Response(status=500, body=constants.ERROR_BUILD_WRITE_FAILED)
+
+            try:
+                store.rename(tmp_path, self._build_workspace_file(job_id, build_id))
+            except:
+                self.log.exception("Exception while updating workspace")
+                self._remove_temporary(store, tmp_path)
+                return webob.Response(status=500, body=constants.ERROR_BUILD_WRITE_FAILED)
+
+            try:
+                info = store.getinfo(self._build_workspace_file(job_id, build_id))
+                store.write_file(self._build_workspace_codec_file(job_id, build_id), '%s %s' % (codec, info.etag))
+            except:
+                # readers detect the codec from the archive
+                self.log.exception("Exception while recording workspace codec")
+
+            try:
+                workspace_manifest.WorkspaceManifest(self.config, job_id, build_id).clear(store)
+            except:
+                self.log.exception("Exception while removing workspace manifest")
+
+            version = self._workspace_version(store, job_id, build_id)
+
+        return webob.Response(status=204, headers={'X-Workspace-Version': version})
 
     def get_workspace(self, job_id, build_id):
-        """ Get workspace archive """
+        """ Get workspace archive, honoring Range and conditional request
+            headers. Workspaces stored as manifests are archived on demand. """
         if validators.validate_build_id(build_id) != build_id:
             self.log.error("Build_id validation failure, '%s'", build_id)
             return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_ID)
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
+        storage_backend = storage.get_storage(self.config)
         with storage_backend as store:
+            version = self._workspace_version(store, job_id, build_id)
             if not store.isfile(self._build_workspace_file(job_id, build_id)):
-                return webob.Response(status=404, body=constants.ERROR_BUILD_NOT_FOUND)
+                manifest = workspace_manifest.WorkspaceManifest(self.config, job_id, build_id)
+                if not manifest.exists(store):
+                    return webob.Response(status=404, body=constants.ERROR_BUILD_NOT_FOUND)
+                try:
+                    manifest.build_archive(store)
+                except storage.NotFound:
+                    # replaced by an uploaded archive meanwhile
+                    pass
+                except:
+                    self.log.exception("Exception while building workspace archive")
+                    return webob.Response(status=500, body=constants.ERROR_BUILD_READ_FAILED)
 
             try:
                 ifh = store.open(self._build_workspace_file(job_id, build_id), 'rb')
@@ -302,63 +531,187 @@ class JobsBuilds(object):
                 self.log.exception("Exception in get workspace")
                 return webob.Response(status=500, body=constants.ERROR_BUILD_READ_FAILED)
 
-            file_len = store.getsize(self._build_workspace_file(job_id, build_id))
+            info = store.getinfo(self._build_workspace_file(job_id, build_id))
+            codec = self._read_workspace_codec(store, job_id, build_id, info.etag)
 
-        return webob.Response(status=200, body_file=ifh, content_length=file_len, content_type="application/octet-stream")
+        response = webob.Response(status=200, app_iter=storage.FileIter(ifh), content_length=info.size, content_type="application/octet-stream",
+                                  etag=info.etag, accept_ranges='bytes', conditional_response=True)
+        response.headers['X-Workspace-Codec'] = codec
+        if version is not None:
+            response.headers['X-Workspace-Version'] = version
+        return response
+
+    def get_workspace_version(self, job_id, build_id):
+        """ Get version of the workspace in X-Workspace-Version, without
+            building an archive for workspaces stored as manifests """
+        if validators.validate_build_id(build_id) != build_id:
+            self.log.error("Build_id validation failure, '%s'", build_id)
+            return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_ID)
+        storage_backend = storage.get_storage(self.config)
+        with storage_backend as store:
+            version = self._workspace_version(store, job_id, build_id)
+
+        if version is None:
+            return webob.Response(status=404)
+        return webob.Response(status=200, headers={'X-Workspace-Version': version})
 
     def delete_workspace(self, job_id, build_id):
-        """ Delete workspace archive """
+        """ Delete workspace archive and manifest """
         if validators.validate_build_id(build_id) != build_id:
             self.log.error("Build_id validation failure, '%s'", build_id)
             return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_ID)
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
+        storage_backend = storage.get_storage(self.config)
         with storage_backend as store:
-            if not store.isfile(self._build_workspace_file(job_id, build_id)):
+            manifest = workspace_manifest.WorkspaceManifest(self.config, job_id, build_id)
+            if not store.isfile(self._build_workspace_file(job_id, build_id)) and not manifest.exists(store):
                 return webob.Response(status=404, body=constants.ERROR_BUILD_NOT_FOUND)
 
             try:
+                manifest.clear(store)
                 store.unlink(self._build_workspace_file(job_id, build_id))
+                store.unlink(self._build_workspace_codec_file(job_id, build_id))
             except storage.NotFound:
-                return webob.Response(status=500, body=constants.ERROR_BUILD_WRITE_FAILED)
+                pass
             except:
                 self.log.exception("Exception while deleting workspace")
                 return webob.Response(status=500, body=constants.ERROR_BUILD_WRITE_FAILED)
 
         return webob.Response(status=204)
 
-    def delete_build(self, job_id, build_id):
-        """ Delete a specific build and all related data """
+    def get_workspace_manifest(self, job_id, build_id):
+        """ Get workspace manifest """
         if validators.validate_build_id(build_id) != build_id:
             self.log.error("Build_id validation failure, '%s'", build_id)
             return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_ID)
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
+        storage_backend = storage.get_storage(self.config)
+        with storage_backend as store:
+            try:
+                manifest = workspace_manifest.WorkspaceManifest(self.config, job_id, build_id).load(store)
+            except ValueError:
+                self.log.exception("Corrupted workspace manifest")
+                return webob.Response(status=500, body=constants.ERROR_BUILD_READ_FAILED)
+            if manifest is None:
+                return webob.Response(status=404, body=constants.ERROR_WORKSPACE_MANIFEST_NOT_FOUND)
+
+        return webob.Response(status=200, body=json.dumps(manifest), content_type="application/json")
+
+    def update_workspace_manifest(self, request, job_id, build_id):
+        """ Store workspace as a manifest. If some of the file contents
+            are not stored yet, responds 409 with their digests in
+            'missing', to be uploaded before retrying. """
+        if validators.validate_build_id(build_id) != build_id:
+            self.log.error("Build_id validation failure, '%s'", build_id)
+            return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_ID)
+        try:
+            manifest = json.loads(request.body)
+            workspace_manifest.validate(manifest)
+        except ValueError:
+            return webob.Response(status=400, body=constants.ERROR_WORKSPACE_INVALID_MANIFEST)
+        storage_backend = storage.get_storage(self.config)
         with storage_backend as store:
             if not store.isdir(self._build_dir(job_id, build_id)):
                 return webob.Response(status=404, body=constants.ERROR_BUILD_NOT_FOUND)
             try:
-                store.rmtree(self._build_dir(job_id, build_id))
+                missing = workspace_manifest.WorkspaceManifest(self.config, job_id, build_id).save(store, manifest)
+            except:
+                self.log.exception("Exception while storing workspace manifest")
+                return webob.Response(status=500, body=constants.ERROR_BUILD_WRITE_FAILED)
+
+            version = self._workspace_version(store, job_id, build_id)
+
+        if missing:
+            return webob.Response(status=409, body=json.dumps({'missing': missing}), content_type="application/json")
+        return webob.Response(status=204, headers={'X-Workspace-Version': version})
+
+    def get_workspace_blob(self, job_id, build_id, sha256):
+        """ Get contents of a file listed in the workspace manifest """
+        if validators.validate_build_id(build_id) != build_id:
+            self.log.error("Build_id validation failure, '%s'", build_id)
+            return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_ID)
+        if validators.validate_sha256(sha256) != sha256:
+            return webob.Response(status=400, body=constants.ERROR_ARTIFACT_INVALID_DIGEST)
+        storage_backend = storage.get_storage(self.config)
+        with storage_backend as store:
+            manifest = workspace_manifest.WorkspaceManifest(self.config, job_id, build_id)
+            try:
+                ifh = manifest.open_blob(store, sha256)
             except storage.NotFound:
-                return webob.Response(status=204)
+                return webob.Response(status=404, body=constants.ERROR_WORKSPACE_BLOB_NOT_FOUND)
             except:
-                self.log.exception("Exception on delete build")
+                self.log.exception("Exception in get workspace blob")
+                return webob.Response(status=500, body=constants.ERROR_BUILD_READ_FAILED)
+
+            info = manifest.blob_info(store, sha256)
+
+        return webob.Response(status=200, app_iter=storage.FileIter(ifh), content_length=info.size, content_type="application/octet-stream",
+                              etag=info.etag, accept_ranges='bytes', conditional_response=True)
+
+    def update_workspace_blob(self, request, job_id, build_id, sha256):
+        """ Store contents of a workspace file, verified against its digest """
+        if validators.validate_build_id(build_id) != build_id:
+            self.log.error("Build_id validation failure, '%s'", build_id)
+            return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_ID)
+        if validators.validate_sha256(sha256) != sha256:
+            return webob.Response(status=400, body=constants.ERROR_ARTIFACT_INVALID_DIGEST)
+        storage_backend = storage.get_storage(self.config)
+        with storage_backend as store:
+            if not store.isdir(self._build_dir(job_id, build_id)):
                 return webob.Response(status=404, body=constants.ERROR_BUILD_NOT_FOUND)
+            try:
+                stored = workspace_manifest.WorkspaceManifest(self.config, job_id, build_id).add_blob(store, sha256, request.body_file, request.content_length)
+            except:
+                self.log.exception("Exception while storing workspace blob")
+                return webob.Response(status=500, body=constants.ERROR_BUILD_WRITE_FAILED)
+
+        if not stored:
+            return webob.Response(status=400, body=constants.ERROR_ARTIFACT_DIGEST_MISMATCH)
         return webob.Response(status=204)
 
+    def delete_build(self, job_id, build_id):
+        """ Delete a specific build and all related data. The build is moved
+            to the trash and its data removed in the background. """
+        if validators.validate_build_id(build_id) != build_id:
+            self.log.error("Build_id validation failure, '%s'", build_id)
+            return webob.Response(status=400, body=constants.ERROR_BUILD_INVALID_ID)
+        storage_backend = storage.get_storage(self.config)
+        with storage_backend as store:
+            try:
+                trash_id = trash.move_to_trash(self.config, store, self._build_dir(job_id, build_id), {'job_id': job_id, 'build_number': int(build_id)})
+            except storage.NotFound:
+                return webob.Response(status=404, body=constants.ERROR_BUILD_NOT_FOUND)
+            except:
+                self.log.exception("Exception on delete build")
+                return webob.Response(status=500, body=constants.ERROR_INTERNAL)
+            self.metadata.remove_tree(store, self._build_dir(job_id, build_id))
+            build_index.BuildIndex(self.config, job_id).remove(store, int(build_id))
+        return webob.Response(status=202, body=json.dumps({'job_id': job_id, 'build_number': int(build_id), 'trash_id': trash_id}), content_type="application/json")
+
+    def resolve_build_alias(self, job_id, alias):
+        """ Return build number for an alias such as lastSuccessful """
+        storage_backend = storage.get_storage(self.config)
+        with storage_backend as store:
+            if not store.isdir(self._job_dir(job_id)):
+                return None
+            return build_index.BuildIndex(self.config, job_id).resolve(store, alias)
+
     def handle_request(self, request, job_id, parts):
         """ Handle requests related to builds """
         if validators.validate_job_id(job_id) == None:
             self.log.error('Invalid job_id: %r' % job_id)
             return webob.Response(status=400, body=constants.ERROR_JOB_INVALID_ID)
 
+        if len(parts) > 0 and parts[0] in build_index.BUILD_ALIASES:
+            # aliases move as builds complete, only read through them
+            if request.method not in ('GET', 'HEAD'):
+                return webob.Response(status=400)
+            build_number = self.resolve_build_alias(job_id, parts[0])
+            if build_number is None:
+                return webob.Response(status=404, body=constants.ERROR_BUILD_NOT_FOUND)
+            parts = [ str(build_number) ] + parts[1:]
+
         if len(parts) == 0:
             if request.method == 'GET':
-                return self.get_builds(job_id)
+                return self.get_builds(request, job_id)
             elif request.method == 'POST':
                 return self.trigger_build(job_id)
         elif len(parts) == 1:
@@ -374,15 +727,26 @@ class JobsBuilds(object):
             elif parts[1] == 'state' and request.method == 'PUT':
                 return self.update_build_state(request, job_id, parts[0])
             elif parts[1] == 'console' and request.method == 'GET':
-                return self.get_console_log(job_id, parts[0])
+                return self.get_console_log(request, job_id, parts[0])
             elif parts[1] == 'console' and request.method == 'POST':
                 return self.update_console_log(request, job_id, parts[0])
             elif parts[1] == 'workspace' and request.method == 'GET':
                 return self.get_workspace(job_id, parts[0])
+            elif parts[1] == 'workspace' and request.method == 'HEAD':
+                return self.get_workspace_version(job_id, parts[0])
             elif parts[1] == 'workspace' and request.method == 'PUT':
                 return self.update_workspace(request, job_id, parts[0])
             elif parts[1] == 'workspace' and request.method == 'DELETE':
                 return self.delete_workspace(job_id, parts[0])
+        elif parts[1] == 'workspace':
+            if len(parts) == 3 and parts[2] == 'manifest' and request.method == 'GET':
+                return self.get_workspace_manifest(job_id, parts[0])
+            elif len(parts) == 3 and parts[2] == 'manifest' and request.method == 'PUT':
+                return self.update_workspace_manifest(request, job_id, parts[0])
+            elif len(parts) == 4 and parts[2] == 'blobs' and request.method == 'GET':
+                return self.get_workspace_blob(job_id, parts[0], parts[3])
+            elif len(parts) == 4 and parts[2] == 'blobs' and request.method == 'PUT':
+                return self.update_workspace_blob(request, job_id, parts[0], parts[3])
 
         return webob.Response(status=400)
 
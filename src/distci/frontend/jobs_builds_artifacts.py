@@ -11,14 +11,13 @@ import os
 import json
 import webob
 
-from distci.frontend import validators, constants, storage
+from distci.frontend import validators, blob_store, constants, storage
 
 class JobsBuildsArtifacts(object):
     """ Class for handling build artifact related requests """
     def __init__(self, config):
         self.config = config
         self.log = logging.getLogger('jobs_builds_artifacts')
-        self.cephmonitors = config.get('ceph_monitors')
 
     def _job_dir(self, job_id):
         """ Return directory for a specific job """
@@ -37,11 +36,23 @@ class JobsBuildsArtifacts(object):
         return os.path.join(self._build_artifact_dir(job_id, build_id), artifact_id)
 
     def create_or_update_artifact(self, request, job_id, build_id, artifact_id_param = None):
-        """ Create or update an artifact """
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
+        """ Create or update an artifact, stored deduplicated in the blob store.
+            With 'sha256' and 'size' query parameters and no body, the artifact
+            is linked to already stored content, or 404 returned if there is
+            none. With only 'sha256', the uploaded content is verified. """
+        sha256 = request.GET.get('sha256')
+        size = request.GET.get('size')
+        if sha256 is not None and validators.validate_sha256(sha256) != sha256:
+            return webob.Response(status=400, body=constants.ERROR_ARTIFACT_INVALID_DIGEST)
+        if size is not None:
+            try:
+                size = int(size)
+            except ValueError:
+                size = -1
+            if sha256 is None or size < 0 or request.content_length:
+                return webob.Response(status=400, body=constants.ERROR_ARTIFACT_INVALID_DIGEST)
+
+        storage_backend = storage.get_storage(self.config)
         with storage_backend as store:
             if artifact_id_param is not None:
                 artifact_id = artifact_id_param
@@ -62,35 +73,32 @@ class JobsBuildsArtifacts(object):
             data_len = request.content_length
             ifh = request.body_file
 
-            try:
-                ofh = store.open(self._build_artifact_file(job_id, build_id, artifact_id), 'wb')
-            except:
-                self.log.exception("Exception while storing artifact")
-                return webob.Response(status=400, body=constants.ERROR_ARTIFACT_WRITE_FAILED)
-
-            try:
-                while data_len > 0:
-                    read_len = data_len
-                    if read_len > 1024*128:
-                        read_len = 1024*128
-                    data = ifh.read(read_len)
-                    ofh.write(data)
-                    data_len = data_len - len(data)
-            except:
-                self.log.exception("Exception while writing artifact")
-                ofh.close()
-                return webob.Response(status=400, body=constants.ERROR_ARTIFACT_WRITE_FAILED)
+            if size is not None:
+                try:
+                    linked = blob_store.BlobStore(self.config).link(store, sha256, size, self._build_artifact_file(job_id, build_id, artifact_id))
+                except:
+                    self.log.exception("Exception while linking artifact")
+                    return webob.Response(status=400, body=constants.ERROR_ARTIFACT_WRITE_FAILED)
+                if not linked:
+                    return webob.Response(status=404, body=constants.ERROR_ARTIFACT_BLOB_NOT_FOUND)
+            else:
+                try:
+                    stored_sha256, size = blob_store.BlobStore(self.config).put(store, ifh, data_len, self._build_artifact_file(job_id, build_id, artifact_id), sha256)
+                except:
+                    self.log.exception("Exception while storing artifact")
+                    return webob.Response(status=400, body=constants.ERROR_ARTIFACT_WRITE_FAILED)
 
-            ofh.close()
+                if stored_sha256 is None:
+                    if sha256 is not None and (data_len is None or size == data_len):
+                        return webob.Response(status=400, body=constants.ERROR_ARTIFACT_DIGEST_MISMATCH)
+                    return webob.Response(status=400, body=constants.ERROR_ARTIFACT_WRITE_FAILED)
+                sha256 = stored_sha256
 
-        return webob.Response(status=200 if artifact_id_param else 201, body=json.dumps({'job_id': job_id, 'build_number': int(build_id), 'artifact_id': artifact_id}), content_type="application/json")
+        return webob.Response(status=200 if artifact_id_param else 201, body=json.dumps({'job_id': job_id, 'build_number': int(build_id), 'artifact_id': artifact_id, 'sha256': sha256, 'size': size}), content_type="application/json")
 
     def get_artifact(self, job_id, build_id, artifact_id):
-        """ Get artifact data """
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
+        """ Get artifact data, honoring Range and conditional request headers """
+        storage_backend = storage.get_storage(self.config)
         with storage_backend as store:
             if not store.isfile(self._build_artifact_file(job_id, build_id, artifact_id)):
                 return webob.Response(status=404, body=constants.ERROR_ARTIFACT_NOT_FOUND)
@@ -102,21 +110,23 @@ class JobsBuildsArtifacts(object):
                 self.log.exception("Exception while getting artifact")
                 return webob.Response(status=500, body=constants.ERROR_ARTIFACT_READ_FAILED)
 
-            file_len = store.getsize(self._build_artifact_file(job_id, build_id, artifact_id))
+            info = store.getinfo(self._build_artifact_file(job_id, build_id, artifact_id))
+            sha256 = blob_store.BlobStore(self.config).digest(store, self._build_artifact_file(job_id, build_id, artifact_id))
 
-        return webob.Response(status=200, body_file=ifh, content_length=file_len)
+        response = webob.Response(status=200, app_iter=storage.FileIter(ifh), content_length=info.size,
+                                  etag=info.etag, accept_ranges='bytes', conditional_response=True)
+        if sha256 is not None:
+            response.headers['X-Content-SHA256'] = str(sha256)
+        return response
 
     def delete_artifact(self, job_id, build_id, artifact_id):
         """ Delete artifact """
-        if self.cephmonitors:
-            storage_backend = storage.CephFSStorage(','.join(self.cephmonitors))
-        else:
-            storage_backend = storage.LocalFSStorage()
+        storage_backend = storage.get_storage(self.config)
         with storage_backend as store:
             if not store.isfile(self._build_artifact_file(job_id, build_id, artifact_id)):
                 return webob.Response(status=404, body=constants.ERROR_ARTIFACT_NOT_FOUND)
             try:
-                store.unlink(self._build_artifact_file(job_id, build_id, artifact_id))
+                blob_store.BlobStore(self.config).unlink(store, self._build_artifact_file(job_id, build_id, artifact_id))
             except storage.NotFound:
                 return webob.Response(status=404, body=constants.ERROR_ARTIFACT_NOT_FOUND)
             except:
@@ -0,0 +1,240 @@
+"""
+Metadata store for small documents
+
+Job configs, build states, build counters and build indexes are small JSON
+documents read on nearly every request. By default they are files next to
+the data they describe, on the storage backend. With the 'sqlite' backend
+they live in an SQLite database in WAL mode instead, where a read is a
+single local lookup and updates are transactions. Workspaces, artifacts and
+console logs stay on the storage backend either way.
+
+Documents are addressed by the file name they would have on the storage
+backend. The SQLite backend moves documents still stored as files into the
+database when they are first read, so it can be enabled on an existing
+installation. The database is local to a host: all frontends writing to
+the same data directory have to share it, i.e. run on the same host.
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+import os
+import logging
+import sqlite3
+import threading
+import contextlib
+
+from distci.frontend import sync, storage
+
+DEFAULT_TIMEOUT = 30
+
+class FileMetadata(object):
+    """ Documents as files on the storage backend. Updates are not atomic,
+        callers serialize them with their own locks. """
+    atomic_updates = False
+
+    def get(self, store, path):
+        """ Return document, None if there is none """
+        try:
+            with store.open(path, 'rb') as fileo:
+                return fileo.read()
+        except storage.NotFound:
+            return None
+
+    def put(self, store, path, data):
+        """ Store document """
+        store.write_file(path, data)
+
+    def delete(self, store, path):
+        """ Remove document """
+        try:
+            store.unlink(path)
+        except storage.NotFound:
+            pass
+
+    def update(self, store, path, func):
+        """ Replace document with func(document), removing it if the result
+            is None. Returns the new document. """
+        data = func(self.get(store, path))
+        if data is None:
+            self.delete(store, path)
+        else:
+            self.put(store, path, data)
+        return data
+
+    def remove_tree(self, store, path):
+        """ Remove documents under a directory, noop as they go with the
+            directory itself """
+        pass
+
+    def connection(self, path):
+        """ Return data connection, like sync.FSData, for documents under
+            a local directory """
+        return sync.FSData(path)
+
+class SQLiteMetadata(object):
+    """ Documents in an SQLite database, one connection per thread """
+    atomic_updates = True
+
+    def __init__(self, data_directory, database, timeout=DEFAULT_TIMEOUT):
+        self.data_directory = data_directory
+        self.database = database
+        self.timeout = timeout
+        self.local = threading.local()
+        self.log = logging.getLogger('metadata')
+
+    def _conn(self):
+        """ Return database connection of the calling thread """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.database, timeout=self.timeout, isolation_level=None)
+            conn.text_factory = str
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS documents (key TEXT PRIMARY KEY, data TEXT NOT NULL)')
+            self.local.conn = conn
+            self.local.depth = 0
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """ Run a write transaction, committed unless an exception is raised.
+            Nested transactions are part of the outermost one. """
+        conn = self._conn()
+        if self.local.depth > 0:
+            yield conn
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        self.local.depth += 1
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            self.local.depth -= 1
+        conn.execute('COMMIT')
+
+    def _key(self, path):
+        """ Return database key of a document """
+        return os.path.relpath(path, self.data_directory)
+
+    @classmethod
+    def _select(cls, conn, key):
+        """ Return document by key, None if there is none """
+        row = conn.execute('SELECT data FROM documents WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _import(self, store, path):
+        """ Move a document stored as a file into the database, return it
+            or None if there is no such file either """
+        try:
+            with store.open(path, 'rb') as fileo:
+                data = fileo.read()
+        except storage.NotFound:
+            return None
+        with self._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO documents (key, data) VALUES (?, ?)', (self._key(path), data))
+            data = self._select(conn, self._key(path))
+        self.log.info('Moved %s into the metadata database', path)
+        try:
+            store.unlink(path)
+        except storage.NotFound:
+            pass
+        return data
+
+    def get(self, store, path):
+        """ Return document, None if there is none """
+        data = self._select(self._conn(), self._key(path))
+        if data is None:
+            return self._import(store, path)
+        return data
+
+    def put(self, store, path, data):
+        """ Store document """
+        self._conn().execute('INSERT OR REPLACE INTO documents (key, data) VALUES (?, ?)', (self._key(path), data))
+
+    def delete(self, store, path):
+        """ Remove document, and its file if it has not been moved yet """
+        self._conn().execute('DELETE FROM documents WHERE key = ?', (self._key(path),))
+        try:
+            store.unlink(path)
+        except storage.NotFound:
+            pass
+
+    def update(self, store, path, func):
+        """ Replace document with func(document) in a single transaction,
+            removing it if the result is None. Returns the new document. """
+        self.get(store, path)
+        key = self._key(path)
+        with self._transaction() as conn:
+            data = func(self._select(conn, key))
+            if data is None:
+                conn.execute('DELETE FROM documents WHERE key = ?', (key,))
+            else:
+                conn.execute('INSERT OR REPLACE INTO documents (key, data) VALUES (?, ?)', (key, data))
+        return data
+
+    def remove_tree(self, store, path):
+        """ Remove documents under a directory """
+        prefix = self._key(path) + '/'
+        # '0' sorts right after '/', bounding the keys with the prefix
+        self._conn().execute('DELETE FROM documents WHERE key > ? AND key < ?', (prefix, prefix[:-1] + '0'))
+
+    def connection(self, path):
+        """ Return data connection, like sync.FSData, for documents under
+            a local directory """
+        return SQLiteData(self, self._key(path))
+
+class SQLiteData(object):
+    """ sync.FSData interface on an SQLite metadata database, with atomic
+        compare and set """
+    def __init__(self, metadata, prefix):
+        self.metadata = metadata
+        self.prefix = prefix
+
+    def list(self, path=''):
+        prefix = self.prefix + path + '/'
+        rows = self.metadata._conn().execute('SELECT key FROM documents WHERE key > ? AND key < ?', (prefix, prefix[:-1] + '0'))
+        return [ row[0][len(prefix):] for row in rows if '/' not in row[0][len(prefix):] ]
+
+    def set(self, path, data='', previous_data=None):
+        with self.metadata._transaction() as conn:
+            if previous_data is not None and SQLiteMetadata._select(conn, self.prefix + path) != previous_data:
+                return False
+            conn.execute('INSERT OR REPLACE INTO documents (key, data) VALUES (?, ?)', (self.prefix + path, data))
+        return True
+
+    def get(self, path):
+        return SQLiteMetadata._select(self.metadata._conn(), self.prefix + path)
+
+    def delete(self, path):
+        self.metadata._conn().execute('DELETE FROM documents WHERE key = ?', (self.prefix + path,))
+
+    def close(self):
+        pass
+
+_DATABASES = {}
+_DATABASES_LOCK = threading.Lock()
+
+def get_metadata(config):
+    """ Return the metadata store selected by configuration, raise
+        ValueError if the backend is unknown or the database path is needed
+        but not set """
+    backend = config.get('metadata_backend', 'file')
+    if backend == 'file':
+        return FileMetadata()
+    elif backend != 'sqlite':
+        raise ValueError('Unknown metadata backend %r' % backend)
+    database = config.get('metadata_database')
+    if not database:
+        # data_directory is only a local path with local storage
+        if storage.backend_name(config) != 'localfs':
+            raise ValueError('metadata_database must be set to a local path with the %s storage backend' % storage.backend_name(config))
+        database = os.path.join(config.get('data_directory'), 'metadata.db')
+    with _DATABASES_LOCK:
+        if database not in _DATABASES:
+            _DATABASES[database] = SQLiteMetadata(config.get('data_directory'), database, config.get('metadata_timeout', DEFAULT_TIMEOUT))
+        return _DATABASES[database]
@@ -14,8 +14,59 @@ except ImportError:
 import os
 import stat
 import ctypes
+import ctypes.util
 import shutil
 import errno
+import threading
+import time
+import logging
+import functools
+import collections
+import uuid
+from multiprocessing import pool
+
+CEPH_POOL_MAX_SIZE = 16
+CEPH_POOL_TIMEOUT = 30.0
+CEPH_POOL_IDLE_CHECK_INTERVAL = 30.0
+READ_CHUNK_SIZE = 128*1024
+FILE_WRAPPER_BLOCK_SIZE = 1024*1024
+INGEST_CHUNK_SIZE = 4*1024*1024
+WRITE_CHUNK_SIZE = 1024*1024
+RMTREE_WORKERS = 8
+RMTREE_PROGRESS_INTERVAL = 1000
+
+DT_UNKNOWN = 0
+DT_DIR = 4
+
+
+# errnos telling that the session of a CephFS handle is gone
+SESSION_ERRNOS = (errno.ENOTCONN, errno.ESHUTDOWN, errno.EIO, errno.ETIMEDOUT)
+
+def _keep_errno(make_ex):
+    """ Wrap cephfs.make_ex so that the exceptions it creates carry the
+        errno, which the bindings otherwise only put in the message """
+    @functools.wraps(make_ex)
+    def wrapper(ret, msg):
+        exc = make_ex(ret, msg)
+        exc.errno = abs(ret)
+        return exc
+    wrapper.keeps_errno = True
+    return wrapper
+
+if 'cephfs' in globals() and hasattr(cephfs, 'make_ex') and not getattr(cephfs.make_ex, 'keeps_errno', False):
+    # also used for the errors raised inside the bindings
+    cephfs.make_ex = _keep_errno(cephfs.make_ex)
+
+DirEntry = collections.namedtuple('DirEntry', ['name', 'is_dir'])
+FileInfo = collections.namedtuple('FileInfo', ['size', 'etag'])
+
+class _Dirent(ctypes.Structure):
+    """ struct dirent as filled by ceph_readdir_r on Linux """
+    _fields_ = [ ('d_ino', ctypes.c_uint64),
+                 ('d_off', ctypes.c_int64),
+                 ('d_reclen', ctypes.c_ushort),
+                 ('d_type', ctypes.c_ubyte),
+                 ('d_name', ctypes.c_char * 256) ]
 
 class NotFound(Exception):
     """ object not found """
@@ -23,12 +74,398 @@ class NotFound(Exception):
 class ObjectExists(Exception):
     """ object already exists """
 
+class PoolTimeout(Exception):
+    """ no pooled connection became available in time """
+
+class CephFSConnectionPool(object):
+    """ Pool of mounted CephFS handles, shared by all requests in the process.
+
+        Handles are checked out exclusively for the lifetime of a storage
+        object and returned on shutdown. Handles that hit a session error
+        are discarded, and idle handles are health checked before reuse. """
+    def __init__(self, monitors, max_size=CEPH_POOL_MAX_SIZE, timeout=CEPH_POOL_TIMEOUT):
+        self.monitors = str(monitors)
+        self.max_size = max_size
+        self.timeout = timeout
+        self.log = logging.getLogger('storage')
+        self.cv = threading.Condition()
+        self.idle = []
+        self.size = 0
+        self.acquisitions = 0
+        self.reconnects = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _mount(self):
+        """ create and mount a new handle """
+        conn = cephfs.LibCephFS({"mon_host": self.monitors})
+        conn.mount()
+        return conn
+
+    @classmethod
+    def _is_alive(cls, conn):
+        """ check that an idle handle still has a working session """
+        try:
+            conn.stat('/')
+        except cephfs.Error:
+            return False
+        return True
+
+    @classmethod
+    def _unmount(cls, conn):
+        """ shut down a handle, ignoring errors from dead sessions """
+        try:
+            conn.shutdown()
+        except cephfs.Error:
+            pass
+
+    def acquire(self):
+        """ check out a mounted handle, waiting if the pool is exhausted """
+        start = time.time()
+        conn = None
+        last_used = None
+        self.cv.acquire()
+        try:
+            while len(self.idle) == 0 and self.size >= self.max_size:
+                remaining = start + self.timeout - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout('No CephFS connection available for %s' % self.monitors)
+                self.cv.wait(remaining)
+            if len(self.idle) > 0:
+                conn, last_used = self.idle.pop()
+            else:
+                self.size += 1
+            waited = time.time() - start
+            self.acquisitions += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        finally:
+            self.cv.release()
+
+        if waited > 1.0:
+            self.log.warning('Waited %.2fs for a CephFS connection, pool size %d', waited, self.size)
+
+        if conn is not None and time.time() - last_used > CEPH_POOL_IDLE_CHECK_INTERVAL:
+            if not self._is_alive(conn):
+                self.log.info('Dropping stale CephFS connection')
+                self._unmount(conn)
+                conn = None
+                self.cv.acquire()
+                self.reconnects += 1
+                self.cv.release()
+
+        if conn is None:
+            try:
+                conn = self._mount()
+            except:
+                self.cv.acquire()
+                self.size -= 1
+                self.cv.notify()
+                self.cv.release()
+                raise
+        return conn
+
+    def release(self, conn, discard=False):
+        """ return a handle to the pool, or drop it after a session error """
+        if discard:
+            self._unmount(conn)
+        self.cv.acquire()
+        try:
+            if discard:
+                self.size -= 1
+            else:
+                self.idle.append((conn, time.time()))
+            self.cv.notify()
+        finally:
+            self.cv.release()
+
+    def stats(self):
+        """ return pool usage counters """
+        self.cv.acquire()
+        try:
+            return { 'size': self.size,
+                     'idle': len(self.idle),
+                     'in_use': self.size - len(self.idle),
+                     'max_size': self.max_size,
+                     'acquisitions': self.acquisitions,
+                     'reconnects': self.reconnects,
+                     'wait_time_total': self.wait_time,
+                     'wait_time_max': self.max_wait_time }
+        finally:
+            self.cv.release()
+
+_CEPH_POOLS = {}
+_CEPH_POOLS_LOCK = threading.Lock()
+_CEPH_POOL_SETTINGS = { 'max_size': CEPH_POOL_MAX_SIZE,
+                        'timeout': CEPH_POOL_TIMEOUT }
+
+_IO_SETTINGS = { 'write_chunk_size': WRITE_CHUNK_SIZE,
+                 'zero_copy_uploads': True,
+                 'rmtree_workers': RMTREE_WORKERS }
+
+def configure(config):
+    """ apply pool and I/O settings from frontend configuration """
+    _CEPH_POOL_SETTINGS['max_size'] = config.get('ceph_pool_size', CEPH_POOL_MAX_SIZE)
+    _CEPH_POOL_SETTINGS['timeout'] = config.get('ceph_pool_timeout', CEPH_POOL_TIMEOUT)
+    _IO_SETTINGS['write_chunk_size'] = config.get('storage_write_chunk_size', WRITE_CHUNK_SIZE)
+    _IO_SETTINGS['zero_copy_uploads'] = config.get('storage_zero_copy_uploads', True)
+    _IO_SETTINGS['rmtree_workers'] = config.get('storage_rmtree_workers', RMTREE_WORKERS)
+    if backend_name(config) == 'memory':
+        # starts out empty, create what installation does for the others
+        jobs_dir = os.path.join(config.get('data_directory', '/'), 'jobs')
+        with get_storage(config) as store:
+            if not store.isdir(jobs_dir):
+                try:
+                    store.makedirs(jobs_dir)
+                except ObjectExists:
+                    pass
+
+def get_ceph_pool(monitors):
+    """ return the process-wide connection pool for given monitors """
+    monitors = str(monitors)
+    with _CEPH_POOLS_LOCK:
+        ceph_pool = _CEPH_POOLS.get(monitors)
+        if ceph_pool is None:
+            ceph_pool = CephFSConnectionPool(monitors, **_CEPH_POOL_SETTINGS)
+            _CEPH_POOLS[monitors] = ceph_pool
+        return ceph_pool
+
+def read_chunks(ifh, length=None, chunk_size=None):
+    """ Read file object 'ifh' until EOF or 'length' bytes, yielding
+        (buffer, count) pairs. Sources supporting readinto() are read into
+        one reusable bytearray, so consumers must use each chunk before
+        asking for the next one. """
+    if chunk_size is None:
+        chunk_size = _IO_SETTINGS['write_chunk_size']
+    readinto = getattr(ifh, 'readinto', None)
+    buf = view = None
+    if readinto is not None:
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+    copied = 0
+    while length is None or copied < length:
+        read_len = chunk_size
+        if length is not None:
+            read_len = min(read_len, length - copied)
+        if readinto is not None:
+            if read_len < chunk_size:
+                ret = readinto(view[:read_len])
+            else:
+                ret = readinto(buf)
+            if not ret:
+                return
+            yield buf, ret
+        else:
+            data = ifh.read(read_len)
+            if not data:
+                return
+            ret = len(data)
+            yield data, ret
+        copied += ret
+
+_LIBC = {}
+
+def _libc_function(name, argtypes):
+    """ return a libc function, None if libc does not have it """
+    if 'libc' not in _LIBC:
+        try:
+            _LIBC['libc'] = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        except OSError:
+            _LIBC['libc'] = None
+    func = getattr(_LIBC['libc'], name, None)
+    if func is not None:
+        func.argtypes = argtypes
+        func.restype = ctypes.c_ssize_t
+    return func
+
+_OFF_T_P = ctypes.POINTER(ctypes.c_longlong)
+_COPY_FILE_RANGE_ARGTYPES = [ ctypes.c_int, _OFF_T_P, ctypes.c_int, _OFF_T_P, ctypes.c_size_t, ctypes.c_uint ]
+
+# kernel or file system does not support the call for these descriptors
+_UNSUPPORTED_ERRNOS = (errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.EBADF)
+
+def _write_all(fdesc, data):
+    """ write all of data to a file descriptor """
+    view = memoryview(data)
+    while len(view) > 0:
+        view = view[os.write(fdesc, view):]
+
+def _copy_file_range(ifh, out_fd, length):
+    """ Copy up to 'length' bytes from the current position of a regular
+        file to another in the kernel with copy_file_range(), return
+        number of bytes copied, less than 'length' at EOF or if not
+        supported """
+    copy_file_range = _libc_function('copy_file_range', _COPY_FILE_RANGE_ARGTYPES)
+    if copy_file_range is None or not stat.S_ISREG(os.fstat(ifh.fileno()).st_mode):
+        return 0
+    # the position of the file object, not of the descriptor, which
+    # may be ahead because of read buffering
+    offset = ctypes.c_longlong(ifh.tell())
+    copied = 0
+    try:
+        while copied < length:
+            ret = copy_file_range(ifh.fileno(), ctypes.byref(offset), out_fd, None, length - copied, 0)
+            if ret < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err in _UNSUPPORTED_ERRNOS:
+                    break
+                raise IOError(err, os.strerror(err))
+            if ret == 0:
+                break
+            copied += ret
+    finally:
+        ifh.seek(offset.value)
+    return copied
+
+def ingest(fileo, ifh, length):
+    """ Bulk copy 'length' bytes from upload source 'ifh' to local file
+        'fileo' without passing them through Python where possible: copied
+        in the kernel from a regular file, such as a request body spooled
+        by the server, and otherwise read into one large reusable buffer.
+        Returns number of bytes copied, or None if 'ifh' is not a source
+        this handles. """
+    if not _IO_SETTINGS['zero_copy_uploads'] or length is None or not isinstance(fileo, file):
+        return None
+    if not isinstance(ifh, file):
+        return None
+    fileo.flush()
+    out_fd = fileo.fileno()
+    copied = _copy_file_range(ifh, out_fd, length)
+    for buf, buf_len in read_chunks(ifh, length - copied, INGEST_CHUNK_SIZE):
+        _write_all(out_fd, memoryview(buf)[:buf_len])
+        copied += buf_len
+    return copied
+
+def _write_file_atomic(store, path, data):
+    """ write data to a temporary file next to path and rename it over path """
+    tmp_path = '%s.tmp-%s' % (path, uuid.uuid4().hex)
+    try:
+        with store.open(tmp_path, 'wb') as fileo:
+            fileo.write(data)
+        store.rename(tmp_path, path)
+    except:
+        try:
+            store.unlink(tmp_path)
+        except Exception:
+            pass
+        raise
+
+def _timestamp(value):
+    """ return stat time as float seconds, libcephfs may give datetimes """
+    if hasattr(value, 'timetuple'):
+        return time.mktime(value.timetuple()) + value.microsecond / 1000000.0
+    return float(value)
+
+def make_etag(ino, size, mtime):
+    """ return a strong entity tag for file contents identified by inode,
+        size and modification time. Stored files are replaced rather than
+        modified in place, so any change shows up in one of these. """
+    return '%x-%x-%x' % (ino, size, int(_timestamp(mtime) * 1000000))
+
+class FileIter(object):
+    """ Iterate over a storage file in fixed size chunks, for use as a WSGI
+        app_iter. Reads stop after 'length' bytes if given. The file is
+        closed when the server closes the iterator. """
+    def __init__(self, fileo, chunk_size=READ_CHUNK_SIZE, length=None):
+        self.fileo = fileo
+        self.chunk_size = chunk_size
+        self.remaining = length
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """ return the next chunk """
+        read_len = self.chunk_size
+        if self.remaining is not None:
+            read_len = min(read_len, self.remaining)
+            if read_len <= 0:
+                raise StopIteration
+        data = self.fileo.read(read_len)
+        if not data:
+            raise StopIteration
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        return data
+
+    __next__ = next
+
+    def app_iter_range(self, start, stop):
+        """ return iterator over bytes start..stop-1, used by webob when
+            serving Range requests """
+        if start:
+            self.fileo.seek(start)
+        if stop is None:
+            return FileIter(self.fileo, self.chunk_size)
+        return FileIter(self.fileo, self.chunk_size, stop - start)
+
+    def close(self):
+        """ close the underlying file """
+        self.fileo.close()
+
+def use_file_wrapper(request, response):
+    """ Hand a whole local file being downloaded over to wsgi.file_wrapper,
+        which servers implement with sendfile() or other means of sending
+        file contents without copying them through Python. Range requests,
+        HEAD and CephFS files stay with FileIter. """
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    app_iter = response.app_iter
+    if (file_wrapper is None or
+        not isinstance(app_iter, FileIter) or
+        app_iter.remaining is not None or
+        not isinstance(app_iter.fileo, file) or
+        request.method != 'GET' or
+        request.range is not None):
+        return response
+    # setting app_iter drops Content-Length
+    content_length = response.content_length
+    response.app_iter = file_wrapper(app_iter.fileo, FILE_WRAPPER_BLOCK_SIZE)
+    response.content_length = content_length
+    return response
+
+def _is_session_error(exc):
+    """ Tell whether a cephfs error means the session of the handle is gone.
+        Failed operations, e.g. ENOTEMPTY, EINVAL or EACCES, leave the
+        handle usable. """
+    for name in ('IOError', 'LibCephFSStateError'):
+        cls = getattr(cephfs, name, None)
+        if cls is not None and isinstance(exc, cls):
+            return True
+    err = getattr(exc, 'errno', None)
+    if err is not None:
+        return abs(err) in SESSION_ERRNOS
+    return 'not mounted' in str(exc)
+
+def _session_guard(func):
+    """ mark the pooled connection broken if a call fails on session level """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        except cephfs.Error, e:
+            if _is_session_error(e):
+                self.mark_broken()
+            raise
+    return wrapper
+
 class CephFSFile(object):
-    """ Limited file object wrapper around CephFS targets """
-    def __init__(self, monitors):
+    """ Limited file object wrapper around CephFS targets.
+
+        File objects borrow the mounted connection of the CephFSStorage
+        that opened them. The connection stays checked out of the pool
+        until the storage object has been shut down and every file
+        opened through it has been closed, so files may outlive the
+        'with' block of their storage, e.g. when streamed as a response
+        body after the request handler has returned. """
+    def __init__(self, storage, chunk_size=None):
+        self.storage = storage
         self.conn = None
         self.fdesc = None
-        self.monitors = str(monitors)
+        if chunk_size is None:
+            chunk_size = _IO_SETTINGS['write_chunk_size']
+        self.chunk_size = chunk_size
 
     def __del__(self):
         """ destructor """
@@ -44,22 +481,25 @@ class CephFSFile(object):
         return False
 
     def close(self):
-        """ close file object """
-        if self.fdesc:
-            self.conn.close(self.fdesc)
+        """ close file object and release the borrowed connection """
+        if self.fdesc is not None:
+            try:
+                self.conn.close(self.fdesc)
+            except cephfs.Error, e:
+                if _is_session_error(e):
+                    self.mark_broken()
             self.fdesc = None
         if self.conn:
-            self.conn.shutdown()
             self.conn = None
+            self.storage.release()
 
     def open(self, path, mode='r'):
         """ open a file """
-        if self.fdesc:
+        if self.fdesc is not None:
             self.conn.close(self.fdesc)
             self.fdesc = None
         if not self.conn:
-            self.conn = cephfs.LibCephFS({"mon_host": self.monitors})
-            self.conn.mount()
+            self.conn = self.storage.retain()
         if mode in ['r', 'rb']:
             flags = os.O_RDONLY
         elif mode in ['r+', 'r+b']:
@@ -77,33 +517,59 @@ class CephFSFile(object):
             self.fdesc = self.conn.open(str(path), flags, 0644)
         except cephfs.ObjectNotFound:
             raise NotFound
+        except cephfs.Error, e:
+            if _is_session_error(e):
+                self.mark_broken()
+            raise
+
+    def mark_broken(self):
+        """ have the borrowed connection discarded instead of pooled """
+        self.storage.mark_broken()
 
+    def _read_at(self, buf, offset, length):
+        """ read at most 'length' bytes into 'buf' starting at 'offset' """
+        ret = self.conn.libcephfs.ceph_read(self.conn.cluster, self.fdesc, ctypes.byref(buf, offset), ctypes.c_longlong(length), ctypes.c_longlong(-1))
+        if ret < 0:
+            raise cephfs.make_ex(ret, "error in read")
+        return ret
+
+    @_session_guard
+    def readinto(self, buf):
+        """ Fill a bytearray or ctypes buffer, return number of bytes read. """
+        if self.fdesc is None:
+            return 0
+        size = len(buf)
+        if isinstance(buf, bytearray):
+            buf = (ctypes.c_char * size).from_buffer(buf)
+        filled = 0
+        while filled < size:
+            ret = self._read_at(buf, filled, min(size - filled, READ_CHUNK_SIZE))
+            if ret == 0:
+                break
+            filled += ret
+        return filled
+
+    @_session_guard
     def read(self, limit=-1):
         """ Read at most 'limit' bytes. If zero or negative, read until EOF. """
         if self.fdesc is None:
             return ''
-        retbuf = ''
         if limit and limit > 0:
             readbuf = ctypes.create_string_buffer(limit)
-        else:
-            readbuf = ctypes.create_string_buffer(128*1024)
+            return ctypes.string_at(readbuf, self.readinto(readbuf))
+        chunks = []
+        readbuf = ctypes.create_string_buffer(READ_CHUNK_SIZE)
         while True:
-            readlen = 128*1024
-            if limit and limit > 0:
-                if len(retbuf) >= limit:
-                    return retbuf
-                else:
-                    if limit - len(readbuf) < readlen:
-                        readlen = limit - len(retbuf)
-            ret = self.conn.libcephfs.ceph_read(self.conn.cluster, self.fdesc, readbuf, ctypes.c_longlong(readlen), ctypes.c_longlong(-1))
+            ret = self._read_at(readbuf, 0, READ_CHUNK_SIZE)
             if ret == 0:
-                return retbuf
-            elif ret > 0:
-                retbuf += readbuf[0:ret]
-            else:
-                raise cephfs.make_ex(ret, "error in read")
-        return retbuf
+                return ''.join(chunks)
+            chunks.append(ctypes.string_at(readbuf, ret))
 
+    def iter_chunks(self, chunk_size=READ_CHUNK_SIZE, length=None):
+        """ return a WSGI app_iter streaming the rest of the file """
+        return FileIter(self, chunk_size, length)
+
+    @_session_guard
     def seek(self, offset, whence=0):
         """ seek """
         if self.fdesc is None:
@@ -112,28 +578,54 @@ class CephFSFile(object):
         if ret < 0:
             raise cephfs.make_ex(ret, "error in seek")
 
-    def write(self, data):
-        """ write data """
+    @classmethod
+    def _buffer_address(cls, data):
+        """ return address of the bytes in a str, bytearray or ctypes buffer """
+        if isinstance(data, bytearray):
+            return ctypes.addressof((ctypes.c_char * len(data)).from_buffer(data))
+        if isinstance(data, ctypes.Array):
+            return ctypes.addressof(data)
+        return ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value
+
+    @_session_guard
+    def write(self, data, length=None):
+        """ Write the first 'length' bytes of data, all of it by default. Data
+            is handed to libcephfs in place, without slicing copies. """
         if self.fdesc is None:
             return
+        if length is None:
+            length = len(data)
+        base = self._buffer_address(data)
+        chunk_size = self.chunk_size
         offset = 0
-        total = len(data)
-        while offset < total:
-            datalen = len(data) - offset
-            if datalen > 128*1024:
-                datalen = 128*1024
-            ret = self.conn.libcephfs.ceph_write(self.conn.cluster, self.fdesc, ctypes.c_char_p(data[offset:offset+datalen]), ctypes.c_longlong(datalen), ctypes.c_longlong(-1))
+        while offset < length:
+            datalen = min(length - offset, chunk_size)
+            ret = self.conn.libcephfs.ceph_write(self.conn.cluster, self.fdesc, ctypes.c_void_p(base + offset), ctypes.c_longlong(datalen), ctypes.c_longlong(-1))
 
             if ret >= 0:
                 offset += ret
             else:
                 raise cephfs.make_ex(ret, "error in write")
 
+    def write_from(self, ifh, length=None):
+        """ Copy from file object 'ifh' until EOF or 'length' bytes,
+            return number of bytes copied """
+        copied = 0
+        for buf, buf_len in read_chunks(ifh, length, self.chunk_size):
+            self.write(buf, buf_len)
+            copied += buf_len
+        return copied
+
 class CephFSStorage(object):
     """ Wrapper around cephfs bindings with some additional functionality """
     def __init__(self, monitors):
         self.monitors = str(monitors)
+        self.pool = get_ceph_pool(self.monitors)
         self.conn = None
+        self.broken = False
+        self.connected = False
+        self.users = 0
+        self.lock = threading.Lock()
 
     def __del__(self):
         """ destructor """
@@ -150,11 +642,35 @@ class CephFSStorage(object):
         return False
 
     def connect(self):
-        """ connect to Ceph cluster """
-        if self.conn is None:
-            self.conn = cephfs.LibCephFS({"mon_host": self.monitors})
-            self.conn.mount()
+        """ check out a mounted connection from the pool """
+        if not self.connected:
+            self.retain()
+            self.connected = True
+
+    def retain(self):
+        """ take a reference on the connection, checking it out if needed """
+        with self.lock:
+            if self.conn is None:
+                self.conn = self.pool.acquire()
+                self.broken = False
+            self.users += 1
+            return self.conn
 
+    def mark_broken(self):
+        """ have the connection discarded instead of pooled on release """
+        self.broken = True
+
+    def release(self):
+        """ drop a reference, returning the connection to the pool on last use """
+        with self.lock:
+            self.users -= 1
+            if self.users > 0 or self.conn is None:
+                return
+            conn = self.conn
+            self.conn = None
+        self.pool.release(conn, discard=self.broken)
+
+    @_session_guard
     def exists(self, path):
         """ check whether path exists """
         try:
@@ -163,6 +679,7 @@ class CephFSStorage(object):
             return False
         return True
 
+    @_session_guard
     def getsize(self, path):
         """ get size of a file """
         try:
@@ -171,6 +688,7 @@ class CephFSStorage(object):
             raise NotFound
         return res['st_size']
 
+    @_session_guard
     def isdir(self, path):
         """ check whether path exists and is a directory """
         try:
@@ -179,6 +697,7 @@ class CephFSStorage(object):
             return False
         return stat.S_ISDIR(res['st_mode'])
 
+    @_session_guard
     def isfile(self, path):
         """ check whether path exists and is a regular file """
         try:
@@ -187,9 +706,10 @@ class CephFSStorage(object):
             return False
         return stat.S_ISREG(res['st_mode'])
 
-    def listdir(self, path):
-        """ return directory contents, excluding . and .. """
-        entries = []
+    def scandir(self, path):
+        """ Generate DirEntry tuples for directory contents, excluding . and ..
+            Entries are read one at a time with ceph_readdir_r until the end
+            of the directory, types come from the dirent where available. """
         dirp = ctypes.c_void_p()
         ret = self.conn.libcephfs.ceph_opendir(self.conn.cluster,
                                                str(path),
@@ -197,32 +717,42 @@ class CephFSStorage(object):
         if ret < 0:
             if ret == -errno.ENOENT:
                 raise NotFound
+            if -ret in SESSION_ERRNOS:
+                self.mark_broken()
             raise cephfs.make_ex(ret, "error in opendir: %s" % path)
 
-        buf = ctypes.create_string_buffer(1024)
-        ret = self.conn.libcephfs.ceph_getdnames(self.conn.cluster,
-                                                 dirp,
-                                                 buf,
-                                                 ctypes.c_int(1024))
-        if ret < 0:
-            raise cephfs.make_ex(ret, "error in getdnames: %s" % path)
-
-        start = 0
-        offset = 0
-        while offset < ret:
-            if buf[offset] == '\0' or offset == ret:
-                fname = buf[start:offset]
-                if fname != '.' and fname != '..':
-                    entries.append(fname)
-                start = offset + 1
-            offset += 1
-
-        ret = self.conn.libcephfs.ceph_closedir(self.conn.cluster, dirp)
-        if ret < 0:
-            raise cephfs.make_ex(ret, "error in closedir: %s" % path)
+        try:
+            dirent = _Dirent()
+            while True:
+                ret = self.conn.libcephfs.ceph_readdir_r(self.conn.cluster,
+                                                         dirp,
+                                                         ctypes.byref(dirent))
+                if ret == 0:
+                    break
+                if ret < 0:
+                    if -ret in SESSION_ERRNOS:
+                        self.mark_broken()
+                    raise cephfs.make_ex(ret, "error in readdir: %s" % path)
+                fname = dirent.d_name
+                if fname == '.' or fname == '..':
+                    continue
+                if dirent.d_type == DT_UNKNOWN:
+                    is_dir = self.isdir(os.path.join(path, fname))
+                else:
+                    is_dir = dirent.d_type == DT_DIR
+                yield DirEntry(fname, is_dir)
+        finally:
+            ret = self.conn.libcephfs.ceph_closedir(self.conn.cluster, dirp)
+            if ret < 0:
+                if -ret in SESSION_ERRNOS:
+                    self.mark_broken()
+                raise cephfs.make_ex(ret, "error in closedir: %s" % path)
 
-        return entries
+    def listdir(self, path):
+        """ return directory contents, excluding . and .. """
+        return [ entry.name for entry in self.scandir(path) ]
 
+    @_session_guard
     def mkdir(self, path, mode=0755):
         """ create directory """
         try:
@@ -247,10 +777,21 @@ class CephFSStorage(object):
 
     def open(self, path, mode='r'):
         """ open file """
-        fileo = CephFSFile(self.monitors)
-        fileo.open(path, mode)
+        fileo = CephFSFile(self)
+        try:
+            fileo.open(path, mode)
+        except:
+            fileo.close()
+            raise
         return fileo
 
+    @classmethod
+    def write_from(cls, fileo, ifh, length=None):
+        """ Copy from file object 'ifh' into an open storage file until EOF
+            or 'length' bytes, return number of bytes copied """
+        return fileo.write_from(ifh, length)
+
+    @_session_guard
     def unlink(self, path):
         """ unlink a file """
         try:
@@ -258,6 +799,40 @@ class CephFSStorage(object):
         except cephfs.ObjectNotFound:
             raise NotFound
 
+    @_session_guard
+    def rename(self, src, dst):
+        """ rename a file, atomically replacing dst if it exists """
+        ret = self.conn.libcephfs.ceph_rename(self.conn.cluster, str(src), str(dst))
+        if ret < 0:
+            if ret == -errno.ENOENT:
+                raise NotFound
+            raise cephfs.make_ex(ret, "error in rename: %s" % src)
+
+    @_session_guard
+    def link(self, src, dst):
+        """ create hard link dst to file src """
+        ret = self.conn.libcephfs.ceph_link(self.conn.cluster, str(src), str(dst))
+        if ret < 0:
+            if ret == -errno.ENOENT:
+                raise NotFound
+            if ret == -errno.EEXIST:
+                raise ObjectExists
+            raise cephfs.make_ex(ret, "error in link: %s" % src)
+
+    @_session_guard
+    def getnlink(self, path):
+        """ get number of hard links to a file """
+        try:
+            res = self.conn.stat(str(path))
+        except cephfs.ObjectNotFound:
+            raise NotFound
+        return res['st_nlink']
+
+    def write_file(self, path, data):
+        """ replace file contents atomically, readers see old or new data """
+        _write_file_atomic(self, path, data)
+
+    @_session_guard
     def rmdir(self, path):
         """ delete directory """
         ret = self.conn.libcephfs.ceph_rmdir(self.conn.cluster, str(path))
@@ -266,23 +841,17 @@ class CephFSStorage(object):
                 raise NotFound
             raise cephfs.make_ex(ret, "error in rmdir: %s" % path)
 
-    def rmtree(self, path):
-        """ delete a directory and its contents """
-        items = self.listdir(path)
-        for item in items:
-            full_path = os.path.join(path, item)
-            if self.isdir(full_path):
-                self.rmtree(full_path)
-            else:
-                self.unlink(full_path)
-        self.rmdir(path)
+    def rmtree(self, path, progress=None):
+        """ delete a directory and its contents in parallel, see remove_tree() """
+        remove_tree(self, path, progress=progress)
 
     def shutdown(self):
-        """ close Ceph session """
-        if self.conn:
-            self.conn.shutdown()
-            self.conn = None
+        """ release our connection reference, open files keep it checked out """
+        if self.connected:
+            self.connected = False
+            self.release()
 
+    @_session_guard
     def stat(self, path):
         """ stat a path """
         try:
@@ -290,6 +859,15 @@ class CephFSStorage(object):
         except cephfs.ObjectNotFound:
             raise NotFound
 
+    @_session_guard
+    def getinfo(self, path):
+        """ get size and entity tag of a file """
+        try:
+            res = self.conn.stat(str(path))
+        except cephfs.ObjectNotFound:
+            raise NotFound
+        return FileInfo(res['st_size'], make_etag(res['st_ino'], res['st_size'], res['st_mtime']))
+
 class LocalFSStorage(object):
     """ storage abstraction for local filesystem """
     def __init__(self):
@@ -343,6 +921,18 @@ class LocalFSStorage(object):
                 raise NotFound
             raise
 
+    @classmethod
+    def scandir(cls, path):
+        """ Generate DirEntry tuples for directory contents, excluding . and .. """
+        for fname in cls.listdir(path):
+            try:
+                is_dir = stat.S_ISDIR(os.lstat(os.path.join(path, fname)).st_mode)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            yield DirEntry(fname, is_dir)
+
     @classmethod
     def mkdir(cls, path, mode=0755):
         """ create directory """
@@ -351,12 +941,19 @@ class LocalFSStorage(object):
         except OSError, e:
             if e.errno == errno.ENOENT:
                 raise NotFound
+            if e.errno == errno.EEXIST:
+                raise ObjectExists
             raise
 
     @classmethod
     def makedirs(cls, path, mode=0755):
         """ create directory, with intermediary directories if missing """
-        os.makedirs(path, mode)
+        try:
+            os.makedirs(path, mode)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                raise ObjectExists
+            raise
 
     @classmethod
     def open(cls, path, mode='r'):
@@ -368,6 +965,19 @@ class LocalFSStorage(object):
                 raise NotFound
             raise
 
+    @classmethod
+    def write_from(cls, fileo, ifh, length=None):
+        """ Copy from file object 'ifh' into an open storage file until EOF
+            or 'length' bytes, return number of bytes copied """
+        copied = ingest(fileo, ifh, length)
+        if copied is not None:
+            return copied
+        copied = 0
+        for buf, buf_len in read_chunks(ifh, length):
+            fileo.write(buffer(buf, 0, buf_len))
+            copied += buf_len
+        return copied
+
     @classmethod
     def unlink(cls, path):
         """ unlink a file """
@@ -378,6 +988,38 @@ class LocalFSStorage(object):
                 raise NotFound
             raise
 
+    @classmethod
+    def rename(cls, src, dst):
+        """ rename a file, atomically replacing dst if it exists """
+        try:
+            os.rename(src, dst)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                raise NotFound
+            raise
+
+    @classmethod
+    def link(cls, src, dst):
+        """ create hard link dst to file src """
+        try:
+            os.link(src, dst)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                raise NotFound
+            if e.errno == errno.EEXIST:
+                raise ObjectExists
+            raise
+
+    @classmethod
+    def getnlink(cls, path):
+        """ get number of hard links to a file """
+        return cls.stat(path).st_nlink
+
+    @classmethod
+    def write_file(cls, path, data):
+        """ replace file contents atomically, readers see old or new data """
+        _write_file_atomic(cls, path, data)
+
     @classmethod
     def rmdir(cls, path):
         """ delete directory """
@@ -389,8 +1031,12 @@ class LocalFSStorage(object):
             raise
 
     @classmethod
-    def rmtree(cls, path):
-        """ delete a directory and its contents """
+    def rmtree(cls, path, progress=None):
+        """ delete a directory and its contents, with remove_tree() if
+            progress is to be reported """
+        if progress is not None:
+            remove_tree(cls, path, progress=progress)
+            return
         try:
             shutil.rmtree(path)
         except OSError, e:
@@ -413,3 +1059,453 @@ class LocalFSStorage(object):
                 raise NotFound
             raise
 
+    @classmethod
+    def getinfo(cls, path):
+        """ get size and entity tag of a file """
+        res = cls.stat(path)
+        return FileInfo(res.st_size, make_etag(res.st_ino, res.st_size, res.st_mtime))
+
+
+class _MemoryInode(object):
+    """ contents of an in-memory file, shared by its hard links """
+    def __init__(self, ino):
+        self.ino = ino
+        self.data = bytearray()
+        self.nlink = 0
+        self.mtime = time.time()
+
+class MemoryTree(object):
+    """ process-wide in-memory file system used by MemoryStorage. One lock
+        guards the whole tree, including file contents. """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.dirs = { '/': set() }
+        self.files = {}
+        self.next_ino = 1
+
+    def new_inode(self):
+        """ allocate a new file, with the lock held """
+        inode = _MemoryInode(self.next_ino)
+        self.next_ino += 1
+        return inode
+
+class MemoryFile(object):
+    """ file object on a MemoryTree """
+    def __init__(self, tree, inode, mode):
+        self.tree = tree
+        self.inode = inode
+        self.readable = 'r' in mode or '+' in mode
+        self.writable = 'r' not in mode or '+' in mode
+        self.append = 'a' in mode
+        self.pos = 0
+        self.closed = False
+
+    def __enter__(self):
+        """ enter hook for with statements """
+        return self
+
+    def __exit__(self, _type, _value, _traceback):
+        """ exit hook for with statements """
+        self.close()
+        return False
+
+    def read(self, limit=-1):
+        """ Read at most 'limit' bytes. If negative, read until EOF. """
+        if not self.readable:
+            raise IOError(errno.EBADF, 'File not open for reading')
+        with self.tree.lock:
+            end = len(self.inode.data)
+            if limit is not None and limit >= 0:
+                end = min(end, self.pos + limit)
+            data = str(self.inode.data[self.pos:end])
+        self.pos += len(data)
+        return data
+
+    def readinto(self, buf):
+        """ read into a writable buffer """
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        """ write data """
+        if not self.writable:
+            raise IOError(errno.EBADF, 'File not open for writing')
+        data = memoryview(data).tobytes()
+        with self.tree.lock:
+            if self.append:
+                self.pos = len(self.inode.data)
+            if self.pos > len(self.inode.data):
+                self.inode.data.extend('\0' * (self.pos - len(self.inode.data)))
+            self.inode.data[self.pos:self.pos + len(data)] = data
+            self.inode.mtime = time.time()
+        self.pos += len(data)
+
+    def write_from(self, ifh, length=None):
+        """ Copy from file object 'ifh' until EOF or 'length' bytes,
+            return number of bytes copied """
+        copied = 0
+        for buf, buf_len in read_chunks(ifh, length):
+            self.write(buffer(buf, 0, buf_len))
+            copied += buf_len
+        return copied
+
+    def seek(self, offset, whence=0):
+        """ seek """
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            with self.tree.lock:
+                offset += len(self.inode.data)
+        self.pos = max(offset, 0)
+
+    def tell(self):
+        """ tell """
+        return self.pos
+
+    def flush(self):
+        """ flush, noop for memory files """
+        pass
+
+    def close(self):
+        """ close file """
+        self.closed = True
+
+_MEMORY_TREE = MemoryTree()
+
+class MemoryStorage(object):
+    """ Thread-safe in-memory storage, for tests and for benchmarking the
+        frontend without disk or CephFS latency. All instances share one
+        tree, which is lost when the process exits. """
+    def __init__(self, tree=None):
+        self.tree = tree or _MEMORY_TREE
+
+    def __enter__(self):
+        """ enter hook for with statements """
+        return self
+
+    def __exit__(self, _type, _value, _traceback):
+        """ exit hook for with statements """
+        return False
+
+    @classmethod
+    def _norm(cls, path):
+        """ return normalized absolute path """
+        return os.path.normpath(os.path.join('/', path))
+
+    def _parent(self, path):
+        """ return children of the parent directory of a path, raise
+            NotFound if it does not exist. Called with the lock held. """
+        parent = self.tree.dirs.get(os.path.dirname(path))
+        if parent is None:
+            raise NotFound
+        return parent
+
+    def _inode(self, path):
+        """ return inode of a file, with the lock held """
+        inode = self.tree.files.get(self._norm(path))
+        if inode is None:
+            raise NotFound
+        return inode
+
+    def connect(self):
+        """ connect to storage, noop for memory storage """
+        pass
+
+    def shutdown(self):
+        """ shutdown, noop for memory storage """
+        pass
+
+    def exists(self, path):
+        """ check whether path exists """
+        path = self._norm(path)
+        with self.tree.lock:
+            return path in self.tree.dirs or path in self.tree.files
+
+    def getsize(self, path):
+        """ get size of a file """
+        with self.tree.lock:
+            return len(self._inode(path).data)
+
+    def getinfo(self, path):
+        """ get size and entity tag of a file """
+        with self.tree.lock:
+            inode = self._inode(path)
+            return FileInfo(len(inode.data), make_etag(inode.ino, len(inode.data), inode.mtime))
+
+    def getnlink(self, path):
+        """ get number of hard links to a file """
+        with self.tree.lock:
+            return self._inode(path).nlink
+
+    def isdir(self, path):
+        """ check whether path exists and is a directory """
+        with self.tree.lock:
+            return self._norm(path) in self.tree.dirs
+
+    def isfile(self, path):
+        """ check whether path exists and is a regular file """
+        with self.tree.lock:
+            return self._norm(path) in self.tree.files
+
+    def listdir(self, path):
+        """ return directory contents, excluding . and .. """
+        with self.tree.lock:
+            children = self.tree.dirs.get(self._norm(path))
+            if children is None:
+                raise NotFound
+            return list(children)
+
+    def scandir(self, path):
+        """ Generate DirEntry tuples for directory contents, excluding . and .. """
+        path = self._norm(path)
+        with self.tree.lock:
+            children = self.tree.dirs.get(path)
+            if children is None:
+                raise NotFound
+            entries = [ DirEntry(name, os.path.join(path, name) in self.tree.dirs) for name in children ]
+        return iter(entries)
+
+    def mkdir(self, path, mode=0755):
+        """ create directory """
+        path = self._norm(path)
+        with self.tree.lock:
+            parent = self._parent(path)
+            if path in self.tree.dirs or path in self.tree.files:
+                raise ObjectExists
+            self.tree.dirs[path] = set()
+            parent.add(os.path.basename(path))
+
+    def makedirs(self, path, mode=0755):
+        """ create directory, with intermediary directories if missing """
+        path = self._norm(path)
+        with self.tree.lock:
+            if path in self.tree.dirs or path in self.tree.files:
+                raise ObjectExists
+            if os.path.dirname(path) not in self.tree.dirs:
+                self.makedirs(os.path.dirname(path), mode)
+            self.mkdir(path, mode)
+
+    def open(self, path, mode='r'):
+        """ open file """
+        path = self._norm(path)
+        with self.tree.lock:
+            inode = self.tree.files.get(path)
+            if inode is None:
+                if mode.startswith('r'):
+                    raise NotFound
+                if path in self.tree.dirs:
+                    raise IOError(errno.EISDIR, 'Is a directory: %s' % path)
+                parent = self._parent(path)
+                inode = self.tree.new_inode()
+                inode.nlink = 1
+                self.tree.files[path] = inode
+                parent.add(os.path.basename(path))
+            elif mode.startswith('w'):
+                del inode.data[:]
+                inode.mtime = time.time()
+            return MemoryFile(self.tree, inode, mode)
+
+    @classmethod
+    def write_from(cls, fileo, ifh, length=None):
+        """ Copy from file object 'ifh' into an open storage file until EOF
+            or 'length' bytes, return number of bytes copied """
+        return fileo.write_from(ifh, length)
+
+    def write_file(self, path, data):
+        """ replace file contents atomically, readers see old or new data """
+        _write_file_atomic(self, path, data)
+
+    def _remove_entry(self, path):
+        """ remove a directory entry, with the lock held """
+        self.tree.dirs[os.path.dirname(path)].discard(os.path.basename(path))
+
+    def unlink(self, path):
+        """ unlink a file """
+        path = self._norm(path)
+        with self.tree.lock:
+            inode = self._inode(path)
+            del self.tree.files[path]
+            inode.nlink -= 1
+            self._remove_entry(path)
+
+    def _rename_dir(self, src, dst):
+        """ move a directory tree, with the lock held """
+        parent = self._parent(dst)
+        if dst in self.tree.dirs or dst in self.tree.files:
+            raise OSError(errno.EEXIST, 'File exists: %s' % dst)
+        if dst.startswith(src + '/'):
+            raise OSError(errno.EINVAL, 'Invalid argument: %s' % dst)
+        for table in (self.tree.dirs, self.tree.files):
+            for path in [ path for path in table if path == src or path.startswith(src + '/') ]:
+                table[dst + path[len(src):]] = table.pop(path)
+        parent.add(os.path.basename(dst))
+        self._remove_entry(src)
+
+    def rename(self, src, dst):
+        """ rename a file or a directory, atomically replacing dst if it
+            is a file """
+        src = self._norm(src)
+        dst = self._norm(dst)
+        with self.tree.lock:
+            if src in self.tree.dirs:
+                self._rename_dir(src, dst)
+                return
+            inode = self._inode(src)
+            parent = self._parent(dst)
+            if dst in self.tree.dirs:
+                raise OSError(errno.EISDIR, 'Is a directory: %s' % dst)
+            if src == dst:
+                return
+            if dst in self.tree.files:
+                self.tree.files[dst].nlink -= 1
+            self.tree.files[dst] = inode
+            parent.add(os.path.basename(dst))
+            del self.tree.files[src]
+            self._remove_entry(src)
+
+    def link(self, src, dst):
+        """ create hard link dst to file src """
+        src = self._norm(src)
+        dst = self._norm(dst)
+        with self.tree.lock:
+            inode = self._inode(src)
+            parent = self._parent(dst)
+            if dst in self.tree.files or dst in self.tree.dirs:
+                raise ObjectExists
+            inode.nlink += 1
+            self.tree.files[dst] = inode
+            parent.add(os.path.basename(dst))
+
+    def rmdir(self, path):
+        """ delete directory """
+        path = self._norm(path)
+        with self.tree.lock:
+            children = self.tree.dirs.get(path)
+            if children is None:
+                raise NotFound
+            if children:
+                raise OSError(errno.ENOTEMPTY, 'Directory not empty: %s' % path)
+            del self.tree.dirs[path]
+            self._remove_entry(path)
+
+    def _rmtree(self, path):
+        """ delete a directory and its contents, with the lock held.
+            Returns numbers of files and directories removed. """
+        children = self.tree.dirs.get(path)
+        if children is None:
+            raise NotFound
+        files, dirs = 0, 1
+        for name in list(children):
+            child = os.path.join(path, name)
+            if child in self.tree.dirs:
+                child_files, child_dirs = self._rmtree(child)
+                files += child_files
+                dirs += child_dirs
+            else:
+                self.unlink(child)
+                files += 1
+        self.rmdir(path)
+        return files, dirs
+
+    def rmtree(self, path, progress=None):
+        """ delete a directory and its contents """
+        with self.tree.lock:
+            files, dirs = self._rmtree(self._norm(path))
+        if progress is not None:
+            progress(files, dirs)
+
+def remove_tree(store, path, workers=None, progress=None, before_unlink=None):
+    """ Delete directory 'path' and its contents from 'store' with a
+        bounded pool of threads sharing the store. Directories are read
+        level by level, using the entry types scandir() returns, while the
+        files found on the previous level are unlinked. Directories are
+        removed deepest level first once they are empty. Entries removed
+        by somebody else meanwhile are skipped.
+
+        'progress' is called from the calling thread with the numbers of
+        files and directories removed so far, every
+        RMTREE_PROGRESS_INTERVAL removals and once done. It may block to
+        slow the removal down. 'before_unlink' is called from the removing
+        thread with the path of each file before it is unlinked. Returns
+        the final numbers. """
+    if workers is None:
+        workers = _IO_SETTINGS['rmtree_workers']
+    counts = [ 0, 0 ]
+    reported = [ 0 ]
+
+    def _report(force=False):
+        if progress is not None and (force or sum(counts) - reported[0] >= RMTREE_PROGRESS_INTERVAL):
+            reported[0] = sum(counts)
+            progress(counts[0], counts[1])
+
+    def _process(task):
+        action, entry_path = task
+        try:
+            if action == 'scan':
+                return action, entry_path, list(store.scandir(entry_path))
+            elif action == 'unlink':
+                if before_unlink is not None:
+                    before_unlink(entry_path)
+                store.unlink(entry_path)
+            else:
+                store.rmdir(entry_path)
+        except NotFound:
+            return action, entry_path, None
+        return action, entry_path, True
+
+    levels = []
+    # a missing tree is an error, unlike entries disappearing under it
+    scanned = [ (path, list(store.scandir(path))) ]
+    threads = pool.ThreadPool(max(workers, 1))
+    try:
+        while scanned:
+            levels.append([ dirpath for dirpath, _ in scanned ])
+            tasks = []
+            for dirpath, entries in scanned:
+                for entry in entries:
+                    tasks.append(('scan' if entry.is_dir else 'unlink', os.path.join(dirpath, entry.name)))
+            scanned = []
+            for action, entry_path, result in threads.imap_unordered(_process, tasks):
+                if action == 'scan':
+                    if result is not None:
+                        scanned.append((entry_path, result))
+                elif result:
+                    counts[0] += 1
+                    _report()
+        for dirpaths in reversed(levels):
+            for _, _, result in threads.imap_unordered(_process, [ ('rmdir', dirpath) for dirpath in dirpaths ]):
+                if result:
+                    counts[1] += 1
+                    _report()
+    finally:
+        threads.terminate()
+        threads.join()
+    _report(True)
+    return counts[0], counts[1]
+
+_BACKENDS = {}
+
+def register_backend(name, factory):
+    """ Register a storage backend. 'factory' is called with the frontend
+        configuration and returns a storage object for one request. """
+    _BACKENDS[name] = factory
+
+def backend_name(config):
+    """ return name of the storage backend selected by configuration """
+    name = config.get('storage_backend')
+    if name is None:
+        if config.get('ceph_monitors'):
+            return 'cephfs'
+        return 'localfs'
+    if name not in _BACKENDS:
+        raise ValueError('Unknown storage backend %r' % name)
+    return name
+
+def get_storage(config):
+    """ return a storage object of the configured backend """
+    return _BACKENDS[backend_name(config)](config)
+
+register_backend('localfs', lambda config: LocalFSStorage())
+register_backend('cephfs', lambda config: CephFSStorage(','.join(config['ceph_monitors'])))
+register_backend('memory', lambda config: MemoryStorage())
@@ -10,14 +10,18 @@ try:
 except:
     pass
 import os
+import errno
+import fcntl
 import threading
 import uuid
 import logging
+import time
 
 ZOO_OPEN_ACL_UNSAFE = {"perms": 0x1f, "scheme": "world", "id": "anyone"}
 
 SYNC_LOCK_SUCCESS = 0
 SYNC_LOCK_CONNECTION_FAILURE = 1
+SYNC_LOCK_BUSY = 2
 
 class SyncError(Exception):
     def __init__(self, code, message):
@@ -208,6 +212,104 @@ class PhonyLock(object):
     def close(self):
         pass
 
+class FileLock(object):
+    """ Lock on a local file with flock(), released by the kernel if the
+        holder dies. Only synchronizes processes of a single host. """
+    def __init__(self, path):
+        self.path = path
+        self.fdesc = None
+
+    def try_lock(self):
+        while True:
+            fdesc = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                fcntl.flock(fdesc, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                os.close(fdesc)
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return False
+                raise
+            # the previous holder removes the file on unlock, retry unless
+            # we locked the file that is there now
+            try:
+                current = os.stat(self.path).st_ino
+            except OSError:
+                current = None
+            if current == os.fstat(fdesc).st_ino:
+                self.fdesc = fdesc
+                return True
+            os.close(fdesc)
+
+    def unlock(self):
+        if self.fdesc is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            os.close(self.fdesc)
+            self.fdesc = None
+
+    def close(self):
+        self.unlock()
+
+def acquire_lock(zknodes, lockname, attempts=10, interval=0.1):
+    """ Take a lock for a short critical section, retrying while it is busy.
+        Returns the lock object, or None if it could not be taken. """
+    log = logging.getLogger('sync')
+    for attempt in range(attempts):
+        if zknodes:
+            try:
+                lock = ZooKeeperLock(zknodes, lockname)
+            except SyncError:
+                log.exception('Failed to create lock %s', lockname)
+                return None
+        else:
+            lock = PhonyLock(lockname)
+        if lock.try_lock() == True:
+            return lock
+        lock.close()
+        if attempt < attempts - 1:
+            time.sleep(interval)
+    return None
+
+class EventNotifier(object):
+    """ In-process notification of named events for long-polling requests.
+        Only waiters in the same process are woken up, so waiters should
+        also poll shared state periodically. """
+    def __init__(self):
+        self.cv = threading.Condition()
+        self.waiters = {}
+
+    def wait(self, name, timeout):
+        """ Wait for an event, return True if notified before timeout """
+        deadline = time.time() + timeout
+        self.cv.acquire()
+        try:
+            entry = self.waiters.setdefault(name, {'waiting': 0, 'generation': 0})
+            entry['waiting'] += 1
+            generation = entry['generation']
+            remaining = timeout
+            while entry['generation'] == generation and remaining > 0:
+                self.cv.wait(remaining)
+                remaining = deadline - time.time()
+            entry['waiting'] -= 1
+            if entry['waiting'] == 0:
+                del self.waiters[name]
+            return entry['generation'] != generation
+        finally:
+            self.cv.release()
+
+    def notify(self, name):
+        """ Wake up all waiters of an event """
+        self.cv.acquire()
+        try:
+            entry = self.waiters.get(name)
+            if entry is not None:
+                entry['generation'] += 1
+                self.cv.notify_all()
+        finally:
+            self.cv.release()
+
 class FSData(object):
     """ Simple data access over filesystem. For development and testing only,
         no syncronization over multiple callers is offered """
@@ -11,12 +11,13 @@ import json
 import logging
 import webob
 
-from distci.frontend import validators, sync, constants
+from distci.frontend import validators, metadata, sync, constants
 
 class Tasks(object):
     def __init__(self, config):
         self.config = config
         self.log = logging.getLogger('tasks')
+        self.metadata = metadata.get_metadata(config)
         self.zknodes = config.get('zookeeper_nodes', [])
         if len(self.zknodes) == 0:
             self.zknodes = None
@@ -55,7 +56,7 @@ class Tasks(object):
         if self.zknodes:
             data_conn = sync.ZooKeeperData(self.zknodes, '/distci/tasks')
         else:
-            data_conn = sync.FSData(self._data_dir())
+            data_conn = self.metadata.connection(self._data_dir())
 
         result = {'tasks': data_conn.list() }
         data_conn.close()
@@ -74,7 +75,7 @@ class Tasks(object):
         if self.zknodes:
             data_conn = sync.ZooKeeperData(self.zknodes, '/distci/tasks')
         else:
-            data_conn = sync.FSData(self._data_dir())
+            data_conn = self.metadata.connection(self._data_dir())
 
         if data_conn.set('/%s' % task_id_candidate, json.dumps(task_description)) == True:
             data_conn.close()
@@ -89,7 +90,7 @@ class Tasks(object):
         if self.zknodes:
             data_conn = sync.ZooKeeperData(self.zknodes, '/distci/tasks')
         else:
-            data_conn = sync.FSData(self._data_dir())
+            data_conn = self.metadata.connection(self._data_dir())
         data_conn.delete('/%s' % task_id)
         data_conn.close()
         return webob.Response(status=204)
@@ -99,7 +100,7 @@ class Tasks(object):
         if self.zknodes:
             data_conn = sync.ZooKeeperData(self.zknodes, '/distci/tasks')
         else:
-            data_conn = sync.FSData(self._data_dir())
+            data_conn = self.metadata.connection(self._data_dir())
 
         task_data = data_conn.get('/%s' % task_id)
         if task_data is None:
@@ -114,7 +115,7 @@ class Tasks(object):
         if self.zknodes:
             data_conn = sync.ZooKeeperData(self.zknodes, '/distci/tasks')
         else:
-            data_conn = sync.FSData(self._data_dir())
+            data_conn = self.metadata.connection(self._data_dir())
 
         task_data = data_conn.get('/%s' % task_id)
         if task_data is None:
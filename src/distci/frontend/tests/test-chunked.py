@@ -0,0 +1,36 @@
+"""
+Test DistCI frontend chunked request decoding
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+import io
+import webob
+
+from distci.frontend import chunked
+
+def _request(body, server_software):
+    request = webob.Request.blank('/', method='PUT', headers={ 'Transfer-Encoding': 'chunked' })
+    request.environ['wsgi.input'] = io.BytesIO(body)
+    request.environ['SERVER_SOFTWARE'] = server_software
+    return request
+
+class TestChunked:
+    def test_01_decode_for_wsgiref(self):
+        request = _request('5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n', 'WSGIServer/0.1 Python/2.7')
+        chunked.decode_request(request, {})
+        assert request.body_file_raw.read() == 'hello world', "Wrong decoded body"
+
+    def test_02_decoded_by_server(self):
+        request = _request('hello world', 'gunicorn/0.14.5')
+        chunked.decode_request(request, {})
+        assert request.body_file_raw.read() == 'hello world', "Body decoded twice"
+
+    def test_03_config_override(self):
+        request = _request('5\r\nhello\r\n0\r\n\r\n', 'gunicorn/0.14.5')
+        chunked.decode_request(request, { 'decode_chunked_requests': True })
+        assert request.body_file_raw.read() == 'hello', "Body not decoded"
+        request = _request('5\r\nhello\r\n0\r\n\r\n', 'WSGIServer/0.1 Python/2.7')
+        chunked.decode_request(request, { 'decode_chunked_requests': False })
+        assert request.body_file_raw.read() == '5\r\nhello\r\n0\r\n\r\n', "Body decoded"
@@ -0,0 +1,96 @@
+"""
+Test DistCI frontend console log storage
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+import tempfile
+import gzip
+import io
+import os
+import shutil
+
+from distci.frontend import console_log, storage
+
+class TestConsoleLog:
+    data_directory = None
+    config = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(cls.data_directory, 'jobs', 'test', '1'))
+        cls.config = { 'data_directory': cls.data_directory,
+                       'console_segment_size': 100 }
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_directory)
+
+    def test_01_append_segments(self):
+        with storage.LocalFSStorage() as store:
+            log = console_log.ConsoleLog(self.config, 'test', '1')
+            for line_number in range(50):
+                log.append(store, 'line %02d\n' % line_number)
+            assert log.size(store) == 400, "Wrong log size"
+        build_dir = os.path.join(self.data_directory, 'jobs', 'test', '1')
+        assert os.path.isfile(os.path.join(build_dir, 'console.0.gz')), "Segment missing"
+        assert os.path.isfile(os.path.join(build_dir, 'console.index')), "Index missing"
+
+    def test_02_read_ranges(self):
+        expected = ''.join([ 'line %02d\n' % line_number for line_number in range(50) ])
+        with storage.LocalFSStorage() as store:
+            log = console_log.ConsoleLog(self.config, 'test', '1')
+            for offset, length, tail in ((None, None, None), (95, 120, None), (390, None, None), (None, None, 15), (500, None, None)):
+                app_iter, read_len, log_len = log.read(store, offset, length, tail)
+                data = ''.join(app_iter)
+                app_iter.close()
+                if tail is not None:
+                    wanted = expected[-tail:]
+                else:
+                    wanted = expected[offset or 0:][:length]
+                assert data == wanted, "Wrong content for %r/%r/%r" % (offset, length, tail)
+                assert read_len == len(wanted), "Wrong read length"
+                assert log_len == len(expected), "Wrong log length"
+
+    def test_03_read_gzip(self):
+        expected = ''.join([ 'line %02d\n' % line_number for line_number in range(50) ])
+        with storage.LocalFSStorage() as store:
+            app_iter, content_len, log_len = console_log.ConsoleLog(self.config, 'test', '1').read_gzip(store)
+            data = ''.join(app_iter)
+        assert content_len == len(data), "Wrong content length"
+        assert log_len == len(expected), "Wrong log length"
+        assert gzip.GzipFile(fileobj=io.BytesIO(data)).read() == expected, "Wrong content"
+
+    def test_04_late_append_to_rotated(self):
+        expected = ''.join([ 'line %02d\n' % line_number for line_number in range(50) ])
+        build_dir = os.path.join(self.data_directory, 'jobs', 'test', '1')
+        rotated = sorted([ name for name in os.listdir(build_dir) if name.endswith('.log') and name != 'console.log' ])
+        assert len(rotated) == 1, "Wrong rotated files %r" % rotated
+        # an append that opened console.log before it was renamed
+        file(os.path.join(build_dir, rotated[0]), 'ab').write('late\n')
+        with storage.LocalFSStorage() as store:
+            log = console_log.ConsoleLog(self.config, 'test', '1')
+            for line_number in range(50, 70):
+                log.append(store, 'line %02d\n' % line_number)
+            app_iter, read_len, log_len = log.read(store)
+            data = ''.join(app_iter)
+        assert log_len == 565, "Wrong log length"
+        assert data.count('late\n') == 1, "Late append lost"
+        assert data.startswith(expected), "Served offsets moved"
+        assert sorted(data.splitlines()) == sorted(expected.splitlines() + [ 'late' ] + [ 'line %02d' % n for n in range(50, 70) ]), "Wrong lines"
+
+    def test_05_read_during_rotation(self):
+        build_dir = os.path.join(self.data_directory, 'jobs', 'test', '1')
+        with storage.LocalFSStorage() as store:
+            log = console_log.ConsoleLog(self.config, 'test', '1')
+            app_iter, _, log_len = log.read(store)
+            expected = ''.join(app_iter)
+            # console.log renamed aside, segment and index not yet written
+            segment_number = len([ name for name in os.listdir(build_dir) if name.endswith('.gz') ])
+            os.rename(os.path.join(build_dir, 'console.log'), os.path.join(build_dir, 'console.%d.log' % segment_number))
+            log.append(store, 'more\n')
+            app_iter, _, log_len = log.read(store, 10)
+            assert ''.join(app_iter) == expected[10:] + 'more\n', "Wrong content during rotation"
+            assert log_len == len(expected) + 5, "Wrong log length during rotation"
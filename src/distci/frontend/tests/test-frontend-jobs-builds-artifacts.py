@@ -9,6 +9,7 @@ from nose.plugins.skip import SkipTest
 from webtest import TestApp, TestRequest
 import json
 import tempfile
+import time
 import os
 import shutil
 
@@ -91,8 +92,55 @@ class TestJobsBuildArtifacts:
         response = self.app.request('/jobs/%s/builds/%s/artifacts/%s' % (self.test_state['job_id'], self.test_state['build_number'], self.test_state['artifact_id']))
         assert response.body == 'test_content_modified', "Wrong data"
 
-    def test_05_delete_artifact(self):
+    def test_05_conditional_get_artifact(self):
+        url = '/jobs/%s/builds/%s/artifacts/%s' % (self.test_state['job_id'], self.test_state['build_number'], self.test_state['artifact_id'])
+        response = self.app.request(url)
+        etag = response.headers['ETag']
+        assert etag.startswith('"'), "ETag is not strong"
+        assert response.headers['Accept-Ranges'] == 'bytes', "Ranges not advertised"
+
+        response = self.app.request(url, headers={'If-None-Match': etag}, status=304)
+        assert response.body == '', "Body sent with 304"
+
+        response = self.app.request(url, headers={'Range': 'bytes=5-11'}, status=206)
+        assert response.body == 'content', "Wrong range data"
+        assert response.headers['Content-Range'] == 'bytes 5-11/21', "Wrong Content-Range"
+
+        response = self.app.request(url, headers={'Range': 'bytes=13-', 'If-Range': etag}, status=206)
+        assert response.body == 'modified', "Wrong resumed data"
+
+        response = self.app.request(url, headers={'Range': 'bytes=13-', 'If-Range': '"stale"'}, status=200)
+        assert response.body == 'test_content_modified', "Stale If-Range did not return whole file"
+
+    def test_06_delete_artifact(self):
         request = TestRequest.blank('/jobs/%s/builds/%s/artifacts/%s' % (self.test_state['job_id'], self.test_state['build_number'], self.test_state['artifact_id']), content_type='application/octet-stream')
         request.method = 'DELETE'
         _ = self.app.do_request(request, 204, False)
 
+
+    def test_07_deduplicated_storage(self):
+        blobs_dir = os.path.join(self.data_directory, 'blobs')
+        assert [ name for name in os.listdir(blobs_dir) if name != 'tmp' and os.listdir(os.path.join(blobs_dir, name)) ] == [], "Unreferenced blobs left behind"
+
+        artifact_files = []
+        for _ in range(2):
+            request = TestRequest.blank('/jobs/%s/builds/%s/artifacts' % (self.test_state['job_id'], self.test_state['build_number']), content_type='application/octet-stream')
+            request.method = 'POST'
+            request.body = 'shared_content'
+            response = self.app.do_request(request, 201, False)
+            result = json.loads(response.body)
+            artifact_files.append(os.path.join(self.data_directory, 'jobs', self.test_state['job_id'], self.test_state['build_number'], 'artifacts', result['artifact_id']))
+        assert os.stat(artifact_files[0]).st_ino == os.stat(artifact_files[1]).st_ino, "Content stored twice"
+        assert os.stat(artifact_files[0]).st_nlink == 3, "Wrong reference count"
+        assert os.listdir(os.path.join(blobs_dir, 'tmp')) == [], "Temporary upload left behind"
+
+        request = TestRequest.blank('/jobs/%s/builds/%s' % (self.test_state['job_id'], self.test_state['build_number']))
+        request.method = 'DELETE'
+        response = self.app.do_request(request, 202, False)
+        trash_url = '/trash/%s' % json.loads(response.body)['trash_id']
+        for _ in range(100):
+            if self.app.get(trash_url, expect_errors=True).status_int == 404:
+                break
+            time.sleep(0.05)
+        assert self.app.get(trash_url, expect_errors=True).status_int == 404, "Build not reclaimed"
+        assert [ name for name in os.listdir(blobs_dir) if name != 'tmp' and os.listdir(os.path.join(blobs_dir, name)) ] == [], "Blob not collected with build"
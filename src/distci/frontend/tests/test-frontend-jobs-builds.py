@@ -8,6 +8,9 @@ See LICENSE for details
 from nose.plugins.skip import SkipTest
 from webtest import TestApp, TestRequest
 import json
+import gzip
+import tarfile
+import io
 import tempfile
 import os
 import shutil
@@ -16,6 +19,7 @@ import urllib2
 import wsgiref.simple_server
 
 from distci import frontend
+from distci.frontend import jobs_builds, build_index, storage, sync, workspace_manifest
 
 class BackgroundHttpServer:
     def __init__(self, server):
@@ -149,6 +153,12 @@ class TestJobsBuilds:
         response = self.app.request('/jobs/%s/builds/%s/console' % (self.test_state['job_id'], self.test_state['build_number']))
         assert response.body == 'line1\nline2\n', "Wrong content"
 
+        request = urllib2.Request('http://localhost:%d/jobs/%s/builds/%s/console' % (self.server_port, self.test_state['job_id'], self.test_state['build_number']), headers={'Accept-Encoding': 'gzip'})
+        response = urllib2.urlopen(request)
+        assert response.info().getheader('Content-Encoding') == 'gzip', "Log was not compressed"
+        assert response.info().getheader('X-Console-Size') == '12', "Wrong log size"
+        assert gzip.GzipFile(fileobj=io.BytesIO(response.read())).read() == 'line1\nline2\n', "Wrong compressed content"
+
     def test_06_set_workspace(self):
         request = TestRequest.blank('/jobs/%s/builds/%s/workspace' % (self.test_state['job_id'], self.test_state['build_number']), content_type='application/octet-stream')
         request.method = 'PUT'
@@ -167,6 +177,13 @@ class TestJobsBuilds:
 
         response = self.app.request('/jobs/%s/builds/%s/workspace' % (self.test_state['job_id'], self.test_state['build_number']))
         assert response.body == 'updated_test_content', "Wrong data"
+        assert response.headers['X-Workspace-Codec'] == 'gzip', "Wrong codec"
+
+        # codec recorded for the previous archive, not yet for this one
+        codec_file = os.path.join(self.data_directory, 'jobs', self.test_state['job_id'], str(self.test_state['build_number']), 'workspace.codec')
+        file(codec_file, 'wb').write('gzip 0-0-0')
+        response = self.app.request('/jobs/%s/builds/%s/workspace' % (self.test_state['job_id'], self.test_state['build_number']))
+        assert response.headers['X-Workspace-Codec'] == 'none', "Codec of previous archive used"
 
     def test_09_delete_workspace(self):
         request = TestRequest.blank('/jobs/%s/builds/%s/workspace' % (self.test_state['job_id'], self.test_state['build_number']))
@@ -176,7 +193,8 @@ class TestJobsBuilds:
     def test_10_delete_build(self):
         request = TestRequest.blank('/jobs/%s/builds/%s' % (self.test_state['job_id'], self.test_state['build_number']))
         request.method = 'DELETE'
-        _ = self.app.do_request(request, 204, False)
+        _ = self.app.do_request(request, 202, False)
+        _ = self.app.do_request(TestRequest.blank('/jobs/%s/builds/%s' % (self.test_state['job_id'], self.test_state['build_number'])), 404, False)
 
     def test_11_github_webhook(self):
         response = self.app.post('/jobs/%s/github-webhook' % self.test_state['job_id'], {'payload': json.dumps({'ref':'refs/heads/master'})})
@@ -194,3 +212,140 @@ class TestJobsBuilds:
         request.body = json.dumps({'ref': 'refs/heads/wrongbranch'})
         _response = self.app.do_request(request, 400, True)
 
+
+    def test_13_build_numbers_not_reused(self):
+        request = TestRequest.blank('/jobs/%s/builds' % self.test_state['job_id'])
+        request.method = 'POST'
+        response = self.app.do_request(request, 201, False)
+        result = json.loads(response.body)
+        assert result['build_number'] > self.test_state['build_number'], "Build number was reused"
+        self.test_state['build_number'] = result['build_number']
+
+        os.unlink(os.path.join(self.data_directory, 'jobs', self.test_state['job_id'], 'build.counter'))
+        response = self.app.do_request(request, 201, False)
+        result = json.loads(response.body)
+        assert result['build_number'] == self.test_state['build_number'] + 1, "Wrong build number without counter"
+
+        handler = jobs_builds.JobsBuilds({ 'data_directory': self.data_directory })
+        counter_file = os.path.join(self.data_directory, 'jobs', self.test_state['job_id'], 'build.counter')
+        with storage.LocalFSStorage() as store:
+            handler._advance_build_counter(store, self.test_state['job_id'], 1)
+        assert int(file(counter_file, 'rb').read()) == self.test_state['build_number'] + 1, "Build counter moved back"
+
+        def busy(store, job_id, build_number):
+            raise sync.SyncError(sync.SYNC_LOCK_BUSY, 'Job locked')
+        handler._advance_build_counter = busy
+        with storage.LocalFSStorage() as store:
+            build_number = handler._allocate_build_number(store, self.test_state['job_id'])
+        build_dir = os.path.join(self.data_directory, 'jobs', self.test_state['job_id'], build_number)
+        assert int(build_number) == self.test_state['build_number'] + 2, "Wrong build number with busy counter"
+        assert os.path.isdir(build_dir), "Build dropped with busy counter"
+        os.rmdir(build_dir)
+
+    def test_14_get_builds_invalid_query(self):
+        _ = self.app.request('/jobs/%s/builds?limit=x' % self.test_state['job_id'], status=400)
+        _ = self.app.request('/jobs/%s/builds?order=sideways' % self.test_state['job_id'], status=400)
+        response = self.app.request('/jobs/%s/builds?limit=1&order=desc' % self.test_state['job_id'])
+        result = json.loads(response.body)
+        assert result['builds'] == [ self.test_state['build_number'] + 1 ], "Wrong newest build"
+
+    def test_15_build_aliases(self):
+        _ = self.app.request('/jobs/%s/builds/lastSuccessful/state' % self.test_state['job_id'], status=404)
+
+        request = TestRequest.blank('/jobs/%s/builds/%s/state' % (self.test_state['job_id'], self.test_state['build_number']), content_type='application/json')
+        request.method = 'PUT'
+        request.body = json.dumps({"status": "complete", "result": "success"})
+        _ = self.app.do_request(request, 200, False)
+
+        response = self.app.request('/jobs/%s/builds/lastSuccessful/state' % self.test_state['job_id'])
+        result = json.loads(response.body)
+        assert int(result['build_number']) == self.test_state['build_number'], "Wrong build for lastSuccessful"
+        assert result['state']['result'] == 'success', "Wrong state for lastSuccessful"
+
+        response = self.app.request('/jobs/%s/builds/lastBuild' % self.test_state['job_id'])
+        result = json.loads(response.body)
+        assert int(result['build_number']) == self.test_state['build_number'] + 1, "Wrong build for lastBuild"
+
+        request = TestRequest.blank('/jobs/%s/builds/lastBuild' % self.test_state['job_id'])
+        request.method = 'DELETE'
+        _ = self.app.do_request(request, 400, False)
+        request = TestRequest.blank('/jobs/%s/builds/lastSuccessful/state' % self.test_state['job_id'], content_type='application/json')
+        request.method = 'PUT'
+        request.body = json.dumps({"status": "complete", "result": "failure"})
+        _ = self.app.do_request(request, 400, False)
+
+        os.unlink(os.path.join(self.data_directory, 'jobs', self.test_state['job_id'], 'builds.index'))
+        response = self.app.request('/jobs/%s/builds/lastCompleted' % self.test_state['job_id'])
+        result = json.loads(response.body)
+        assert int(result['build_number']) == self.test_state['build_number'], "Wrong build after index rebuild"
+
+        # a state change that could not take the index lock invalidates the
+        # index, the lock holder storing its older copy afterwards must not
+        # hide the change
+        build_number = self.test_state['build_number'] + 1
+        index = build_index.BuildIndex({ 'data_directory': self.data_directory }, self.test_state['job_id'])
+        with storage.LocalFSStorage() as store:
+            generation = index._generation(store)
+            entries = index.load(store)
+            state_file = os.path.join(self.data_directory, 'jobs', self.test_state['job_id'], str(build_number), 'build.state')
+            saved_state = file(state_file, 'rb').read()
+            json.dump({"status": "complete", "result": "failure"}, file(state_file, 'wb'))
+            index.invalidate(store)
+            index._write(store, entries, generation)
+        response = self.app.request('/jobs/%s/builds/lastFailed' % self.test_state['job_id'])
+        result = json.loads(response.body)
+        assert int(result['build_number']) == build_number, "Invalidated change lost"
+        file(state_file, 'wb').write(saved_state)
+        with storage.LocalFSStorage() as store:
+            index.invalidate(store)
+
+    def test_16_console_follow(self):
+        build_number = self.test_state['build_number'] + 1
+        console_url = '/jobs/%s/builds/%d/console' % (self.test_state['job_id'], build_number)
+        request = TestRequest.blank(console_url, content_type='text/plain')
+        request.method = 'POST'
+        request.body = 'line1\n'
+        _ = self.app.do_request(request, 204, False)
+
+        response = self.app.request('%s?since=0' % console_url)
+        assert response.body == 'line1\n', "Wrong content"
+        assert response.headers['X-Build-Complete'] == 'false', "Build reported complete"
+
+        response = self.app.request('%s?since=6&wait=0' % console_url)
+        assert response.body == '', "Unexpected content"
+        assert response.headers['X-Console-Size'] == '6', "Wrong log size"
+
+        def append():
+            request = TestRequest.blank(console_url, content_type='text/plain')
+            request.method = 'POST'
+            request.body = 'line2\n'
+            self.app.do_request(request, 204, False)
+        timer = threading.Timer(0.2, append)
+        timer.start()
+        response = self.app.request('%s?since=6&wait=10' % console_url)
+        timer.join()
+        assert response.body == 'line2\n', "Wrong followed content"
+
+        request = TestRequest.blank('/jobs/%s/builds/%d/state' % (self.test_state['job_id'], build_number), content_type='application/json')
+        request.method = 'PUT'
+        request.body = json.dumps({"status": "complete", "result": "failure"})
+        _ = self.app.do_request(request, 200, False)
+        response = self.app.request('%s?since=12&wait=10' % console_url)
+        assert response.body == '', "Unexpected content"
+        assert response.headers['X-Build-Complete'] == 'true', "Build not reported complete"
+
+    def test_17_workspace_archive_of_outdated_manifest(self):
+        build_id = str(self.test_state['build_number'] + 1)
+        manifest = workspace_manifest.WorkspaceManifest({ 'data_directory': self.data_directory }, self.test_state['job_id'], build_id)
+        add_to_archive = manifest._add_to_archive
+        def save_during_build(store, tarf, entry):
+            # a worker stores a new manifest while the archive is written
+            if entry['path'] == 'old':
+                manifest.save(store, { 'entries': [ { 'path': 'new', 'type': 'dir' } ] })
+            add_to_archive(store, tarf, entry)
+        manifest._add_to_archive = save_during_build
+        with storage.LocalFSStorage() as store:
+            manifest.save(store, { 'entries': [ { 'path': 'old', 'type': 'dir' } ] })
+            manifest.build_archive(store)
+        archive = os.path.join(self.data_directory, 'jobs', self.test_state['job_id'], build_id, 'workspace')
+        assert tarfile.open(archive).getnames() == [ 'new' ], "Archive of outdated manifest served"
@@ -95,7 +95,8 @@ class TestJobs:
             raise SkipTest("Skipping test for single job deletion, no recorded state")
         request = TestRequest.blank('/jobs/%s' % job_id)
         request.method = 'DELETE'
-        response = self.app.do_request(request, 204, False)
+        response = self.app.do_request(request, 202, False)
+        assert json.loads(response.body).has_key('trash_id'), "Trash entry ID went missing"
 
         response = self.app.request('/jobs')
         result = json.loads(response.body)
@@ -0,0 +1,144 @@
+"""
+Test DistCI frontend metadata store
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+from webtest import TestApp, TestRequest
+import json
+import tempfile
+import os
+import shutil
+
+from distci import frontend
+from distci.frontend import metadata, storage
+
+class TestSQLiteMetadata:
+    data_directory = None
+    metadata = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(cls.data_directory, 'jobs'))
+        cls.metadata = metadata.get_metadata({ 'data_directory': cls.data_directory, 'metadata_backend': 'sqlite' })
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_directory)
+
+    def _path(self, *parts):
+        return os.path.join(self.data_directory, 'jobs', *parts)
+
+    def test_01_get_put_delete(self):
+        with storage.LocalFSStorage() as store:
+            assert self.metadata.get(store, self._path('a', 'job.config')) is None, "Missing document found"
+            self.metadata.put(store, self._path('a', 'job.config'), '{"job_id": "a"}')
+            assert self.metadata.get(store, self._path('a', 'job.config')) == '{"job_id": "a"}', "Wrong document"
+            self.metadata.delete(store, self._path('a', 'job.config'))
+            assert self.metadata.get(store, self._path('a', 'job.config')) is None, "Document not deleted"
+        assert not os.path.exists(self._path('a')), "Document written as a file"
+
+    def test_02_update_and_remove_tree(self):
+        with storage.LocalFSStorage() as store:
+            for _ in range(3):
+                self.metadata.update(store, self._path('b', 'build.counter'), lambda data: str(int(data or 0) + 1))
+            assert self.metadata.get(store, self._path('b', 'build.counter')) == '3', "Updates lost"
+            self.metadata.put(store, self._path('b', '1', 'build.state'), '{}')
+            self.metadata.put(store, self._path('b0', 'job.config'), '{}')
+            self.metadata.remove_tree(store, self._path('b'))
+            assert self.metadata.get(store, self._path('b', '1', 'build.state')) is None, "Tree not removed"
+            assert self.metadata.get(store, self._path('b0', 'job.config')) == '{}', "Sibling removed"
+
+    def test_03_import_file(self):
+        os.mkdir(self._path('c'))
+        file(self._path('c', 'job.config'), 'wb').write('{"job_id": "c"}')
+        with storage.LocalFSStorage() as store:
+            assert self.metadata.get(store, self._path('c', 'job.config')) == '{"job_id": "c"}', "File not imported"
+        assert not os.path.exists(self._path('c', 'job.config')), "Imported file left behind"
+
+    def test_04_connection(self):
+        conn = self.metadata.connection(os.path.join(self.data_directory, 'tasks'))
+        assert conn.set('/t1', 'one') == True, "Set failed"
+        assert conn.set('/t1', 'two', 'wrong') == False, "Compare and set ignored previous data"
+        assert conn.set('/t1', 'two', 'one') == True, "Compare and set failed"
+        assert conn.get('/t1') == 'two', "Wrong data"
+        assert conn.list() == [ 't1' ], "Wrong listing"
+        conn.delete('/t1')
+        assert conn.get('/t1') is None, "Not deleted"
+        conn.close()
+
+class TestSQLiteFrontend:
+    app = None
+    data_directory = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(cls.data_directory, 'jobs'))
+        os.mkdir(os.path.join(cls.data_directory, 'tasks'))
+        config = { "data_directory": cls.data_directory,
+                   "metadata_backend": "sqlite" }
+        cls.app = TestApp(frontend.Frontend(config))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.app = None
+        shutil.rmtree(cls.data_directory)
+
+    def test_01_job_and_builds(self):
+        request = TestRequest.blank('/jobs/sqlite_job', content_type='application/json')
+        request.method = 'PUT'
+        request.body = json.dumps({ 'job_id': 'sqlite_job' })
+        self.app.do_request(request, 200, False)
+        assert json.loads(self.app.request('/jobs/sqlite_job').body)['config']['job_id'] == 'sqlite_job', "Wrong job config"
+        for _ in range(2):
+            request = TestRequest.blank('/jobs/sqlite_job/builds')
+            request.method = 'POST'
+            self.app.do_request(request, 201, False)
+        request = TestRequest.blank('/jobs/sqlite_job/builds/2/state', content_type='application/json')
+        request.method = 'PUT'
+        request.body = json.dumps({ 'status': 'complete', 'result': 'success' })
+        self.app.do_request(request, 200, False)
+        assert json.loads(self.app.request('/jobs/sqlite_job/builds/lastSuccessful').body)['build_number'] == '2', "Wrong last successful build"
+        assert json.loads(self.app.request('/jobs/sqlite_job/builds').body)['builds'] == [ 1, 2 ], "Wrong builds"
+        job_dir = os.path.join(self.data_directory, 'jobs', 'sqlite_job')
+        assert sorted(os.listdir(job_dir)) == [ '1', '2' ], "Metadata stored as files"
+
+    def test_02_missing(self):
+        self.app.do_request(TestRequest.blank('/jobs/sqlite_job/builds/3/state'), 404, False)
+        self.app.do_request(TestRequest.blank('/jobs/no_such_job'), 404, False)
+
+    def test_03_delete(self):
+        request = TestRequest.blank('/jobs/sqlite_job/builds/2')
+        request.method = 'DELETE'
+        self.app.do_request(request, 202, False)
+        self.app.do_request(TestRequest.blank('/jobs/sqlite_job/builds/2/state'), 404, False)
+        request = TestRequest.blank('/jobs/sqlite_job')
+        request.method = 'DELETE'
+        self.app.do_request(request, 202, False)
+        self.app.do_request(TestRequest.blank('/jobs/sqlite_job'), 404, False)
+
+    def test_04_tasks(self):
+        request = TestRequest.blank('/tasks', content_type='application/json')
+        request.method = 'POST'
+        request.body = json.dumps({ 'command': 'something' })
+        task_id = json.loads(self.app.do_request(request, 201, False).body)['id']
+        assert json.loads(self.app.request('/tasks').body)['tasks'] == [ task_id ], "Wrong tasks"
+        assert os.listdir(os.path.join(self.data_directory, 'tasks')) == [], "Task stored as a file"
+
+class TestMetadataConfig:
+    def test_01_database_required_with_ceph(self):
+        config = { 'data_directory': '/distci',
+                   'ceph_monitors': [ 'mon1' ],
+                   'metadata_backend': 'sqlite' }
+        try:
+            metadata.get_metadata(config)
+            assert False, "Database path inside CephFS accepted"
+        except ValueError:
+            pass
+        data_directory = tempfile.mkdtemp()
+        config['metadata_database'] = os.path.join(data_directory, 'metadata.db')
+        assert isinstance(metadata.get_metadata(config), metadata.SQLiteMetadata), "Wrong metadata store"
+        shutil.rmtree(data_directory)
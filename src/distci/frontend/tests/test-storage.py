@@ -0,0 +1,277 @@
+"""
+Test DistCI frontend storage abstraction
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+import tempfile
+import io
+import os
+import json
+import shutil
+import socket
+import threading
+import time
+import collections
+import webob
+import wsgiref.util
+
+from distci import frontend
+from distci.frontend import storage
+
+class TestLocalFSStorage:
+    data_directory = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_directory = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_directory)
+
+    def test_01_file_iter(self):
+        path = os.path.join(self.data_directory, 'file_iter')
+        file(path, 'wb').write('0123456789' * 10)
+        with storage.LocalFSStorage() as store:
+            chunks = list(storage.FileIter(store.open(path, 'rb'), chunk_size=30))
+        assert len(chunks) == 4, "Wrong number of chunks"
+        assert ''.join(chunks) == '0123456789' * 10, "Wrong content"
+
+    def test_02_file_iter_length(self):
+        path = os.path.join(self.data_directory, 'file_iter')
+        with storage.LocalFSStorage() as store:
+            fileo = store.open(path, 'rb')
+            fileo.seek(5)
+            app_iter = storage.FileIter(fileo, chunk_size=4, length=10)
+            data = ''.join(app_iter)
+            app_iter.close()
+        assert data == '5678901234', "Wrong content"
+        assert fileo.closed, "File was not closed"
+
+    def test_03_write_from(self):
+        source_path = os.path.join(self.data_directory, 'write_from_source')
+        target_path = os.path.join(self.data_directory, 'write_from_target')
+        file(source_path, 'wb').write('abcdefghij' * 1000)
+        with storage.LocalFSStorage() as store:
+            ifh = open(source_path, 'rb')
+            with store.open(target_path, 'wb') as ofh:
+                written = store.write_from(ofh, ifh, 9995)
+            ifh.close()
+        assert written == 9995, "Wrong length reported"
+        assert file(target_path, 'rb').read() == ('abcdefghij' * 1000)[:9995], "Wrong content"
+
+    def test_04_read_chunks_reuses_buffer(self):
+        source = io.BytesIO('x' * 2500)
+        chunks = [ (buf, buf_len) for buf, buf_len in storage.read_chunks(source, chunk_size=1000) ]
+        assert [ buf_len for _, buf_len in chunks ] == [ 1000, 1000, 500 ], "Wrong chunk sizes"
+        assert chunks[0][0] is chunks[2][0], "Buffer was not reused"
+
+    def test_05_scandir(self):
+        scan_dir = os.path.join(self.data_directory, 'scandir')
+        os.mkdir(scan_dir)
+        os.mkdir(os.path.join(scan_dir, 'subdir'))
+        file(os.path.join(scan_dir, 'file'), 'wb').write('')
+        with storage.LocalFSStorage() as store:
+            entries = dict(store.scandir(scan_dir))
+        assert entries == { 'subdir': True, 'file': False }, "Wrong entries"
+
+    def test_06_write_file(self):
+        path = os.path.join(self.data_directory, 'write_file')
+        with storage.LocalFSStorage() as store:
+            store.write_file(path, 'first')
+            store.write_file(path, 'second')
+        assert file(path, 'rb').read() == 'second', "Wrong content"
+        assert [ name for name in os.listdir(self.data_directory) if name.startswith('write_file') ] == [ 'write_file' ], "Temporary file left behind"
+
+    def test_07_use_file_wrapper(self):
+        path = os.path.join(self.data_directory, 'file_wrapper')
+        file(path, 'wb').write('0123456789')
+        request = webob.Request.blank('/', environ={'wsgi.file_wrapper': wsgiref.util.FileWrapper})
+        response = webob.Response(app_iter=storage.FileIter(open(path, 'rb')), content_length=10)
+        response = storage.use_file_wrapper(request, response)
+        assert isinstance(response.app_iter, wsgiref.util.FileWrapper), "file wrapper not used"
+        assert response.content_length == 10, "Content-Length lost"
+        assert ''.join(response.app_iter) == '0123456789', "Wrong content"
+        response.app_iter.close()
+
+        request.range = 'bytes=2-'
+        response = webob.Response(app_iter=storage.FileIter(open(path, 'rb')), content_length=10)
+        response = storage.use_file_wrapper(request, response)
+        assert isinstance(response.app_iter, storage.FileIter), "file wrapper used for a range"
+        response.app_iter.close()
+
+    def test_08_ingest_from_socket(self):
+        data = os.urandom(3 * storage.INGEST_CHUNK_SIZE + 1000)
+        sender, receiver = socket.socketpair()
+        writer = threading.Thread(target=sender.sendall, args=('header\n' + data + 'next request',))
+        writer.start()
+        rfile = receiver.makefile('rb')
+        assert rfile.readline() == 'header\n', "Wrong header"
+        path = os.path.join(self.data_directory, 'ingest_socket')
+        with storage.LocalFSStorage() as store:
+            with store.open(path, 'wb') as ofh:
+                written = store.write_from(ofh, rfile, len(data))
+        writer.join()
+        sender.close()
+        assert written == len(data), "Wrong length reported"
+        assert file(path, 'rb').read() == data, "Wrong content"
+        assert rfile.read() == 'next request', "Data after the upload was consumed"
+        receiver.close()
+
+    def test_09_ingest_from_file(self):
+        source_path = os.path.join(self.data_directory, 'ingest_source')
+        target_path = os.path.join(self.data_directory, 'ingest_file')
+        file(source_path, 'wb').write('0123456789' * 100000)
+        ifh = open(source_path, 'rb')
+        assert ifh.read(5) == '01234', "Wrong content"
+        with storage.LocalFSStorage() as store:
+            with store.open(target_path, 'wb') as ofh:
+                written = store.write_from(ofh, ifh, 500000)
+        assert written == 500000, "Wrong length reported"
+        assert ifh.read(5) == '56789', "Source position not advanced"
+        ifh.close()
+        assert file(target_path, 'rb').read() == ('0123456789' * 100000)[5:500005], "Wrong content"
+
+class TestMemoryStorage:
+    def test_01_files(self):
+        store = storage.MemoryStorage(storage.MemoryTree())
+        store.makedirs('/data/jobs')
+        assert store.isdir('/data') and store.isdir('/data/jobs'), "Directories not created"
+        with store.open('/data/jobs/a', 'wb') as ofh:
+            ofh.write('0123456789')
+        with store.open('/data/jobs/a', 'ab') as ofh:
+            ofh.write('abc')
+        assert store.getsize('/data/jobs/a') == 13, "Wrong size"
+        with store.open('/data/jobs/a', 'rb') as ifh:
+            assert ifh.read(4) == '0123', "Wrong content"
+            assert ''.join(storage.FileIter(ifh, chunk_size=3)) == '456789abc', "Wrong content"
+        store.write_file('/data/jobs/b', 'replaced')
+        assert sorted(store.listdir('/data/jobs')) == [ 'a', 'b' ], "Wrong directory contents"
+        assert [ entry.is_dir for entry in store.scandir('/data') ] == [ True ], "Wrong directory entries"
+        try:
+            store.open('/data/missing/a', 'wb')
+            assert False, "Opened file in missing directory"
+        except storage.NotFound:
+            pass
+
+    def test_02_links(self):
+        store = storage.MemoryStorage(storage.MemoryTree())
+        store.write_file('/a', 'data')
+        store.link('/a', '/b')
+        assert store.getnlink('/a') == 2, "Wrong link count"
+        assert store.getinfo('/a') == store.getinfo('/b'), "Links differ"
+        store.rename('/b', '/c')
+        assert not store.exists('/b') and store.open('/c').read() == 'data', "Rename failed"
+        store.unlink('/a')
+        assert store.getnlink('/c') == 1, "Wrong link count after unlink"
+        store.makedirs('/d/e')
+        store.write_file('/d/e/f', 'data')
+        try:
+            store.rmdir('/d')
+            assert False, "Removed non-empty directory"
+        except OSError:
+            pass
+        store.rename('/d', '/g')
+        assert store.open('/g/e/f').read() == 'data' and not store.exists('/d/e'), "Directory rename failed"
+        store.rmtree('/g')
+        assert store.listdir('/') == [ 'c' ], "Tree not removed"
+
+    def test_03_concurrent_appends(self):
+        store = storage.MemoryStorage(storage.MemoryTree())
+        def append(char):
+            for _ in range(200):
+                with store.open('/log', 'ab') as ofh:
+                    ofh.write(char * 10)
+        threads = [ threading.Thread(target=append, args=(char,)) for char in 'abcd' ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        data = store.open('/log', 'rb').read()
+        assert len(data) == 8000, "Appends lost"
+        assert all(data[i:i+10] == data[i] * 10 for i in range(0, 8000, 10)), "Appends interleaved"
+
+    def test_04_backend_registry(self):
+        assert isinstance(storage.get_storage({}), storage.LocalFSStorage), "Wrong default backend"
+        assert storage.backend_name({'ceph_monitors': ['mon1']}) == 'cephfs', "Ceph not selected"
+        assert isinstance(storage.get_storage({'storage_backend': 'memory'}), storage.MemoryStorage), "Wrong backend"
+        try:
+            storage.get_storage({'storage_backend': 'tape'})
+            assert False, "Unknown backend accepted"
+        except ValueError:
+            pass
+
+    def test_05_frontend_on_memory(self):
+        config = { 'storage_backend': 'memory', 'data_directory': '/memory-test' }
+        app = frontend.Frontend(config)
+        request = webob.Request.blank('/jobs/memjob', method='PUT', body=json.dumps({'job_id': 'memjob'}))
+        assert request.get_response(app).status_int == 200, "Job not created"
+        response = webob.Request.blank('/jobs/memjob/builds', method='POST').get_response(app)
+        build_number = json.loads(response.body)['build_number']
+        path = '/jobs/memjob/builds/%d/workspace' % build_number
+        request = webob.Request.blank(path, method='PUT', body='workspace data')
+        request.content_type = 'application/octet-stream'
+        assert request.get_response(app).status_int == 204, "Workspace not stored"
+        assert webob.Request.blank(path).get_response(app).body == 'workspace data', "Wrong workspace"
+        assert not os.path.exists('/memory-test'), "Data written to disk"
+        with storage.MemoryStorage() as store:
+            store.rmtree('/memory-test')
+
+class CountingStorage(storage.MemoryStorage):
+    """ memory storage recording calls made by remove_tree """
+    def __init__(self):
+        storage.MemoryStorage.__init__(self, storage.MemoryTree())
+        self.calls = collections.defaultdict(int)
+        self.active = 0
+        self.max_active = 0
+        self.calls_lock = threading.Lock()
+
+    def isdir(self, path):
+        self.calls['isdir'] += 1
+        return storage.MemoryStorage.isdir(self, path)
+
+    def unlink(self, path):
+        with self.calls_lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.001)
+        storage.MemoryStorage.unlink(self, path)
+        with self.calls_lock:
+            self.active -= 1
+
+class TestRemoveTree:
+    def test_01_remove_tree(self):
+        store = CountingStorage()
+        for build in range(20):
+            store.makedirs('/job/%d/artifacts' % build)
+            store.write_file('/job/%d/build.state' % build, '{}')
+            for artifact in range(5):
+                store.write_file('/job/%d/artifacts/%d' % (build, artifact), 'data')
+        progress = []
+        result = storage.remove_tree(store, '/job', workers=4, progress=lambda files, dirs: progress.append((files, dirs)))
+        assert result == (120, 41), "Wrong counts %r" % (result,)
+        assert progress[-1] == (120, 41), "Final progress not reported"
+        assert not store.exists('/job'), "Tree left behind"
+        assert store.calls['isdir'] == 0, "Entry types not taken from scandir"
+        assert store.max_active > 1, "Files not unlinked in parallel"
+
+    def test_02_remove_missing_tree(self):
+        try:
+            storage.remove_tree(storage.MemoryStorage(storage.MemoryTree()), '/missing')
+            assert False, "Missing tree removed"
+        except storage.NotFound:
+            pass
+
+    def test_03_local_progress(self):
+        data_directory = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(data_directory, 'tree', 'a', 'b'))
+            file(os.path.join(data_directory, 'tree', 'a', 'b', 'c'), 'wb').write('data')
+            progress = []
+            storage.LocalFSStorage.rmtree(os.path.join(data_directory, 'tree'), progress=lambda files, dirs: progress.append((files, dirs)))
+            assert progress == [ (1, 3) ], "Wrong progress %r" % progress
+            assert os.listdir(data_directory) == [], "Tree left behind"
+        finally:
+            shutil.rmtree(data_directory)
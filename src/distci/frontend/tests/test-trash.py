@@ -0,0 +1,112 @@
+"""
+Test DistCI frontend trash and background reclamation
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+from webtest import TestApp, TestRequest
+import json
+import tempfile
+import time
+import os
+import shutil
+
+from distci import frontend
+from distci.frontend import trash, storage, sync
+
+class TestTrash:
+    app = None
+    data_directory = None
+    config = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(cls.data_directory, 'jobs'))
+        cls.config = { "data_directory": cls.data_directory,
+                       "trash_reclaim_rate": 200 }
+        cls.app = TestApp(frontend.Frontend(cls.config))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.app = None
+        shutil.rmtree(cls.data_directory)
+
+    def _wait_reclaimed(self, url, timeout=5.0):
+        statuses = []
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            response = self.app.get(url, expect_errors=True)
+            if response.status_int == 404:
+                return statuses
+            statuses.append(json.loads(response.body))
+            time.sleep(0.02)
+        assert False, "Trash entry not reclaimed"
+
+    def test_01_empty(self):
+        assert trash.get_reclaimer(self.config).thread is None, "Reclaimer started before use"
+        result = json.loads(self.app.request('/trash').body)
+        assert result['entries'] == [], "Trash not empty"
+        assert result['reclaim_rate'] == 200, "Wrong reclaim rate"
+        self.app.do_request(TestRequest.blank('/trash/invalid'), 400, False)
+        self.app.do_request(TestRequest.blank('/trash/00000000-0000-0000-0000-000000000000'), 404, False)
+
+    def test_02_rate_limited_reclamation(self):
+        job_dir = os.path.join(self.data_directory, 'jobs', 'big')
+        os.makedirs(os.path.join(job_dir, '1', 'artifacts'))
+        for i in range(100):
+            file(os.path.join(job_dir, '1', 'artifacts', str(i)), 'wb').write('data')
+        start = time.time()
+        with storage.LocalFSStorage() as store:
+            trash_id = trash.move_to_trash(self.config, store, job_dir, {'job_id': 'big'})
+        assert not os.path.exists(job_dir), "Job not moved to trash"
+        statuses = self._wait_reclaimed('/trash/%s' % trash_id)
+        assert time.time() - start >= 0.4, "Reclamation rate not limited"
+        assert statuses and statuses[0]['job_id'] == 'big', "Wrong trash entry description"
+        assert 'reclaiming' in [ status['status'] for status in statuses ], "Reclamation progress not reported"
+        assert os.listdir(os.path.join(self.data_directory, 'trash')) == [], "Trash entry left behind"
+
+    def test_03_delete_job(self):
+        request = TestRequest.blank('/jobs/deleted', content_type='application/json')
+        request.method = 'PUT'
+        request.body = json.dumps({ 'job_id': 'deleted' })
+        self.app.do_request(request, 200, False)
+        request = TestRequest.blank('/jobs/deleted/builds')
+        request.method = 'POST'
+        self.app.do_request(request, 201, False)
+        request = TestRequest.blank('/jobs/deleted')
+        request.method = 'DELETE'
+        response = self.app.do_request(request, 202, False)
+        trash_id = json.loads(response.body)['trash_id']
+        self.app.do_request(TestRequest.blank('/jobs/deleted'), 404, False)
+        self._wait_reclaimed('/trash/%s' % trash_id)
+        assert json.loads(self.app.request('/trash').body)['entries'] == [], "Trash not empty"
+        request = TestRequest.blank('/jobs/deleted')
+        request.method = 'DELETE'
+        self.app.do_request(request, 404, False)
+
+    def test_04_reclaim_locked(self):
+        entry_id = '00000000-0000-0000-0000-000000000004'
+        entry_dir = os.path.join(self.data_directory, 'trash', entry_id)
+        os.makedirs(entry_dir)
+        file(os.path.join(entry_dir, 'file'), 'wb').write('data')
+        reclaimer = trash.Reclaimer(self.config)
+        # another frontend process on the host is reclaiming the entry
+        lock = sync.FileLock(os.path.join(trash._lock_dir(), '%s.lock' % entry_id))
+        assert lock.try_lock(), "Lock not taken"
+        try:
+            assert reclaimer.reclaim(entry_id) == False, "Locked entry reclaimed"
+            assert os.path.isdir(entry_dir), "Locked entry removed"
+        finally:
+            lock.unlock()
+        assert reclaimer.reclaim(entry_id) == True, "Entry not reclaimed"
+        assert not os.path.exists(entry_dir), "Entry left behind"
+
+    def test_05_shared_storage_needs_zookeeper(self):
+        try:
+            trash.Reclaimer({ 'data_directory': self.data_directory, 'ceph_monitors': [ 'mon1' ] })
+        except ValueError:
+            pass
+        else:
+            assert False, "Reclaimer without ZooKeeper on CephFS"
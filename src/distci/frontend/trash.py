@@ -0,0 +1,349 @@
+"""
+Trash area for deleted jobs and builds
+
+Deleting a job or a build renames its directory into the trash directory,
+a single fast operation, and leaves removing the contents to a reclamation
+thread in each frontend process, started on first use there, i.e. on the
+first delete or trash request after the server has forked. Blobs referred to from a removed
+tree are released once it is gone. Reclamation is limited to
+trash_reclaim_rate files and directories per second, so that large deletes
+do not take all storage throughput from requests. Entries left behind by a
+stopped frontend are reclaimed by whichever frontend gets to them first.
+
+Each entry is a directory <id> with the removed tree and a file <id>.info
+describing what was deleted. The description is written before the tree
+is moved, so the directory appears in the trash complete.
+
+An entry is reclaimed by one frontend at a time, holding a ZooKeeper lock.
+Without ZooKeeper, which is only allowed with storage local to the host,
+processes take turns through lock files in the local temporary directory. Blob
+references are collected while the tree is removed. If the removal fails,
+the digests are saved in the description, so that a later attempt releases
+the blobs of the files that were left behind.
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+import os
+import json
+import time
+import uuid
+import tempfile
+import atexit
+import logging
+import threading
+import webob
+
+from distci.frontend import blob_store, validators, sync, constants, storage
+
+RECLAIM_RATE = 2000
+POLL_INTERVAL = 60.0
+ORPHAN_INFO_AGE = 3600
+
+def _trash_dir(config):
+    """ Return trash directory """
+    return os.path.join(config.get('data_directory'), 'trash')
+
+def _lock_dir():
+    """ Return local directory for reclamation lock files """
+    lock_dir = os.path.join(tempfile.gettempdir(), 'distci-trash-locks')
+    if not os.path.isdir(lock_dir):
+        try:
+            os.makedirs(lock_dir)
+        except OSError:
+            if not os.path.isdir(lock_dir):
+                raise
+    return lock_dir
+
+def _info_file(config, entry_id):
+    """ Return filename for the description of a trash entry """
+    return os.path.join(_trash_dir(config), '%s.info' % entry_id)
+
+def move_to_trash(config, store, path, info):
+    """ Move directory 'path' into the trash, described by dict 'info', and
+        wake up reclamation. Returns ID of the trash entry, raises
+        storage.NotFound if there is no such directory. """
+    entry_id = str(uuid.uuid4())
+    info = dict(info, deleted=int(time.time()))
+    try:
+        store.write_file(_info_file(config, entry_id), json.dumps(info))
+    except storage.NotFound:
+        try:
+            store.mkdir(_trash_dir(config))
+        except storage.ObjectExists:
+            pass
+        store.write_file(_info_file(config, entry_id), json.dumps(info))
+    try:
+        store.rename(path, os.path.join(_trash_dir(config), entry_id))
+    except:
+        try:
+            store.unlink(_info_file(config, entry_id))
+        except storage.NotFound:
+            pass
+        raise
+    get_reclaimer(config).wake()
+    return entry_id
+
+class Reclaimer(object):
+    """ Background thread removing trash entries """
+    def __init__(self, config):
+        self.config = config
+        self.log = logging.getLogger('trash')
+        self.zknodes = config.get('zookeeper_nodes')
+        if not self.zknodes and storage.backend_name(config) == 'cephfs':
+            # lock files only keep processes of a single host apart
+            raise ValueError('zookeeper_nodes must be set to reclaim trash with the cephfs storage backend')
+        self.rate = config.get('trash_reclaim_rate', RECLAIM_RATE)
+        self.interval = config.get('trash_poll_interval', POLL_INTERVAL)
+        self.cv = threading.Condition()
+        self.thread = None
+        self.pid = None
+        self.pending = False
+        self.stopping = False
+        self.current = None
+        self.reclaimed = 0
+
+    def start(self):
+        """ Start the reclamation thread, unless running in this process """
+        with self.cv:
+            if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.stopping = False
+            self.thread = threading.Thread(target=self._run, name='trash-reclaimer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def wake(self):
+        """ Have the reclamation thread look for new entries """
+        self.start()
+        with self.cv:
+            self.pending = True
+            self.cv.notify()
+
+    def stop(self, timeout=None):
+        """ Stop the reclamation thread after the entry being reclaimed """
+        with self.cv:
+            self.stopping = True
+            self.cv.notify()
+            thread = self.thread
+        if thread is not None and self.pid == os.getpid():
+            thread.join(timeout)
+
+    def _run(self):
+        """ Reclamation thread main loop """
+        while not self.stopping:
+            try:
+                self.reclaim_all()
+            except:
+                self.log.exception('Trash reclamation failed')
+            with self.cv:
+                if not self.pending and not self.stopping:
+                    self.cv.wait(self.interval)
+                self.pending = False
+
+    def status(self, entry_id):
+        """ Return progress of the entry being reclaimed, None if it is not
+            being reclaimed by this process """
+        with self.cv:
+            if self.current is None or self.current['id'] != entry_id:
+                return None
+            return dict(self.current)
+
+    def reclaim_all(self):
+        """ Reclaim all entries in the trash, return number reclaimed """
+        with storage.get_storage(self.config) as store:
+            try:
+                entries = list(store.scandir(_trash_dir(self.config)))
+            except storage.NotFound:
+                return 0
+            entry_ids = set(entry.name for entry in entries if entry.is_dir and validators.validate_trash_id(entry.name))
+            for entry in entries:
+                if entry.name.endswith('.info') and entry.name[:-len('.info')] not in entry_ids:
+                    self._remove_orphan_info(store, entry.name[:-len('.info')])
+        count = 0
+        for entry_id in entry_ids:
+            if self.stopping:
+                break
+            if self.reclaim(entry_id):
+                count += 1
+        return count
+
+    def _remove_orphan_info(self, store, entry_id):
+        """ Remove the description of an entry that never made it to the
+            trash, or whose reclamation was interrupted """
+        info = read_info(self.config, store, entry_id)
+        if info is None or info.get('deleted', 0) < time.time() - ORPHAN_INFO_AGE:
+            try:
+                store.unlink(_info_file(self.config, entry_id))
+            except storage.NotFound:
+                pass
+
+    def _progress(self, started, files, directories):
+        """ Record progress and stay within the reclamation rate """
+        with self.cv:
+            self.current['files'] = files
+            self.current['directories'] = directories
+        if self.rate > 0:
+            delay = started + (files + directories) / float(self.rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _lock(self, entry_id):
+        """ Take the reclamation lock of an entry, None if it is busy """
+        if self.zknodes:
+            return sync.acquire_lock(self.zknodes, 'trash-lock-%s' % entry_id, attempts=1)
+        lock = sync.FileLock(os.path.join(_lock_dir(), '%s.lock' % entry_id))
+        if lock.try_lock():
+            return lock
+        lock.close()
+        return None
+
+    def reclaim(self, entry_id):
+        """ Remove a trash entry and release blobs it referred to. Returns
+            False if another frontend is reclaiming it. """
+        lock = self._lock(entry_id)
+        if lock is None:
+            return False
+        try:
+            with storage.get_storage(self.config) as store:
+                tree = os.path.join(_trash_dir(self.config), entry_id)
+                if not store.isdir(tree):
+                    # reclaimed by another frontend meanwhile
+                    return False
+                info = read_info(self.config, store, entry_id) or {}
+                with self.cv:
+                    self.current = dict(describe(info), id=entry_id, status='reclaiming', files=0, directories=0)
+                self.log.info('Reclaiming %s: %r', entry_id, describe(info))
+                blobs = blob_store.BlobStore(self.config)
+                # including digests saved by an interrupted attempt
+                digests = set(info.get('digests', []))
+                def _collect(path):
+                    if path.endswith('.meta'):
+                        sha256 = blobs.digest(store, path[:-len('.meta')])
+                        if sha256 is not None:
+                            digests.add(sha256)
+                started = time.time()
+                removed = False
+                try:
+                    storage.remove_tree(store, tree,
+                                        progress=lambda files, directories: self._progress(started, files, directories),
+                                        before_unlink=_collect)
+                    removed = True
+                except storage.NotFound:
+                    removed = True
+                finally:
+                    blobs.release_all(store, digests)
+                    if not removed and digests:
+                        # files referring to them may be left behind
+                        self._save_digests(store, entry_id, info, digests)
+                try:
+                    store.unlink(_info_file(self.config, entry_id))
+                except storage.NotFound:
+                    pass
+                with self.cv:
+                    self.reclaimed += 1
+        finally:
+            with self.cv:
+                self.current = None
+            lock.unlock()
+            lock.close()
+        return True
+
+    def _save_digests(self, store, entry_id, info, digests):
+        """ Record digests of blobs to release on the next attempt """
+        try:
+            store.write_file(_info_file(self.config, entry_id), json.dumps(dict(info, digests=sorted(digests))))
+        except:
+            self.log.exception('Failed to save blob references of %s', entry_id)
+
+def describe(info):
+    """ Return description of a trash entry without internal fields """
+    return dict((key, value) for key, value in info.iteritems() if key != 'digests')
+
+def read_info(config, store, entry_id):
+    """ Return description of a trash entry, None if missing or unreadable """
+    try:
+        with store.open(_info_file(config, entry_id), 'rb') as fileo:
+            return json.load(fileo)
+    except (storage.NotFound, ValueError):
+        return None
+
+_RECLAIMERS = {}
+_RECLAIMERS_LOCK = threading.Lock()
+
+def get_reclaimer(config):
+    """ Return the process-wide reclaimer of a data directory """
+    with _RECLAIMERS_LOCK:
+        reclaimer = _RECLAIMERS.get(config.get('data_directory'))
+        if reclaimer is None:
+            reclaimer = Reclaimer(config)
+            _RECLAIMERS[config.get('data_directory')] = reclaimer
+        return reclaimer
+
+@atexit.register
+def _stop_reclaimers():
+    """ Stop reclamation threads before interpreter shutdown """
+    with _RECLAIMERS_LOCK:
+        reclaimers = _RECLAIMERS.values()
+    for reclaimer in reclaimers:
+        reclaimer.stop(1.0)
+
+class Trash(object):
+    """ Class for handling trash status requests """
+    def __init__(self, config):
+        self.config = config
+        self.log = logging.getLogger('trash')
+        self.reclaimer = get_reclaimer(config)
+
+    def _entry_status(self, store, entry_id):
+        """ Return status of a trash entry, None if it is not in the trash """
+        status = self.reclaimer.status(entry_id)
+        if status is not None:
+            return status
+        if not store.isdir(os.path.join(_trash_dir(self.config), entry_id)):
+            return None
+        return dict(describe(read_info(self.config, store, entry_id) or {}), id=entry_id, status='pending')
+
+    def get_trash(self):
+        """ Return entries waiting for reclamation """
+        result = { 'entries': [],
+                   'reclaimed': self.reclaimer.reclaimed,
+                   'reclaim_rate': self.reclaimer.rate }
+        storage_backend = storage.get_storage(self.config)
+        with storage_backend as store:
+            try:
+                entries = list(store.scandir(_trash_dir(self.config)))
+            except storage.NotFound:
+                entries = []
+            for entry in entries:
+                if entry.is_dir and validators.validate_trash_id(entry.name):
+                    status = self._entry_status(store, entry.name)
+                    if status is not None:
+                        result['entries'].append(status)
+        result['entries'].sort(key=lambda entry: entry.get('deleted'))
+        return webob.Response(status=200, body=json.dumps(result), content_type="application/json")
+
+    def get_entry(self, entry_id):
+        """ Return status of a trash entry, 404 once it has been reclaimed """
+        storage_backend = storage.get_storage(self.config)
+        with storage_backend as store:
+            status = self._entry_status(store, entry_id)
+        if status is None:
+            return webob.Response(status=404, body=constants.ERROR_TRASH_NOT_FOUND)
+        return webob.Response(status=200, body=json.dumps(status), content_type="application/json")
+
+    def handle_request(self, request, parts):
+        """ Parse and dispatch trash API requests """
+        # picks up entries left behind by stopped frontends
+        self.reclaimer.start()
+        if request.method != 'GET':
+            return webob.Response(status=400)
+        if len(parts) == 0:
+            return self.get_trash()
+        elif len(parts) == 1:
+            if validators.validate_trash_id(parts[0]) != parts[0]:
+                return webob.Response(status=400, body=constants.ERROR_TRASH_INVALID_ID)
+            return self.get_entry(parts[0])
+        return webob.Response(status=400)
@@ -13,6 +13,8 @@ __JOB_ID_MAX_LEN = 256
 __BUILD_ID_VALIDATOR = re.compile('^([0-9]+)$')
 __BUILD_ID_MAX_LEN = 16
 __ARTIFACT_ID_VALIDATOR = __TASK_ID_VALIDATOR
+__TRASH_ID_VALIDATOR = __TASK_ID_VALIDATOR
+__SHA256_VALIDATOR = re.compile('^([a-f0-9]{64})$')
 
 def validate_task_id(task_id):
     """ Validate task ID """
@@ -46,3 +48,16 @@ def validate_artifact_id(artifact_id):
         return matches.group(0)
     return None
 
+def validate_trash_id(trash_id):
+    """ Validate trash entry ID """
+    matches = __TRASH_ID_VALIDATOR.match(trash_id)
+    if matches is not None:
+        return matches.group(0)
+    return None
+
+def validate_sha256(digest):
+    """ Validate hex encoded SHA-256 digest """
+    matches = __SHA256_VALIDATOR.match(digest)
+    if matches is not None:
+        return matches.group(0)
+    return None
@@ -0,0 +1,249 @@
+"""
+Workspace manifests
+
+Instead of a tar archive, a workspace can be stored as a manifest listing
+the files, directories and symlinks of the tree, with file contents kept
+in the blob store. Workers only need to transfer the files whose digests
+they do not have, and a full archive is rebuilt from the manifest when
+somebody asks for one.
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+import os
+import json
+import uuid
+import time
+import tarfile
+import logging
+
+from distci.frontend import blob_store, validators, storage
+
+MANIFEST_VERSION = 1
+
+ARCHIVE_ATTEMPTS = 3
+
+ENTRY_TYPES = ('file', 'dir', 'symlink')
+
+def _valid_path(path):
+    """ path is relative and stays inside the workspace """
+    if not isinstance(path, basestring) or path == '' or path.startswith('/'):
+        return False
+    return all(part not in ('', '.', '..') for part in path.split('/'))
+
+def validate(manifest):
+    """ Return entries of a manifest, raise ValueError if it is malformed """
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('entries'), list):
+        raise ValueError('Manifest entries missing')
+    paths = set()
+    for entry in manifest['entries']:
+        if not isinstance(entry, dict) or entry.get('type') not in ENTRY_TYPES:
+            raise ValueError('Invalid manifest entry %r' % entry)
+        if not _valid_path(entry.get('path')) or entry['path'] in paths:
+            raise ValueError('Invalid or duplicate path %r' % entry.get('path'))
+        paths.add(entry['path'])
+        for key in ('mode', 'mtime'):
+            if key in entry and not isinstance(entry[key], (int, long)):
+                raise ValueError('Invalid %s for %r' % (key, entry['path']))
+        if entry['type'] == 'file':
+            if not isinstance(entry.get('sha256'), basestring) or validators.validate_sha256(entry['sha256']) != entry['sha256']:
+                raise ValueError('Invalid digest for %r' % entry['path'])
+            if not isinstance(entry.get('size'), (int, long)) or entry['size'] < 0:
+                raise ValueError('Invalid size for %r' % entry['path'])
+        elif entry['type'] == 'symlink':
+            if not isinstance(entry.get('target'), basestring):
+                raise ValueError('Invalid symlink target for %r' % entry['path'])
+    return manifest['entries']
+
+class WorkspaceManifest(object):
+    """ Manifest based workspace of a single build """
+    def __init__(self, config, job_id, build_id):
+        self.config = config
+        self.job_id = job_id
+        self.build_id = build_id
+        self.log = logging.getLogger('workspace_manifest')
+        self.blobs = blob_store.BlobStore(config)
+
+    def _build_dir(self):
+        """ Return directory for the build """
+        return os.path.join(self.config.get('data_directory'), 'jobs', self.job_id, self.build_id)
+
+    def manifest_file(self):
+        """ Return filename for the manifest """
+        return os.path.join(self._build_dir(), 'workspace.manifest')
+
+    def _archive_file(self):
+        """ Return filename for the workspace archive """
+        return os.path.join(self._build_dir(), 'workspace')
+
+    def _codec_file(self):
+        """ Return filename for the codec of the workspace archive """
+        return os.path.join(self._build_dir(), 'workspace.codec')
+
+    def _blob_dir(self):
+        """ Return directory for the contents referred to by the manifest """
+        return os.path.join(self._build_dir(), 'workspace.blobs')
+
+    def _blob_file(self, sha256):
+        """ Return filename for workspace file contents """
+        return os.path.join(self._blob_dir(), sha256)
+
+    def _ensure_blob_dir(self, store):
+        """ Create blob directory if missing """
+        if not store.isdir(self._blob_dir()):
+            try:
+                store.mkdir(self._blob_dir())
+            except storage.ObjectExists:
+                pass
+
+    def exists(self, store):
+        """ Check whether the workspace is stored as a manifest """
+        return store.isfile(self.manifest_file())
+
+    def _read(self, store):
+        """ Return stored manifest as serialized, None if there is none """
+        try:
+            with store.open(self.manifest_file(), 'rb') as fileo:
+                return fileo.read()
+        except storage.NotFound:
+            return None
+
+    def load(self, store):
+        """ Return stored manifest, None if there is none """
+        data = self._read(store)
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def save(self, store, manifest):
+        """ Store a manifest, replacing an archive or earlier manifest.
+            Returns digests of file contents the frontend does not have,
+            in which case nothing is stored and the client has to upload
+            those with add_blob and try again. """
+        entries = validate(manifest)
+        self._ensure_blob_dir(store)
+        missing = []
+        digests = set()
+        for entry in entries:
+            if entry['type'] != 'file' or entry['sha256'] in digests:
+                continue
+            digests.add(entry['sha256'])
+            if store.isfile(self._blob_file(entry['sha256'])):
+                continue
+            if not self.blobs.link(store, entry['sha256'], entry['size'], self._blob_file(entry['sha256'])):
+                missing.append(entry['sha256'])
+        if missing:
+            return missing
+
+        store.write_file(self.manifest_file(), json.dumps({'version': MANIFEST_VERSION, 'entries': entries}))
+        self._remove_archive(store)
+        self._release_blobs(store, digests)
+        return []
+
+    def add_blob(self, store, sha256, ifh, length):
+        """ Store file contents for a manifest about to be saved. Returns
+            False if the data did not match the digest. """
+        self._ensure_blob_dir(store)
+        stored_sha256, _ = self.blobs.put(store, ifh, length, self._blob_file(sha256), sha256)
+        return stored_sha256 is not None
+
+    def open_blob(self, store, sha256):
+        """ Open file contents referred to by the manifest """
+        return store.open(self._blob_file(sha256), 'rb')
+
+    def blob_info(self, store, sha256):
+        """ Return size and entity tag of file contents """
+        return store.getinfo(self._blob_file(sha256))
+
+    def build_archive(self, store):
+        """ Write a gzipped tar archive of the manifest as the workspace
+            archive, for clients that do not use manifests. A manifest
+            saved meanwhile outdates the archive, which is then built
+            again from the new one. """
+        for _ in range(ARCHIVE_ATTEMPTS):
+            data = self._read(store)
+            if data is None:
+                raise storage.NotFound
+            manifest = json.loads(data)
+            tmp_path = '%s.tmp-%s' % (self._archive_file(), uuid.uuid4().hex)
+            try:
+                with store.open(tmp_path, 'wb') as ofh:
+                    tarf = tarfile.open(fileobj=ofh, mode='w|gz')
+                    for entry in sorted(manifest['entries'], key=lambda entry: entry['path']):
+                        self._add_to_archive(store, tarf, entry)
+                    tarf.close()
+                if self._read(store) != data:
+                    store.unlink(tmp_path)
+                    continue
+                store.rename(tmp_path, self._archive_file())
+            except:
+                try:
+                    store.unlink(tmp_path)
+                except storage.NotFound:
+                    pass
+                raise
+            # save() may have removed the archive just before the rename
+            if self._read(store) == data:
+                return
+            self._remove_archive(store)
+        raise IOError('Workspace manifest of %s/%s keeps changing' % (self.job_id, self.build_id))
+
+    def _add_to_archive(self, store, tarf, entry):
+        """ Add a manifest entry to a tar archive """
+        info = tarfile.TarInfo(str(entry['path']))
+        info.mtime = entry.get('mtime', int(time.time()))
+        if entry['type'] == 'dir':
+            info.type = tarfile.DIRTYPE
+            info.mode = entry.get('mode', 0755)
+            tarf.addfile(info)
+        elif entry['type'] == 'symlink':
+            info.type = tarfile.SYMTYPE
+            info.linkname = str(entry['target'])
+            info.mode = entry.get('mode', 0777)
+            tarf.addfile(info)
+        else:
+            info.size = entry['size']
+            info.mode = entry.get('mode', 0644)
+            with self.open_blob(store, entry['sha256']) as ifh:
+                tarf.addfile(info, ifh)
+
+    def _remove_archive(self, store):
+        """ Remove workspace archive, it is outdated or being replaced.
+            Archives built from the manifest are gzip, the default codec. """
+        for path in (self._archive_file(), self._codec_file()):
+            try:
+                store.unlink(path)
+            except storage.NotFound:
+                pass
+
+    def _release_blobs(self, store, keep=()):
+        """ Release workspace contents not referred to by the manifest """
+        try:
+            names = store.listdir(self._blob_dir())
+        except storage.NotFound:
+            return
+        for name in names:
+            if name in keep or '.' in name:
+                continue
+            try:
+                self.blobs.unlink(store, self._blob_file(name))
+            except storage.NotFound:
+                pass
+
+    def clear(self, store):
+        """ Remove manifest and the contents it refers to, keeping any
+            archive. Returns True if there was a manifest. """
+        try:
+            store.unlink(self.manifest_file())
+            existed = True
+        except storage.NotFound:
+            existed = False
+        self._release_blobs(store)
+        try:
+            store.rmdir(self._blob_dir())
+        except storage.NotFound:
+            pass
+        except:
+            self.log.exception('Failed to remove %s', self._blob_dir())
+        return existed
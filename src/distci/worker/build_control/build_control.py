@@ -55,7 +55,7 @@ class BuildControlWorker(worker_base.WorkerBase):
         self.log.debug('Creating workspace')
         tmp_dir = tempfile.mkdtemp()
 
-        if self.send_workspace(self.build_states[task_key]['job_id'], self.build_states[task_key]['build_number'], tmp_dir) == False:
+        if self.send_workspace(self.build_states[task_key]['job_id'], self.build_states[task_key]['build_number'], tmp_dir, self.build_states[task_key]['job_config'].get('workspace_codec')) == False:
             self.log.error('Failed to store empty workspace')
             self.delete_workspace(tmp_dir)
             return
@@ -90,6 +90,8 @@ class BuildControlWorker(worker_base.WorkerBase):
                        'build_number': self.build_states[task_key]['build_number'],
                        'capabilities': capabilities,
                        'params': copy.deepcopy(self.build_states[task_key]['job_config']['tasks'][subtask_index]['params']) }
+        if self.build_states[task_key]['job_config'].get('workspace_codec') is not None:
+            task_descr['workspace_codec'] = self.build_states[task_key]['job_config']['workspace_codec']
 
         task_obj = task_base.GenericTask(task_descr, None)
         task_obj = self.post_new_task(task_obj)
@@ -0,0 +1,211 @@
+"""
+Workspace archive compression codecs
+
+A codec is given as 'name' or 'name:level'. 'none' sends the tar archive
+as is, 'gzip' compresses it as a single gzip member and 'pgzip' compresses
+blocks of it in parallel threads as separate gzip members, which standard
+gzip decoders read as one stream. The decoder needed for an archive is
+recorded with the workspace, see decoder_name().
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+import zlib
+import collections
+import multiprocessing
+from multiprocessing import pool
+
+CODECS = ('none', 'gzip', 'pgzip')
+DEFAULT_CODEC = 'gzip'
+DEFAULT_LEVEL = 6
+
+BLOCK_SIZE = 1024*1024
+READ_CHUNK_SIZE = 1024*64
+
+GZIP_WBITS = zlib.MAX_WBITS | 16
+
+def parse_codec(codec):
+    """ Return (name, level) of a codec, raise ValueError if unknown """
+    if codec is None:
+        codec = DEFAULT_CODEC
+    name, _, level = codec.partition(':')
+    if name not in CODECS:
+        raise ValueError('Unknown codec %r' % codec)
+    if level == '':
+        return name, DEFAULT_LEVEL
+    level = int(level)
+    if level < 1 or level > 9:
+        raise ValueError('Invalid compression level in %r' % codec)
+    return name, level
+
+def decoder_name(codec):
+    """ Return name of the decoder for archives written with codec """
+    name, _ = parse_codec(codec)
+    if name == 'none':
+        return 'none'
+    return 'gzip'
+
+def tar_read_mode(decoder):
+    """ Return tarfile mode for reading an archive with a random access
+        file, None means a workspace stored before codecs were recorded """
+    if decoder == 'none':
+        return 'r:'
+    elif decoder == 'gzip':
+        return 'r:gz'
+    return 'r'
+
+def gzip_compress(data, level=DEFAULT_LEVEL):
+    """ Return data as a single gzip member """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def gzip_decompress(data):
+    """ Return contents of a single gzip member """
+    return zlib.decompress(data, GZIP_WBITS)
+
+class PlainWriter(object):
+    """ Writer passing data through as is """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        """ write data """
+        self.fileobj.write(data)
+
+    def close(self):
+        """ finish, leaving the underlying file open """
+        pass
+
+class GzipWriter(object):
+    """ Writer compressing data as a single gzip member """
+    def __init__(self, fileobj, level):
+        self.fileobj = fileobj
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+
+    def write(self, data):
+        """ compress and write data """
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.fileobj.write(compressed)
+
+    def close(self):
+        """ finish the gzip member, leaving the underlying file open """
+        if self.compressor is not None:
+            self.fileobj.write(self.compressor.flush())
+            self.compressor = None
+
+class ParallelGzipWriter(object):
+    """ Writer compressing fixed size blocks as separate gzip members in a
+        thread pool, zlib releases the GIL while compressing. Output is
+        written in order, with a bounded number of blocks in flight. """
+    def __init__(self, fileobj, level, threads=None, block_size=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads or multiprocessing.cpu_count()
+        self.block_size = block_size
+        self.pool = pool.ThreadPool(self.threads)
+        self.pending = collections.deque()
+        self.buf = []
+        self.buf_len = 0
+
+    def write(self, data):
+        """ buffer data, compressing each full block """
+        self.buf.append(data)
+        self.buf_len += len(data)
+        if self.buf_len >= self.block_size:
+            data = ''.join(self.buf)
+            offset = 0
+            while len(data) - offset >= self.block_size:
+                self._submit(data[offset:offset + self.block_size])
+                offset += self.block_size
+            self.buf = [ data[offset:] ]
+            self.buf_len = len(data) - offset
+
+    def _submit(self, block):
+        """ queue a block for compression, writing out finished blocks
+            while too many are in flight """
+        self.pending.append(self.pool.apply_async(gzip_compress, (block, self.level)))
+        while len(self.pending) > self.threads * 2:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def close(self):
+        """ compress remaining data and wait for all blocks, leaving the
+            underlying file open """
+        if self.pool is None:
+            return
+        try:
+            if self.buf_len > 0:
+                self._submit(''.join(self.buf))
+            self.buf = []
+            self.buf_len = 0
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().get())
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+def open_writer(fileobj, codec, threads=None):
+    """ Return a writer compressing into fileobj with codec. The writer
+        has to be closed to flush it, which leaves fileobj open. """
+    name, level = parse_codec(codec)
+    if name == 'none':
+        return PlainWriter(fileobj)
+    elif name == 'gzip':
+        return GzipWriter(fileobj, level)
+    return ParallelGzipWriter(fileobj, level, threads)
+
+class GzipReader(object):
+    """ Reader decompressing a stream of one or more gzip members """
+    def __init__(self, fileobj, chunk_size=READ_CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decompressor = zlib.decompressobj(GZIP_WBITS)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """ decompress the next chunk of input into the buffer """
+        data = self.fileobj.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            self.buf = self.decompressor.flush()
+            self.pos = 0
+            return
+        output = []
+        while data:
+            output.append(self.decompressor.decompress(data))
+            data = self.decompressor.unused_data
+            if data:
+                # member ended, the rest belongs to the next one
+                self.decompressor = zlib.decompressobj(GZIP_WBITS)
+        self.buf = ''.join(output)
+        self.pos = 0
+
+    def read(self, size=-1):
+        """ read decompressed data """
+        parts = []
+        remaining = size
+        while remaining != 0:
+            if self.pos >= len(self.buf):
+                if self.eof:
+                    break
+                self._fill()
+                continue
+            if remaining < 0:
+                part = self.buf[self.pos:]
+            else:
+                part = self.buf[self.pos:self.pos + remaining]
+                remaining -= len(part)
+            self.pos += len(part)
+            parts.append(part)
+        return ''.join(parts)
+
+def open_reader(fileobj, decoder):
+    """ Return a reader decompressing a stream written with a codec whose
+        decoder_name() is 'decoder' """
+    if decoder == 'none':
+        return fileobj
+    return GzipReader(fileobj)
@@ -63,20 +63,11 @@ class CopyArtifactsWorker(worker_base.WorkerBase):
                 continue
 
             # 1. Locate latest successful build
-            last_successful_build = 0
-            all_builds = self.distci_client.builds.list(source_job_name)
-            if all_builds is not None:
-                for build in sorted(all_builds.get('builds', []), reverse=True):
-                    state = self.distci_client.builds.state.get(source_job_name, build)
-                    if state is not None and state.get('state', {}).get('status') == 'complete' and state.get('state', {}).get('result') == 'success':
-                        last_successful_build = build
-                        break
-                if last_successful_build == 0:
-                    self.send_failure(task, 'Unable to locate a successful build')
-                    continue
-            else:
-                self.send_failure(task, 'Unable to locate builds')
+            state = self.distci_client.builds.state.get(source_job_name, 'lastSuccessful')
+            if state is None or state.get('state', {}).get('result') != 'success':
+                self.send_failure(task, 'Unable to locate a successful build')
                 continue
+            last_successful_build = int(state['build_number'])
 
             # 2. glob through build artifacts
             artifacts = state['state'].get('artifacts', {})
@@ -115,7 +106,8 @@ class CopyArtifactsWorker(worker_base.WorkerBase):
                 # 5. send workspace
                 if self.send_workspace(task.config['job_id'],
                                        task.config['build_number'],
-                                       workspace) == False:
+                                       workspace,
+                                       task.config.get('workspace_codec')) == False:
                     self.log.debug('Sending workspace failed')
                     self.send_failure(task, 'Failed to fetch workspace')
                     continue
@@ -153,7 +153,8 @@ class ExecuteShellWorker(worker_base.WorkerBase):
             self.log.debug('Sending workspace')
             if self.send_workspace(self.tasks[task_id]['task'].config['job_id'],
                                    self.tasks[task_id]['task'].config['build_number'],
-                                   self.tasks[task_id]['workspace']) == False:
+                                   self.tasks[task_id]['workspace'],
+                                   self.tasks[task_id]['task'].config.get('workspace_codec')) == False:
                 self.log.debug('Sending workspace failed')
                 return False
             self.tasks[task_id]['workspace'] = None
@@ -97,7 +97,8 @@ class GitCheckoutWorker(worker_base.WorkerBase):
             # 3. pack and upload workspace
             self.send_workspace(task.config['job_id'],
                                 task.config['build_number'],
-                                workspace)
+                                workspace,
+                                task.config.get('workspace_codec'))
 
             # 4. clear temp dir
             self.delete_workspace(workspace)
@@ -58,6 +58,7 @@ class PublishArtifactsWorker(worker_base.WorkerBase):
 
             # 2. Upload artifacts matching the specified fileglobs
             task.config['artifacts'] = {}
+            task.config['artifact_digests'] = {}
             for mask in task.config['params'].get('artifacts'):
                 path = os.path.abspath(os.path.join(workspace, mask))
                 if path.startswith(os.path.join(workspace, '')):
@@ -65,13 +66,18 @@ class PublishArtifactsWorker(worker_base.WorkerBase):
                         artifact_reply = None
                         abs_artifact = os.path.abspath(artifact)
                         rel_artifact = os.path.relpath(artifact, workspace)
+                        with open(abs_artifact, 'rb') as fh:
+                            sha256, size = worker_base.file_digest(fh)
                         for _ in range(self.worker_config.get('retry_count', 10)):
-                            fh = open(abs_artifact, 'rb')
-                            st = os.stat(abs_artifact)
-                            artifact_reply = self.distci_client.builds.artifacts.put(task.config['job_id'], task.config['build_number'], fh, st.st_size)
-                            fh.close()
+                            # only send the content if the frontend does not have it yet
+                            artifact_reply = self.distci_client.builds.artifacts.link(task.config['job_id'], task.config['build_number'], sha256, size)
+                            if artifact_reply is None:
+                                fh = open(abs_artifact, 'rb')
+                                artifact_reply = self.distci_client.builds.artifacts.put(task.config['job_id'], task.config['build_number'], fh, size, sha256)
+                                fh.close()
                             if artifact_reply is not None and artifact_reply.get('artifact_id') is not None:
                                 log = '%s\nStored \'%s\' as artifact \'%s\'' % (log, rel_artifact, artifact_reply.get('artifact_id'))
+                                task.config['artifact_digests'][artifact_reply.get('artifact_id')] = { 'sha256': sha256, 'size': size }
                                 filename_parts = []
                                 tail = rel_artifact
                                 while tail != '':
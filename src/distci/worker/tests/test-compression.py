@@ -0,0 +1,71 @@
+"""
+Test workspace archive compression codecs
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+import io
+import os
+import gzip
+
+from distci.worker import compression
+
+class TestCompression:
+    data = os.urandom(100000) * 3 + 'x' * 300000
+
+    def _compress(self, codec, **kwargs):
+        output = io.BytesIO()
+        writer = compression.open_writer(output, codec, **kwargs)
+        for offset in range(0, len(self.data), 7000):
+            writer.write(self.data[offset:offset + 7000])
+        writer.close()
+        return output.getvalue()
+
+    def test_01_parse_codec(self):
+        assert compression.parse_codec(None) == ('gzip', 6), "wrong default codec"
+        assert compression.parse_codec('pgzip:1') == ('pgzip', 1), "wrong codec and level"
+        for codec in ('bzip2', 'gzip:0', 'gzip:fast'):
+            try:
+                compression.parse_codec(codec)
+                assert False, "accepted invalid codec %r" % codec
+            except ValueError:
+                pass
+        assert compression.decoder_name('pgzip:3') == 'gzip', "wrong decoder for pgzip"
+        assert compression.decoder_name('none') == 'none', "wrong decoder for none"
+
+    def test_02_none(self):
+        assert self._compress('none') == self.data, "data modified"
+
+    def test_03_gzip_levels(self):
+        fast = self._compress('gzip:1')
+        best = self._compress('gzip:9')
+        assert gzip.GzipFile(fileobj=io.BytesIO(fast)).read() == self.data, "wrong content"
+        assert len(best) <= len(fast), "level ignored"
+
+    def test_04_parallel_gzip_is_standard_gzip(self):
+        output = io.BytesIO()
+        writer = compression.ParallelGzipWriter(output, 6, threads=3, block_size=50000)
+        writer.write(self.data)
+        writer.close()
+        compressed = output.getvalue()
+        assert compressed.count('\x1f\x8b\x08') >= 12, "expected a gzip member per block"
+        assert gzip.GzipFile(fileobj=io.BytesIO(compressed)).read() == self.data, "wrong content"
+
+    def test_05_reader(self):
+        output = io.BytesIO()
+        writer = compression.ParallelGzipWriter(output, 1, threads=2, block_size=65536)
+        writer.write(self.data)
+        writer.close()
+        compressed = output.getvalue()
+        reader = compression.open_reader(io.BytesIO(compressed), 'gzip')
+        chunks = []
+        while True:
+            chunk = reader.read(10240)
+            if chunk == '':
+                break
+            assert len(chunk) <= 10240, "read returned too much"
+            chunks.append(chunk)
+        assert ''.join(chunks) == self.data, "wrong content"
+        reader = compression.open_reader(io.BytesIO(self._compress('gzip')), 'gzip')
+        assert reader.read() == self.data, "wrong content reading all"
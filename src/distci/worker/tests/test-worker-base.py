@@ -12,6 +12,7 @@ import threading
 import urllib2
 import wsgiref.simple_server
 import json
+import tarfile
 
 from distci import frontend
 from distci.worker import worker_base
@@ -39,6 +40,7 @@ class TestWorkerBase:
         cls.data_directory = tempfile.mkdtemp()
         frontend_config_file = os.path.join(cls.data_directory, 'frontend.conf')
         os.mkdir(os.path.join(cls.data_directory, 'tasks'))
+        os.mkdir(os.path.join(cls.data_directory, 'jobs'))
 
         frontend_config = { "data_directory": cls.data_directory }
         json.dump(frontend_config, file(frontend_config_file, 'wb'))
@@ -54,9 +56,23 @@ class TestWorkerBase:
         worker_config = { 'capabilities': [ 'test' ],
                           'poll_interval': 1,
                           'retry_count': 10,
-                          'task_frontends': [ 'http://localhost:8800/' ] }
+                          'task_frontends': [ 'http://localhost:8800/' ],
+                          'frontends': [ 'http://localhost:8800/' ] }
         cls.worker = worker_base.WorkerBase(worker_config)
 
+        incremental_config = dict(worker_config)
+        incremental_config['workspace_sync'] = 'incremental'
+        incremental_config['workspace_blob_cache'] = os.path.join(cls.data_directory, 'blob-cache')
+        cls.incremental_worker = worker_base.WorkerBase(incremental_config)
+
+        streaming_config = dict(worker_config)
+        streaming_config['workspace_streaming'] = True
+        cls.streaming_worker = worker_base.WorkerBase(streaming_config)
+
+        caching_config = dict(worker_config)
+        caching_config['workspace_cache'] = os.path.join(cls.data_directory, 'workspace-cache')
+        cls.caching_worker = worker_base.WorkerBase(caching_config)
+
         cls.test_state = {}
 
     @classmethod
@@ -88,3 +104,163 @@ class TestWorkerBase:
         task = self.worker.fetch_task(0)
         assert task is None, "didn't expect task to be returned"
 
+    def test_06_send_workspace_incremental(self):
+        client = self.incremental_worker.distci_client
+        job = client.jobs.set('wsjob', { 'job_id': 'wsjob' })
+        assert job is not None, "failed to create job"
+        build = client.builds.trigger('wsjob')
+        assert build is not None, "failed to trigger build"
+        self.test_state['build_number'] = build['build_number']
+
+        workspace = tempfile.mkdtemp()
+        os.mkdir(os.path.join(workspace, 'sub'))
+        file(os.path.join(workspace, 'a.txt'), 'wb').write('content a')
+        file(os.path.join(workspace, 'sub', 'b.txt'), 'wb').write('content b')
+        file(os.path.join(workspace, 'sub', 'c.txt'), 'wb').write('content a')
+        os.symlink('a.txt', os.path.join(workspace, 'link'))
+        assert self.incremental_worker.send_workspace('wsjob', build['build_number'], workspace) == True, "failed to send workspace"
+        shutil.rmtree(workspace)
+
+        manifest = client.builds.workspace.get_manifest('wsjob', build['build_number'])
+        assert manifest is not None, "workspace was not stored as manifest"
+        assert sorted(entry['path'] for entry in manifest['entries']) == [ 'a.txt', 'link', 'sub', 'sub/b.txt', 'sub/c.txt' ], "wrong manifest entries"
+
+    def test_07_fetch_workspace_incremental(self):
+        workspace = self.incremental_worker.fetch_workspace('wsjob', self.test_state['build_number'])
+        assert workspace is not None, "failed to fetch workspace"
+        assert file(os.path.join(workspace, 'sub', 'c.txt'), 'rb').read() == 'content a', "wrong content"
+        assert os.readlink(os.path.join(workspace, 'link')) == 'a.txt', "wrong symlink"
+
+        uploads = []
+        client = self.incremental_worker.distci_client
+        put_blob = client.builds.workspace.put_blob
+        def counting_put_blob(job_id, build_id, sha256, fileobj, fileobj_len):
+            uploads.append(sha256)
+            return put_blob(job_id, build_id, sha256, fileobj, fileobj_len)
+        client.builds.workspace.put_blob = counting_put_blob
+        file(os.path.join(workspace, 'sub', 'b.txt'), 'wb').write('modified b')
+        try:
+            assert self.incremental_worker.send_workspace('wsjob', self.test_state['build_number'], workspace) == True, "failed to send workspace"
+        finally:
+            client.builds.workspace.put_blob = put_blob
+        self.incremental_worker.delete_workspace(workspace)
+        assert len(uploads) == 1, "unchanged files were uploaded"
+
+    def test_08_fetch_workspace_archive_from_manifest(self):
+        workspace = self.worker.fetch_workspace('wsjob', self.test_state['build_number'])
+        assert workspace is not None, "failed to fetch workspace archive"
+        assert file(os.path.join(workspace, 'sub', 'b.txt'), 'rb').read() == 'modified b', "wrong content"
+        assert file(os.path.join(workspace, 'a.txt'), 'rb').read() == 'content a', "wrong content"
+        self.worker.delete_workspace(workspace)
+
+    def test_09_streaming_workspace(self):
+        workspace = tempfile.mkdtemp()
+        os.mkdir(os.path.join(workspace, 'sub'))
+        file(os.path.join(workspace, 'sub', 'data.bin'), 'wb').write(os.urandom(300000))
+        os.symlink('sub', os.path.join(workspace, 'link'))
+        assert self.streaming_worker.send_workspace('wsjob', self.test_state['build_number'], workspace) == True, "failed to stream workspace"
+
+        fetched = self.streaming_worker.fetch_workspace('wsjob', self.test_state['build_number'])
+        assert fetched is not None, "failed to fetch streamed workspace"
+        assert file(os.path.join(fetched, 'sub', 'data.bin'), 'rb').read() == file(os.path.join(workspace, 'sub', 'data.bin'), 'rb').read(), "wrong content"
+        assert os.readlink(os.path.join(fetched, 'link')) == 'sub', "wrong symlink"
+        assert self.streaming_worker.distci_client.builds.workspace.get_manifest('wsjob', self.test_state['build_number']) is None, "manifest not replaced by archive"
+        shutil.rmtree(workspace)
+        self.streaming_worker.delete_workspace(fetched)
+
+    def test_10_streaming_workspace_rejects_escaping_members(self):
+        workspace = tempfile.mkdtemp()
+        os.symlink('/tmp', os.path.join(workspace, 'escape'))
+        archive = tempfile.TemporaryFile()
+        tarf = tarfile.open(fileobj=archive, mode='w:gz')
+        tarf.add(os.path.join(workspace, 'escape'), 'escape')
+        info = tarfile.TarInfo('escape/evil.txt')
+        tarf.addfile(info, None)
+        tarf.close()
+        archive.seek(0)
+        shutil.rmtree(workspace)
+        target = tempfile.mkdtemp()
+        try:
+            self.streaming_worker._extract_stream(archive, target)
+            assert False, "member behind symlink was extracted"
+        except ValueError:
+            pass
+        assert not os.path.exists('/tmp/evil.txt'), "member written outside workspace"
+        shutil.rmtree(target)
+
+    def test_11_workspace_codecs(self):
+        workspace = tempfile.mkdtemp()
+        file(os.path.join(workspace, 'data.txt'), 'wb').write('codec test ' * 100000)
+        for worker in (self.worker, self.streaming_worker):
+            for codec, decoder in (('none', 'none'), ('gzip:1', 'gzip'), ('pgzip', 'gzip')):
+                assert worker.send_workspace('wsjob', self.test_state['build_number'], workspace, codec) == True, "failed to send workspace with %s" % codec
+                stored = os.path.join(self.data_directory, 'jobs', 'wsjob', str(self.test_state['build_number']), 'workspace.codec')
+                assert file(stored, 'rb').read().split()[0] == decoder, "wrong codec recorded for %s" % codec
+
+                fetched = worker.fetch_workspace('wsjob', self.test_state['build_number'])
+                assert fetched is not None, "failed to fetch workspace with %s" % codec
+                assert file(os.path.join(fetched, 'data.txt'), 'rb').read() == 'codec test ' * 100000, "wrong content with %s" % codec
+                worker.delete_workspace(fetched)
+        shutil.rmtree(workspace)
+
+    def test_12_workspace_cache(self):
+        workspace = tempfile.mkdtemp()
+        file(os.path.join(workspace, 'cached.txt'), 'wb').write('cached')
+        assert self.caching_worker.send_workspace('wsjob', self.test_state['build_number'], workspace) == True, "failed to send workspace"
+        shutil.rmtree(workspace)
+
+        fetched = self.caching_worker.fetch_workspace('wsjob', self.test_state['build_number'])
+        assert fetched is not None, "failed to fetch workspace"
+        assert os.stat(os.path.join(fetched, 'cached.txt')).st_nlink > 1, "workspace not checked out from cache"
+        self.caching_worker.delete_workspace(fetched)
+
+        workspace = tempfile.mkdtemp()
+        file(os.path.join(workspace, 'other.txt'), 'wb').write('other')
+        assert self.worker.send_workspace('wsjob', self.test_state['build_number'], workspace) == True, "failed to send workspace"
+        shutil.rmtree(workspace)
+
+        fetched = self.caching_worker.fetch_workspace('wsjob', self.test_state['build_number'])
+        assert fetched is not None, "failed to fetch workspace"
+        assert os.listdir(fetched) == [ 'other.txt' ], "stale workspace from cache"
+        self.caching_worker.delete_workspace(fetched)
+
+    def test_13_incremental_workspace_rejects_escaping_entries(self):
+        outside = tempfile.mkdtemp()
+        blob = os.path.join(self.data_directory, 'evil-blob')
+        file(blob, 'wb').write('evil')
+        manifest = { 'entries': [ { 'path': 'escape', 'type': 'symlink', 'target': outside },
+                                  { 'path': 'escape/evil.txt', 'type': 'file', 'sha256': 'x' } ] }
+        client = self.incremental_worker.distci_client
+        get_manifest = client.builds.workspace.get_manifest
+        client.builds.workspace.get_manifest = lambda job_id, build_id: manifest
+        self.incremental_worker._fetch_blob = lambda job_id, build_id, sha256: blob
+        try:
+            assert self.incremental_worker.fetch_workspace_incremental('wsjob', self.test_state['build_number']) is None, "entry behind symlink was written"
+            assert os.listdir(outside) == [], "entry written outside workspace"
+
+            manifest['entries'] = [ { 'path': 'sub', 'type': 'dir', 'mtime': 1000000000 },
+                                    { 'path': 'sub/a.txt', 'type': 'file', 'sha256': 'x', 'mtime': 1100000000 } ]
+            workspace = self.incremental_worker.fetch_workspace_incremental('wsjob', self.test_state['build_number'])
+            assert workspace is not None, "failed to fetch workspace"
+            assert os.stat(os.path.join(workspace, 'sub')).st_mtime == 1000000000, "directory mtime overwritten"
+            assert os.stat(os.path.join(workspace, 'sub', 'a.txt')).st_mtime == 1100000000, "wrong file mtime"
+            self.incremental_worker.delete_workspace(workspace)
+        finally:
+            client.builds.workspace.get_manifest = get_manifest
+            del self.incremental_worker._fetch_blob
+            shutil.rmtree(outside)
+
+    def test_14_blob_cache_eviction(self):
+        cache_dir = self.incremental_worker._blob_cache_dir()
+        for name in os.listdir(cache_dir):
+            os.unlink(os.path.join(cache_dir, name))
+        for index, name in enumerate(('old', 'used', 'new')):
+            file(os.path.join(cache_dir, name), 'wb').write('x' * 100)
+            os.utime(os.path.join(cache_dir, name), (1000000000 + index, 1000000000 + index))
+        os.utime(os.path.join(cache_dir, 'used'), None)
+        self.incremental_worker.worker_config['workspace_blob_cache_size'] = 250
+        try:
+            self.incremental_worker._evict_blobs()
+        finally:
+            del self.incremental_worker.worker_config['workspace_blob_cache_size']
+        assert sorted(os.listdir(cache_dir)) == [ 'new', 'used' ], "Wrong blobs evicted"
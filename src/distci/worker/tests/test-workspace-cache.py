@@ -0,0 +1,63 @@
+"""
+Test worker-local workspace cache
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+import tempfile
+import os
+import shutil
+import time
+
+from distci.worker import workspace_cache
+
+class TestWorkspaceCache:
+    cache_directory = None
+    workspace = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.cache_directory = tempfile.mkdtemp()
+        cls.workspace = tempfile.mkdtemp()
+        os.mkdir(os.path.join(cls.workspace, 'sub'))
+        file(os.path.join(cls.workspace, 'sub', 'a.txt'), 'wb').write('a' * 1000)
+        os.symlink('sub', os.path.join(cls.workspace, 'link'))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.cache_directory)
+        shutil.rmtree(cls.workspace)
+
+    def test_01_checkout_links_cached_files(self):
+        cache = workspace_cache.WorkspaceCache(self.cache_directory)
+        assert cache.store('job', 1, 'v1', self.workspace) == True, "failed to store"
+        assert cache.checkout('job', 1, 'v0') is None, "checked out wrong version"
+        assert cache.checkout('job', 2, 'v1') is None, "checked out wrong build"
+
+        wsdir = cache.checkout('job', 1, 'v1')
+        assert wsdir is not None, "failed to check out"
+        assert file(os.path.join(wsdir, 'sub', 'a.txt'), 'rb').read() == 'a' * 1000, "wrong content"
+        assert os.stat(os.path.join(wsdir, 'sub', 'a.txt')).st_nlink == 3, "file was not hard linked"
+        assert os.readlink(os.path.join(wsdir, 'link')) == 'sub', "wrong symlink"
+        shutil.rmtree(wsdir)
+
+    def test_02_modified_entry_is_discarded(self):
+        cache = workspace_cache.WorkspaceCache(self.cache_directory)
+        wsdir = cache.checkout('job', 1, 'v1')
+        # modified in place through the hard link
+        with open(os.path.join(wsdir, 'sub', 'a.txt'), 'ab') as fileo:
+            fileo.write('b')
+        shutil.rmtree(wsdir)
+        assert cache.checkout('job', 1, 'v1') is None, "checked out modified workspace"
+        assert os.listdir(self.cache_directory) == [], "modified entry not removed"
+
+    def test_03_eviction(self):
+        cache = workspace_cache.WorkspaceCache(self.cache_directory, max_size=3500)
+        for build_id in (1, 2, 3):
+            assert cache.store('evict', build_id, 'v', self.workspace) == True, "failed to store"
+            time.sleep(0.01)
+        os.utime(cache._entry_dir('evict', 1), None)
+        assert cache.store('evict', 4, 'v', self.workspace) == True, "failed to store"
+        kept = [ build_id for build_id in (1, 2, 3, 4) if cache._read_info(cache._entry_dir('evict', build_id)) is not None ]
+        assert kept == [ 1, 3, 4 ], "wrong entries evicted: %r" % kept
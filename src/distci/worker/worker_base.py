@@ -12,11 +12,18 @@ import logging
 import tempfile
 import tarfile
 import os
+import stat
 import shutil
+import hashlib
+import errno
+import httplib
 
 from distci import distcilib
 
-from . import task_base
+from . import task_base, compression, workspace_cache
+
+DIGEST_CHUNK_SIZE = 1024*1024
+BLOB_CACHE_MAX_SIZE = 1024*1024*1024
 
 class WorkerBase(object):
     def __init__(self, config):
@@ -24,6 +31,11 @@ class WorkerBase(object):
         self.uuid = str(uuid.uuid4())
         self.log = logging.getLogger('WorkerBase')
         self.distci_client = distcilib.DistCIClient(config)
+        self.workspace_states = {}
+        self.workspace_cache = None
+        if config.get('workspace_cache') is not None:
+            self.workspace_cache = workspace_cache.WorkspaceCache(config['workspace_cache'],
+                                                                  config.get('workspace_cache_size', workspace_cache.MAX_SIZE))
 
     def fetch_task(self, timeout=None):
         start_timestamp = time.time()
@@ -87,10 +99,27 @@ class WorkerBase(object):
         return None
 
     def fetch_workspace(self, job_id, build_id):
+        if self.workspace_cache is not None:
+            version = self.distci_client.builds.workspace.version(job_id, build_id)
+            wsdir = self.workspace_cache.checkout(job_id, build_id, version)
+            if wsdir is not None:
+                self.log.debug('Using cached workspace %s/%s version %s', job_id, build_id, version)
+                return wsdir
+        if self.worker_config.get('workspace_sync') == 'incremental':
+            wsdir = self.fetch_workspace_incremental(job_id, build_id)
+            if wsdir is not None:
+                return wsdir
+            self.log.info('Falling back to workspace archive for %s/%s', job_id, build_id)
+        return self.fetch_workspace_archive(job_id, build_id)
+
+    def fetch_workspace_archive(self, job_id, build_id):
+        if self.worker_config.get('workspace_streaming'):
+            return self.fetch_workspace_stream(job_id, build_id)
         archive = None
         for _ in range(self.worker_config.get('retry_count', 10)):
             archive = tempfile.TemporaryFile()
-            if self.distci_client.builds.workspace.get(job_id, build_id, archive) == True:
+            headers = {}
+            if self.distci_client.builds.workspace.get(job_id, build_id, archive, headers) == True:
                 break
             archive.close()
             archive = None
@@ -100,7 +129,7 @@ class WorkerBase(object):
 
         archive.seek(0)
         wsdir = tempfile.mkdtemp()
-        tarf = tarfile.open(fileobj=archive, mode='r')
+        tarf = tarfile.open(fileobj=archive, mode=compression.tar_read_mode(headers.get('x-workspace-codec')))
         for member in tarf.getmembers():
             absname = os.path.abspath(os.path.join(wsdir, member.name))
             if ((not absname.startswith('%s%s' % (wsdir, os.path.sep))) or
@@ -116,29 +145,337 @@ class WorkerBase(object):
 
         return wsdir
 
-    def send_workspace(self, job_id, build_id, workspace):
-        archive = tempfile.TemporaryFile()
-        tarf = tarfile.open(fileobj=archive, mode='w:gz')
+    def send_workspace(self, job_id, build_id, workspace, codec=None):
+        headers = {}
+        sent = False
+        if self.worker_config.get('workspace_sync') == 'incremental':
+            sent = self.send_workspace_incremental(job_id, build_id, workspace, headers)
+            if not sent:
+                self.log.info('Falling back to workspace archive for %s/%s', job_id, build_id)
+        if not sent:
+            sent = self.send_workspace_archive(job_id, build_id, workspace, codec, headers)
+        if sent and self.workspace_cache is not None:
+            version = headers.get('x-workspace-version')
+            if version is not None:
+                self.workspace_cache.store(job_id, build_id, version, workspace)
+            else:
+                self.workspace_cache.invalidate(job_id, build_id)
+        return sent
 
-        for root_file in os.listdir(workspace):
-            tarf.add(os.path.join(workspace, root_file), root_file)
+    def _workspace_codec(self, codec):
+        """ Return codec for a workspace archive, the one requested by the
+            job if valid, otherwise the one configured for the worker """
+        for candidate in (codec, self.worker_config.get('workspace_codec')):
+            if candidate is None:
+                continue
+            try:
+                compression.parse_codec(candidate)
+                return candidate
+            except ValueError:
+                self.log.error('Invalid workspace codec %r', candidate)
+        return compression.DEFAULT_CODEC
 
-        tarf.close()
+    def _write_archive(self, fileobj, workspace, codec):
+        """ Write workspace as a tar archive compressed with codec """
+        writer = compression.open_writer(fileobj, codec, self.worker_config.get('workspace_codec_threads'))
+        try:
+            tarf = tarfile.open(fileobj=writer, mode='w|')
+            for root_file in os.listdir(workspace):
+                tarf.add(os.path.join(workspace, root_file), root_file)
+            tarf.close()
+        finally:
+            writer.close()
+
+    def send_workspace_archive(self, job_id, build_id, workspace, codec=None, headers=None):
+        codec = self._workspace_codec(codec)
+        if self.worker_config.get('workspace_streaming'):
+            return self.send_workspace_stream(job_id, build_id, workspace, codec, headers)
+        archive = tempfile.TemporaryFile()
+        self._write_archive(archive, workspace, codec)
         ws_len = archive.tell()
-        self.log.debug('Workspace archive size: %d', ws_len)
+        self.log.debug('Workspace archive size: %d, codec %s', ws_len, codec)
 
         for _ in range(self.worker_config.get('retry_count', 10)):
             archive.seek(0)
-            if self.distci_client.builds.workspace.put(job_id, build_id, archive, ws_len) == True:
+            if self.distci_client.builds.workspace.put(job_id, build_id, archive, ws_len, compression.decoder_name(codec), headers) == True:
                 archive.close()
                 return True
         archive.close()
         return False
 
+    @classmethod
+    def _extract_stream(cls, fileobj, wsdir, decoder=None):
+        """ Extract a tar stream, validating each member before it is
+            written. Raises ValueError for members escaping wsdir. """
+        realdir = os.path.realpath(wsdir)
+        if decoder is None:
+            tarf = tarfile.open(fileobj=fileobj, mode='r|*')
+        else:
+            tarf = tarfile.open(fileobj=compression.open_reader(fileobj, decoder), mode='r|')
+        try:
+            for member in tarf:
+                absname = os.path.abspath(os.path.join(wsdir, member.name))
+                if ((not absname.startswith('%s%s' % (wsdir, os.path.sep))) or
+                    (not (member.isreg() or member.issym() or member.isdir()))):
+                    raise ValueError('Invalid workspace member %r' % member.name)
+                # parents may be symlinks extracted earlier from the same stream
+                parent = os.path.realpath(os.path.dirname(absname))
+                if parent != realdir and not parent.startswith('%s%s' % (realdir, os.path.sep)):
+                    raise ValueError('Workspace member %r behind a symlink' % member.name)
+                tarf.extract(member, wsdir)
+        finally:
+            tarf.close()
+
+    def fetch_workspace_stream(self, job_id, build_id):
+        """ Fetch workspace, extracting the archive while it downloads """
+        for _ in range(self.worker_config.get('retry_count', 10)):
+            response = self.distci_client.builds.workspace.open_stream(job_id, build_id)
+            if response is None:
+                continue
+            wsdir = tempfile.mkdtemp()
+            try:
+                self._extract_stream(response, wsdir, response.getheader('X-Workspace-Codec'))
+                return wsdir
+            except ValueError:
+                self.log.exception('Rejected workspace %s/%s', job_id, build_id)
+                shutil.rmtree(wsdir)
+                return None
+            except (tarfile.TarError, EnvironmentError, httplib.HTTPException):
+                self.log.exception('Failed to extract workspace %s/%s', job_id, build_id)
+                shutil.rmtree(wsdir)
+            finally:
+                response.close()
+        return None
+
+    def send_workspace_stream(self, job_id, build_id, workspace, codec=None, headers=None):
+        """ Send workspace, compressing the archive into the request body """
+        codec = self._workspace_codec(codec)
+        def produce(writer):
+            self._write_archive(writer, workspace, codec)
+
+        for _ in range(self.worker_config.get('retry_count', 10)):
+            if self.distci_client.builds.workspace.put_stream(job_id, build_id, produce, compression.decoder_name(codec), headers) == True:
+                return True
+        return False
+
+    def _blob_cache_dir(self):
+        """ Return directory for locally cached workspace file contents """
+        cache_dir = self.worker_config.get('workspace_blob_cache')
+        if cache_dir is None:
+            cache_dir = os.path.join(tempfile.gettempdir(), 'distci-workspace-blobs')
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+        return cache_dir
+
+    def _fetch_blob(self, job_id, build_id, sha256):
+        """ Return path of workspace file contents in the local cache,
+            downloading them if needed """
+        cached = os.path.join(self._blob_cache_dir(), sha256)
+        if os.path.isfile(cached):
+            try:
+                # most recently used last in eviction order
+                os.utime(cached, None)
+                return cached
+            except OSError:
+                pass
+        for _ in range(self.worker_config.get('retry_count', 10)):
+            fd, tmp_name = tempfile.mkstemp(dir=self._blob_cache_dir(), prefix='tmp-')
+            with os.fdopen(fd, 'w+b') as blob:
+                if self.distci_client.builds.workspace.get_blob(job_id, build_id, sha256, blob) == True:
+                    blob.seek(0)
+                    if file_digest(blob)[0] == sha256:
+                        os.rename(tmp_name, cached)
+                        return cached
+                    self.log.error('Digest mismatch for workspace file %s', sha256)
+            os.unlink(tmp_name)
+        return None
+
+    def _copy_blob(self, job_id, build_id, sha256, path):
+        """ Copy workspace file contents from the local cache to path.
+            Returns False if they could not be fetched. """
+        for _ in range(2):
+            cached = self._fetch_blob(job_id, build_id, sha256)
+            if cached is None:
+                return False
+            try:
+                shutil.copyfile(cached, path)
+                return True
+            except IOError, e:
+                # evicted by another worker on the node, fetch again
+                if e.errno != errno.ENOENT:
+                    raise
+        return False
+
+    def _evict_blobs(self):
+        """ Remove least recently used file contents until the local cache
+            fits its size limit """
+        cache_dir = self._blob_cache_dir()
+        max_size = self.worker_config.get('workspace_blob_cache_size', BLOB_CACHE_MAX_SIZE)
+        blobs = []
+        for name in os.listdir(cache_dir):
+            if name.startswith('tmp-'):
+                continue
+            try:
+                st = os.stat(os.path.join(cache_dir, name))
+            except OSError:
+                continue
+            blobs.append((st.st_mtime, st.st_size, name))
+        blobs.sort()
+        total = sum(size for _, size, _ in blobs)
+        while blobs and total > max_size:
+            _, size, name = blobs.pop(0)
+            try:
+                os.unlink(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+
+    @classmethod
+    def _set_attributes(cls, path, entry):
+        """ Set mode and mtime of a workspace file or directory from its
+            manifest entry """
+        if 'mode' in entry:
+            os.chmod(path, entry['mode'])
+        if 'mtime' in entry:
+            os.utime(path, (entry['mtime'], entry['mtime']))
+
+    def fetch_workspace_incremental(self, job_id, build_id):
+        """ Fetch workspace described by its manifest, downloading only
+            file contents missing from the local cache """
+        manifest = None
+        for _ in range(self.worker_config.get('retry_count', 10)):
+            manifest = self.distci_client.builds.workspace.get_manifest(job_id, build_id)
+            if manifest is not None:
+                break
+        if manifest is None:
+            return None
+
+        wsdir = tempfile.mkdtemp()
+        realdir = os.path.realpath(wsdir)
+        state = {}
+        directories = []
+        try:
+            for entry in sorted(manifest['entries'], key=lambda entry: entry['path']):
+                path = os.path.join(wsdir, *entry['path'].split('/'))
+                if not os.path.abspath(path).startswith('%s%s' % (wsdir, os.path.sep)):
+                    raise ValueError('Path outside workspace: %r' % entry['path'])
+                # parents may be symlinks created earlier from the same manifest
+                parent = os.path.realpath(os.path.dirname(path))
+                if parent != realdir and not parent.startswith('%s%s' % (realdir, os.path.sep)):
+                    raise ValueError('Path behind a symlink: %r' % entry['path'])
+                if os.path.islink(path):
+                    raise ValueError('Path behind a symlink: %r' % entry['path'])
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                if entry['type'] == 'dir':
+                    if not os.path.isdir(path):
+                        os.mkdir(path)
+                    # mode and mtime are set once the contents are written
+                    directories.append((path, entry))
+                    continue
+                elif entry['type'] == 'symlink':
+                    os.symlink(entry['target'], path)
+                    continue
+                else:
+                    # copy, as builds modify workspace files in place
+                    if not self._copy_blob(job_id, build_id, entry['sha256'], path):
+                        raise IOError('Failed to fetch %r' % entry['path'])
+                self._set_attributes(path, entry)
+                st = os.lstat(path)
+                state[entry['path']] = (st.st_size, st.st_mtime, entry['sha256'])
+            for path, entry in reversed(directories):
+                self._set_attributes(path, entry)
+        except (OSError, IOError, ValueError, KeyError, TypeError):
+            self.log.exception('Failed to fetch workspace %s/%s from manifest', job_id, build_id)
+            shutil.rmtree(wsdir)
+            return None
+        finally:
+            try:
+                self._evict_blobs()
+            except OSError:
+                self.log.exception('Failed to evict cached workspace files')
+
+        self.workspace_states[wsdir] = state
+        return wsdir
+
+    def _workspace_manifest(self, workspace):
+        """ Return manifest of a local workspace and a mapping from
+            digests to files. Files unchanged since fetch are not hashed. """
+        state = self.workspace_states.get(workspace, {})
+        entries = []
+        files = {}
+        for root, dirs, filenames in os.walk(workspace):
+            for name in sorted(dirs + filenames):
+                path = os.path.join(root, name)
+                rel_path = '/'.join(os.path.relpath(path, workspace).split(os.path.sep))
+                st = os.lstat(path)
+                entry = { 'path': rel_path, 'mode': stat.S_IMODE(st.st_mode), 'mtime': int(st.st_mtime) }
+                if stat.S_ISLNK(st.st_mode):
+                    entry['type'] = 'symlink'
+                    entry['target'] = os.readlink(path)
+                    del entry['mode']
+                elif stat.S_ISDIR(st.st_mode):
+                    entry['type'] = 'dir'
+                elif stat.S_ISREG(st.st_mode):
+                    entry['type'] = 'file'
+                    entry['size'] = st.st_size
+                    known = state.get(rel_path)
+                    if known is not None and known[:2] == (st.st_size, st.st_mtime):
+                        entry['sha256'] = known[2]
+                    else:
+                        with open(path, 'rb') as fileo:
+                            entry['sha256'] = file_digest(fileo)[0]
+                    files[entry['sha256']] = path
+                else:
+                    continue
+                entries.append(entry)
+        return { 'entries': entries }, files
+
+    def send_workspace_incremental(self, job_id, build_id, workspace, headers=None):
+        """ Send workspace as a manifest, uploading only file contents the
+            frontend does not have """
+        try:
+            manifest, files = self._workspace_manifest(workspace)
+        except (OSError, IOError):
+            self.log.exception('Failed to scan workspace %s', workspace)
+            return False
+
+        for _ in range(self.worker_config.get('retry_count', 10)):
+            missing = self.distci_client.builds.workspace.put_manifest(job_id, build_id, manifest, headers)
+            if missing is None:
+                continue
+            if missing == []:
+                return True
+            self.log.debug('Uploading %d of %d workspace files', len(missing), len(files))
+            for sha256 in missing:
+                if sha256 not in files:
+                    return False
+                with open(files[sha256], 'rb') as fileo:
+                    if not self.distci_client.builds.workspace.put_blob(job_id, build_id, sha256, fileo, os.fstat(fileo.fileno()).st_size):
+                        break
+        return False
+
     def delete_workspace(self, workspace):
+        self.workspace_states.pop(workspace, None)
         try:
             shutil.rmtree(workspace)
         except OSError:
             return False
         return True
 
+def file_digest(fileo):
+    """ return SHA-256 and size of the rest of a file object """
+    sha256 = hashlib.sha256()
+    size = 0
+    while True:
+        data = fileo.read(DIGEST_CHUNK_SIZE)
+        if data == '':
+            break
+        sha256.update(data)
+        size += len(data)
+    return sha256.hexdigest(), size
+
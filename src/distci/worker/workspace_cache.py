@@ -0,0 +1,207 @@
+"""
+Worker-local workspace cache
+
+Keeps the workspace a worker last sent for each build, keyed by job, build
+and the workspace version the frontend returned for it, so that the next
+subtask of the same build on this node does not download what was just
+uploaded. Workspaces are checked out of the cache with hard links when the
+cache is on the same file system. A build modifying a file in place would
+modify the cached copy too, so the size, mode and modification time of
+each file are recorded and checked on checkout. Entries are evicted least
+recently used first when the cache grows past its size limit.
+
+Copyright (c) 2013 Heikki Nousiainen, F-Secure
+See LICENSE for details
+"""
+
+import os
+import stat
+import json
+import errno
+import shutil
+import hashlib
+import logging
+import tempfile
+
+MAX_SIZE = 2*1024*1024*1024
+
+class WorkspaceCache(object):
+    """ On-disk LRU cache of workspaces """
+    def __init__(self, directory, max_size=MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.log = logging.getLogger('workspace_cache')
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    def _entry_dir(self, job_id, build_id):
+        """ Return directory of the cache entry of a build """
+        return os.path.join(self.directory, hashlib.sha1('%s/%s' % (job_id, build_id)).hexdigest())
+
+    @classmethod
+    def _info_file(cls, entry_dir):
+        """ Return filename of the description of a cache entry """
+        return os.path.join(entry_dir, 'info')
+
+    @classmethod
+    def _read_info(cls, entry_dir):
+        """ Return description of a cache entry, None if unusable """
+        try:
+            with open(cls._info_file(entry_dir), 'rb') as fileo:
+                return json.load(fileo)
+        except (IOError, ValueError):
+            return None
+
+    @classmethod
+    def _link_or_copy(cls, src, dst):
+        """ Hard link src to dst, copying across file systems """
+        try:
+            os.link(src, dst)
+        except OSError, e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copy2(src, dst)
+
+    @classmethod
+    def _file_state(cls, st):
+        """ Return recorded state of a file """
+        return [ st.st_size, stat.S_IMODE(st.st_mode), st.st_mtime ]
+
+    def _replicate(self, src, dst, files=None):
+        """ Replicate tree src as dst, linking regular files. Returns state
+            of the files, which are checked against 'files' if given. """
+        state = {}
+        for root, dirs, filenames in os.walk(src):
+            rel_root = os.path.relpath(root, src)
+            for name in dirs + filenames:
+                rel_path = os.path.normpath(os.path.join(rel_root, name))
+                src_path = os.path.join(src, rel_path)
+                dst_path = os.path.join(dst, rel_path)
+                st = os.lstat(src_path)
+                if stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(src_path), dst_path)
+                elif stat.S_ISDIR(st.st_mode):
+                    os.mkdir(dst_path)
+                elif stat.S_ISREG(st.st_mode):
+                    state[rel_path] = self._file_state(st)
+                    if files is not None and files.get(rel_path) != state[rel_path]:
+                        raise ValueError('Cached file %r modified' % rel_path)
+                    self._link_or_copy(src_path, dst_path)
+            # symlinks to directories are not descended into
+            dirs[:] = [ name for name in dirs if not os.path.islink(os.path.join(root, name)) ]
+        if files is not None and len(files) != len(state):
+            raise ValueError('Cached files missing')
+        for root, dirs, _ in os.walk(src, topdown=False):
+            for name in dirs:
+                rel_path = os.path.normpath(os.path.join(os.path.relpath(root, src), name))
+                if not os.path.islink(os.path.join(src, rel_path)):
+                    shutil.copystat(os.path.join(src, rel_path), os.path.join(dst, rel_path))
+        shutil.copystat(src, dst)
+        return state
+
+    def _remove(self, path):
+        """ Remove a cache entry or a partial one """
+        try:
+            shutil.rmtree(path)
+        except OSError:
+            self.log.exception('Failed to remove %s', path)
+
+    def store(self, job_id, build_id, version, workspace):
+        """ Cache workspace as the given version of the build workspace,
+            replacing an earlier version """
+        tmp_dir = tempfile.mkdtemp(dir=self.directory, prefix='tmp-')
+        try:
+            os.rmdir(tmp_dir)
+            os.mkdir(tmp_dir)
+            os.mkdir(os.path.join(tmp_dir, 'tree'))
+            files = self._replicate(workspace, os.path.join(tmp_dir, 'tree'))
+            info = { 'job_id': job_id,
+                     'build_id': str(build_id),
+                     'version': version,
+                     'size': sum(state[0] for state in files.itervalues()),
+                     'files': files }
+            with open(self._info_file(tmp_dir), 'wb') as fileo:
+                json.dump(info, fileo)
+        except (OSError, IOError):
+            self.log.exception('Failed to cache workspace %s/%s', job_id, build_id)
+            self._remove(tmp_dir)
+            return False
+
+        entry_dir = self._entry_dir(job_id, build_id)
+        if os.path.isdir(entry_dir):
+            old_dir = tempfile.mkdtemp(dir=self.directory, prefix='tmp-')
+            try:
+                os.rename(entry_dir, os.path.join(old_dir, 'entry'))
+            except OSError:
+                pass
+            self._remove(old_dir)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another worker cached the build in between
+            self.log.exception('Failed to cache workspace %s/%s', job_id, build_id)
+            self._remove(tmp_dir)
+            return False
+        self.evict()
+        return True
+
+    def checkout(self, job_id, build_id, version):
+        """ Return a new workspace directory with the cached workspace of
+            the build, None unless the cached version matches """
+        if version is None:
+            return None
+        entry_dir = self._entry_dir(job_id, build_id)
+        info = self._read_info(entry_dir)
+        if info is None or info.get('version') != version:
+            return None
+
+        wsdir = tempfile.mkdtemp()
+        try:
+            self._replicate(os.path.join(entry_dir, 'tree'), wsdir, info['files'])
+        except (OSError, IOError, ValueError, KeyError):
+            self.log.exception('Discarding cached workspace %s/%s', job_id, build_id)
+            shutil.rmtree(wsdir)
+            self.invalidate(job_id, build_id)
+            return None
+
+        try:
+            # most recently used first in eviction order
+            os.utime(entry_dir, None)
+        except OSError:
+            pass
+        return wsdir
+
+    def invalidate(self, job_id, build_id):
+        """ Drop the cached workspace of a build """
+        entry_dir = self._entry_dir(job_id, build_id)
+        if os.path.isdir(entry_dir):
+            self._remove(entry_dir)
+
+    def evict(self):
+        """ Remove least recently used entries until the cache fits its
+            size limit """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('tmp-'):
+                continue
+            entry_dir = os.path.join(self.directory, name)
+            info = self._read_info(entry_dir)
+            try:
+                last_used = os.stat(entry_dir).st_mtime
+            except OSError:
+                continue
+            if info is None:
+                self._remove(entry_dir)
+                continue
+            entries.append((last_used, info.get('size', 0), entry_dir))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        while entries and total > self.max_size:
+            _, size, entry_dir = entries.pop(0)
+            self.log.debug('Evicting %s', entry_dir)
+            self._remove(entry_dir)
+            total -= size